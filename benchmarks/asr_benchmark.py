@@ -0,0 +1,138 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Сравнение движков распознавания: время загрузки, real-time factor (время распознавания / длительность записи)
+# и пиковый RSS. Каждый движок запускается в отдельном процессе, чтобы память одного не смешивалась с другим.
+
+def rss_mb(peak=False):
+    if peak:
+        if resource is None:
+            return None
+        value = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux отдаёт килобайты, macOS - байты
+        return value / 1024 / 1024 if sys.platform == 'darwin' else value / 1024
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except (OSError, ValueError):
+        return None
+
+
+def load_audio(paths, seconds):
+    from vrecog.audio import decode_audio_bytes, SAMPLE_RATE
+    if not paths:
+        # Без записей - синтетический сигнал: текст бессмысленный, но RTF и память измеряются
+        rng = np.random.default_rng(1)
+        t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+        audio = (0.1 * np.sin(2 * np.pi * 220 * t) * (np.sin(2 * np.pi * 0.5 * t) > 0)
+                 + 0.01 * rng.standard_normal(len(t))).astype(np.float32)
+        return [('synthetic', audio)]
+    result = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            result.append((os.path.basename(path), decode_audio_bytes(f.read())))
+    return result
+
+
+def run_child(args):
+    from vrecog.audio import SAMPLE_RATE
+    from vrecog.backends import create_backend
+    audio = load_audio(args.audio, args.seconds)
+    baseline = rss_mb()
+    started = time.perf_counter()
+    backend = create_backend(args.child, model=args.model, model_path=args.model_path, cpu_threads=args.threads,
+                             beam_size=args.beam_size, language=args.language, compute_type=args.compute_type)
+    backend.load()
+    load_seconds = time.perf_counter() - started
+    loaded = rss_mb()
+    # Первый прогон прогревает движок и в замеры не входит
+    backend.transcribe(audio[0][1][:SAMPLE_RATE * 5])
+    rtfs = []
+    texts = {}
+    for name, samples in audio:
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            texts[name] = backend.transcribe(samples)
+            rtfs.append((time.perf_counter() - started) / (len(samples) / SAMPLE_RATE))
+    print(json.dumps({
+        'backend': args.child,
+        'load_seconds': load_seconds,
+        'model_mb': None if baseline is None or loaded is None else loaded - baseline,
+        'peak_rss_mb': rss_mb(peak=True),
+        'rtf_median': statistics.median(rtfs),
+        'rtf_max': max(rtfs),
+        'texts': texts,
+    }, ensure_ascii=False))
+
+
+def run_backend(backend, argv):
+    completed = subprocess.run(
+        [sys.executable, '-m', 'benchmarks.asr_benchmark', '--child', backend] + argv,
+        cwd=ROOT, capture_output=True, text=True
+    )
+    if completed.returncode != 0:
+        return {'backend': backend, 'error': (completed.stderr.strip().splitlines() or ['failed'])[-1]}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ASR backends: load time, real-time factor and memory")
+    parser.add_argument('--backends', nargs='+', default=['whisper', 'faster_whisper'])
+    parser.add_argument('--audio', nargs='*', default=[], help="voice files (OGG/MP3/WAV); default: synthetic signal")
+    parser.add_argument('--seconds', type=float, default=30.0, help="length of the synthetic signal")
+    parser.add_argument('--model', default='small')
+    parser.add_argument('--model-path', default=None)
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--beam-size', type=int, default=0)
+    parser.add_argument('--language', default=None)
+    parser.add_argument('--compute-type', default='int8')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    argv = ['--seconds', str(args.seconds), '--model', args.model, '--threads', str(args.threads),
+            '--beam-size', str(args.beam_size), '--compute-type', args.compute_type, '--repeat', str(args.repeat)]
+    if args.model_path:
+        argv += ['--model-path', args.model_path]
+    if args.language:
+        argv += ['--language', args.language]
+    if args.audio:
+        argv += ['--audio'] + [os.path.abspath(path) for path in args.audio]
+
+    print(f"{'backend':>16}{'load s':>9}{'RTF p50':>9}{'RTF max':>9}{'model MB':>10}{'peak MB':>9}")
+    results = [run_backend(backend, argv) for backend in args.backends]
+    for result in results:
+        if 'error' in result:
+            print(f"{result['backend']:>16}  failed: {result['error']}")
+            continue
+        model_mb = '-' if result['model_mb'] is None else f"{result['model_mb']:.0f}"
+        peak_mb = '-' if result['peak_rss_mb'] is None else f"{result['peak_rss_mb']:.0f}"
+        print(f"{result['backend']:>16}{result['load_seconds']:>9.1f}{result['rtf_median']:>9.3f}"
+              f"{result['rtf_max']:>9.3f}{model_mb:>10}{peak_mb:>9}")
+    for result in results:
+        for name, text in result.get('texts', {}).items():
+            print(f"{result['backend']} / {name}: {text.strip()[:100]}")
+
+
+if __name__ == '__main__':
+    main()
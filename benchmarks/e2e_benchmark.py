@@ -0,0 +1,305 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+CORPUS = os.path.join(ROOT, 'benchmarks', 'data', 'shipments_corpus.jsonl')
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Сквозной бенчмарк без сети: настоящий handle_message и машина состояний,
+# а Telegram, Google Sheets, LLM и Whisper заменены локальными заглушками с настраиваемой задержкой.
+
+class StageTimer:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+    def wrap(self, stage, func):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - started)
+        return timed
+
+
+def sleep_for(latency, jitter):
+    if latency > 0:
+        time.sleep(max(0.0, random.gauss(latency, latency * jitter)))
+
+
+class FakeSheetsManager:
+    def __init__(self, worksheet, headers, latency, jitter):
+        self.worksheet = worksheet
+        self.headers = headers
+        self.latency = latency
+        self.jitter = jitter
+        self.rows = []
+        self._lock = threading.Lock()
+
+    def get_headers(self):
+        sleep_for(self.latency, self.jitter)
+        return list(self.headers)
+
+    def rows_from_json(self, items):
+        headers = self.get_headers()
+        return [[data.get(header, "") for header in headers] for data in items]
+
+    def append_rows(self, rows):
+        sleep_for(self.latency, self.jitter)
+        with self._lock:
+            self.rows.extend(rows)
+        return {'updates': {'updatedRows': len(rows)}}
+
+    def append_row(self, values):
+        return self.append_rows([values])
+
+    def append_row_from_json(self, data):
+        self.append_rows(self.rows_from_json([data]))
+
+    def get_column_values(self, header):
+        sleep_for(self.latency, self.jitter)
+        index = self.headers.index(header)
+        with self._lock:
+            return [row[index] for row in self.rows]
+
+    def find_rows(self, value):
+        return [row for row, cell in enumerate(self.get_column_values('shipment_id'), start=2) if cell == str(value)]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux отдаёт килобайты, macOS - байты
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def setup_environment(args, tmpdir):
+    os.environ.setdefault('TELEGRAM_SHIPMENT_DATA_BOT_TOKEN', '123456:BENCHMARK')
+    os.environ['SESSION_STORE_PATH'] = os.path.join(tmpdir, 'sessions.sqlite3')
+    os.environ['SHIPMENT_JOURNAL_PATH'] = os.path.join(tmpdir, 'journal.sqlite3')
+    os.environ['SHIPMENT_JOURNAL_ENABLED'] = 'true' if args.journal else 'false'
+    os.environ['STARTUP_WARM_UP'] = 'false'
+    os.environ['SHEETS_WRITE_BEHIND'] = 'false'
+    os.environ['WHISPER_WORKERS'] = '0'
+    # Заглушка скачивания отдаёт одинаковые байты: с кэшем распознаётся только первое голосовое
+    os.environ['TRANSCRIPT_CACHE_ENABLED'] = 'true' if args.cache else 'false'
+    os.environ['TRANSCRIPT_CACHE_PATH'] = os.path.join(tmpdir, 'transcripts.sqlite3')
+    os.environ['SHEETS_MIRROR_PATH'] = os.path.join(tmpdir, 'sheets_mirror')
+    if not args.telegram_limits:
+        # Без --telegram-limits очередь исходящих сообщений не сдерживает заглушку Telegram
+        os.environ['OUTBOUND_GLOBAL_RATE'] = '100000'
+        os.environ['OUTBOUND_CHAT_RATE'] = '100000'
+        os.environ['OUTBOUND_CHAT_BURST'] = '100000'
+
+
+def install_fakes(main, args, timer, corpus):
+    from shipment_parser import parser as shipment_parser
+    from shipment_parser.rules import extract_shipments
+    from storage_managers import google_sheets_man
+    from shipment_parser.schema import shipment_fields, procurement_fields
+
+    bot = main.bot
+    bot.threaded = False
+    sent = defaultdict(int)
+
+    def send_message(chat_id, text, **kwargs):
+        sleep_for(args.telegram_latency, args.jitter)
+        sent[chat_id] += 1
+        return SimpleNamespace(message_id=sent[chat_id], chat=SimpleNamespace(id=chat_id), text=text)
+
+    def reply_to(message, text, **kwargs):
+        return send_message(message.chat.id, text, **kwargs)
+
+    def get_file(file_id):
+        sleep_for(args.telegram_latency, args.jitter)
+        return SimpleNamespace(file_id=file_id, file_path=f"voice/{file_id}.ogg", file_size=32 * 1024)
+
+    def download_file_capped(file_info, max_bytes):
+        sleep_for(args.telegram_latency, args.jitter)
+        return bytearray(file_info.file_size)
+
+    def recognise_text(audio, *args_, **kwargs):
+        sleep_for(args.asr_latency, args.jitter)
+        return random.choice(corpus)
+
+    class FakeAssistant:
+        def ask_question(self, text):
+            sleep_for(args.llm_latency, args.jitter)
+            return json.dumps({'shipments': extract_shipments(text).shipments}, ensure_ascii=False)
+
+    bot.send_message = timer.wrap('telegram_send', send_message)
+    bot.reply_to = timer.wrap('telegram_send', reply_to)
+    bot.edit_message_text = timer.wrap('telegram_send', lambda text, chat_id=None, message_id=None, **kwargs: send_message(chat_id, text))
+    bot.get_file = get_file
+    main.download_file_capped = timer.wrap('download', download_file_capped)
+    main.recognise_text = timer.wrap('recognise_text', recognise_text)
+    main.parse_shipment = timer.wrap('parse_shipment', main.parse_shipment)
+
+    for provider in shipment_parser.llm_router.providers:
+        provider.pool.factory = FakeAssistant
+    shipment_parser.ask_llm = timer.wrap('llm', shipment_parser.ask_llm)
+    if not args.cache:
+        shipment_parser.parse_cache.maxsize = 0
+    main.config.RULES_FAST_PATH = args.rules
+
+    shipments = FakeSheetsManager('shipments', ['shipment_id'] + shipment_fields, args.sheets_latency, args.jitter)
+    procurements = FakeSheetsManager('procurements', ['shipment_id'] + procurement_fields, args.sheets_latency, args.jitter)
+    google_sheets_man.shipment_store = shipments
+    google_sheets_man.procurement_store = procurements
+    main.store_shipment = timer.wrap('store_shipment', main.store_shipment)
+    if main.shipment_journal is not None:
+        main.shipment_journal.record = timer.wrap('journal_record', main.shipment_journal.record)
+        main.journal_replayer.store = timer.wrap('journal_replay', main.journal_replayer.store)
+    return shipments
+
+
+class UpdateFactory:
+    def __init__(self):
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def _ids(self):
+        with self._lock:
+            self._next_id += 1
+            return self._next_id
+
+    def make(self, user_id, text=None, voice=False):
+        from telebot import types
+        update_id = self._ids()
+        message = {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+        }
+        if voice:
+            message['voice'] = {'file_id': f'voice{update_id}', 'file_unique_id': f'uvoice{update_id}',
+                                'duration': 15, 'mime_type': 'audio/ogg', 'file_size': 32 * 1024}
+        else:
+            message['text'] = text
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+        return types.Update.de_json({'update_id': update_id, 'message': message})
+
+
+def user_script(user_id, factory, corpus, shipments_per_user, voice_ratio):
+    # /add_shipment -> текст или голос -> подтверждение, и так несколько раз
+    updates = []
+    for _ in range(shipments_per_user):
+        updates.append(factory.make(user_id, '/add_shipment'))
+        if random.random() < voice_ratio:
+            updates.append(factory.make(user_id, voice=True))
+        else:
+            updates.append(factory.make(user_id, random.choice(corpus)))
+        updates.append(factory.make(user_id, 'да'))
+    return updates
+
+
+def run(args):
+    random.seed(args.seed)
+    with open(CORPUS, encoding='utf-8') as f:
+        corpus = [json.loads(line)['text'] for line in f if line.strip()]
+
+    tmpdir = tempfile.mkdtemp(prefix='shipment_bench_')
+    setup_environment(args, tmpdir)
+    import main
+    from runtime.async_runtime import UserUpdateDispatcher
+    logging.getLogger().setLevel(logging.WARNING)
+
+    timer = StageTimer()
+    shipments_sheet = install_fakes(main, args, timer, corpus)
+    factory = UpdateFactory()
+    scripts = {user_id: user_script(user_id, factory, corpus, args.shipments, args.voice_ratio)
+               for user_id in range(1, args.users + 1)}
+    total_updates = sum(len(updates) for updates in scripts.values())
+
+    def process(update):
+        started = time.perf_counter()
+        main.bot.process_new_updates([update])
+        timer.record('update_total', time.perf_counter() - started)
+
+    async def drive():
+        dispatcher = UserUpdateDispatcher(process, max_workers=args.workers,
+                                          max_queue_size=args.queue_size, max_pending=args.workers * args.queue_size)
+        # Обновления разных пользователей перемешаны, как в реальном потоке getUpdates
+        pending = {user_id: list(updates) for user_id, updates in scripts.items()}
+        while pending:
+            for user_id in list(pending):
+                await dispatcher.submit(user_id, pending[user_id].pop(0))
+                if not pending[user_id]:
+                    del pending[user_id]
+        await dispatcher.drain()
+
+    started = time.perf_counter()
+    asyncio.run(drive())
+    main.outbound.flush()
+    if main.journal_replayer is not None:
+        while main.shipment_journal.pending_count():
+            main.journal_replayer.replay_once()
+    elapsed = time.perf_counter() - started
+
+    print(f"users {args.users}, updates {total_updates}, workers {args.workers}, "
+          f"stored shipments {len(shipments_sheet.rows)}")
+    print(f"elapsed {elapsed:.2f}s, throughput {total_updates / elapsed:.1f} updates/s, "
+          f"{len(shipments_sheet.rows) / elapsed:.1f} shipments/s")
+    print(f"{'stage':<16}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage in sorted(timer.samples):
+        values = timer.samples[stage]
+        print(f"{stage:<16}{len(values):>8}{percentile(values, 0.5) * 1e3:>10.2f}"
+              f"{percentile(values, 0.95) * 1e3:>10.2f}{percentile(values, 0.99) * 1e3:>10.2f}")
+    rss = peak_rss_mb()
+    if rss is not None:
+        print(f"peak RSS {rss:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark of the shipment bot")
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--shipments', type=int, default=3, help="shipments per user")
+    parser.add_argument('--voice-ratio', type=float, default=0.3)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--queue-size', type=int, default=16)
+    parser.add_argument('--telegram-latency', type=float, default=0.03)
+    parser.add_argument('--asr-latency', type=float, default=0.5)
+    parser.add_argument('--llm-latency', type=float, default=1.0)
+    parser.add_argument('--sheets-latency', type=float, default=0.2)
+    parser.add_argument('--jitter', type=float, default=0.2, help="relative stddev of fake latencies")
+    parser.add_argument('--rules', action='store_true', help="enable the rule-based fast path")
+    parser.add_argument('--cache', action='store_true', help="enable the LLM result and transcript caches")
+    parser.add_argument('--journal', action='store_true', help="store through the SQLite journal")
+    parser.add_argument('--telegram-limits', action='store_true', help="pace replies with the real Telegram rate limits")
+    parser.add_argument('--seed', type=int, default=1)
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
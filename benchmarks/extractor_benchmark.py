@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from shipment_parser.schema import shipment_fields
+from shipment_parser.rules import extract_shipments
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'shipments_corpus.jsonl')
+
+
+# Корпус - JSONL: {"text": ..., "expected": {поле: значение}}.
+# Необязательные "llm_shipments" и "llm_latency" - ранее записанные ответы LLM для сравнения без сети.
+def load_corpus(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def normalize(value):
+    if value is None:
+        return None
+    return ' '.join(str(value).split()).casefold()
+
+
+def field_matches(shipments, expected):
+    actual = shipments[0] if shipments else {}
+    return {field: normalize(actual.get(field)) == normalize(expected.get(field)) for field in shipment_fields}
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def report(name, latencies, matches):
+    total = sum(len(match) for match in matches)
+    correct = sum(sum(match.values()) for match in matches)
+    print(f"{name}: {len(latencies)} messages, accuracy {correct / total:.1%} ({correct}/{total} fields), "
+          f"latency p50 {statistics.median(latencies) * 1e3:.3f} ms, p95 {percentile(latencies, 0.95) * 1e3:.3f} ms")
+    for field in shipment_fields:
+        field_correct = sum(match[field] for match in matches)
+        print(f"    {field:<18} {field_correct}/{len(matches)}")
+
+
+def bench_rules(corpus, repeat, threshold):
+    latencies, matches, confident_matches = [], [], []
+    for record in corpus:
+        started = time.perf_counter()
+        for _ in range(repeat):
+            extraction = extract_shipments(record['text'])
+        latencies.append((time.perf_counter() - started) / repeat)
+        match = field_matches(extraction.shipments, record['expected'])
+        matches.append(match)
+        if extraction.confidence >= threshold:
+            confident_matches.append(match)
+    report("rules (all messages)", latencies, matches)
+    print(f"rules fast path taken for {len(confident_matches)}/{len(corpus)} messages (threshold {threshold})")
+    if confident_matches:
+        total = sum(len(match) for match in confident_matches)
+        correct = sum(sum(match.values()) for match in confident_matches)
+        print(f"rules accuracy on fast-path messages: {correct / total:.1%}")
+
+
+def bench_llm(corpus, live):
+    latencies, matches = [], []
+    if live:
+        from shipment_parser.parser import ask_llm
+    for record in corpus:
+        if live:
+            started = time.perf_counter()
+            shipments = json.loads(ask_llm(record['text'])).get('shipments')
+            latencies.append(time.perf_counter() - started)
+        elif 'llm_shipments' in record:
+            shipments = record['llm_shipments']
+            latencies.append(record.get('llm_latency', 0.0))
+        else:
+            continue
+        matches.append(field_matches(shipments, record['expected']))
+    if not matches:
+        print("llm: no live calls (--llm) and no recorded llm_shipments in corpus, skipped")
+        return
+    report("llm" if live else "llm (recorded)", latencies, matches)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rule-based extractor vs LLM: latency and field accuracy")
+    parser.add_argument('--corpus', default=DEFAULT_CORPUS)
+    parser.add_argument('--repeat', type=int, default=200, help="rule extractor runs per message")
+    parser.add_argument('--threshold', type=float, default=config.RULES_CONFIDENCE_THRESHOLD)
+    parser.add_argument('--llm', action='store_true', help="call the real LLM for every message")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    bench_rules(corpus, args.repeat, args.threshold)
+    bench_llm(corpus, args.llm)
+
+
+if __name__ == '__main__':
+    main()
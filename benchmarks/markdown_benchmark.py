@@ -0,0 +1,52 @@
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from telegram_formatter import escape_markdown_v2
+# Эталон и проверка совпадения с ним на случайных текстах - в tests/test_telegram_formatter.py
+from tests.markdown_reference import escape_reference
+
+SAMPLE = """## Итоги по отгрузкам
+
+Отгрузка **Мастер Строй** на _Ярославское шоссе 114_ подтверждена. Цена 4850 руб. (доставка 7000-7500 руб.)!
+- бетон М220, 1 куб.
+- раствор М150, 2.5 куб.
+
+```python
+total = sum(row['price'] for row in rows)  # итого
+```
+
+Подробнее: [отчёт](https://example.com/report?id=42) и `shipments.xlsx`, ||спойлер||, ~не актуально~.
+"""
+
+
+def timed(func, text, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func(text)
+    return (time.perf_counter() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MarkdownV2 escaper: speed on large LLM-like replies")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[4096, 65536, 524288])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'size':>10}{'reference ms':>15}{'scanner ms':>13}{'speedup':>9}")
+    for size in args.sizes:
+        text = (SAMPLE * (size // len(SAMPLE) + 1))[:size]
+        reference = timed(escape_reference, text, args.repeat)
+        scanner = timed(escape_markdown_v2, text, args.repeat)
+        print(f"{size:>10}{reference * 1e3:>15.2f}{scanner * 1e3:>13.2f}{reference / scanner:>8.1f}x")
+
+    # Худший случай для наивного поиска разделителей: много открывающих скобок без закрывающих
+    text = '[' * 20000 + ']' + 'x' * 20000
+    print(f"unbalanced brackets, 40k chars: reference {timed(escape_reference, text, 1) * 1e3:.1f} ms, "
+          f"scanner {timed(escape_markdown_v2, text, 1) * 1e3:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Запускается в отдельном процессе: импортирует бота и отвечает на /start.
+# Ответ перехватывается, в Telegram ничего не отправляется.
+CHILD = r'''
+import json, os, sys, time
+started = float(sys.argv[1])
+eager = sys.argv[2] == 'eager'
+sys.path.insert(0, os.getcwd())
+import main
+imported = time.time()
+from telebot import types
+replies = []
+main.bot.reply_to = lambda message, text, **kwargs: replies.append(time.time())
+main.bot.send_message = lambda chat_id, text, **kwargs: replies.append(time.time())
+main.bot.threaded = False
+if eager:
+    main.warm_up()
+else:
+    main.start_warm_up()
+update = types.Update.de_json({
+    "update_id": 1,
+    "message": {
+        "message_id": 1,
+        "date": int(time.time()),
+        "chat": {"id": 1, "type": "private"},
+        "from": {"id": 1, "is_bot": False, "first_name": "bench"},
+        "text": "/start",
+        "entities": [{"type": "bot_command", "offset": 0, "length": 6}]
+    }
+})
+main.bot.process_new_updates([update])
+# Ответ уходит через очередь исходящих сообщений - ждём, пока она опустеет
+main.outbound.flush(30)
+print(json.dumps({"import": imported - started, "first_reply": replies[0] - started}))
+sys.stdout.flush()
+os._exit(0)
+'''
+
+
+def run_once(mode):
+    env = dict(os.environ)
+    env.setdefault('TELEGRAM_SHIPMENT_DATA_BOT_TOKEN', '123456:BENCHMARK')
+    with tempfile.TemporaryDirectory(prefix='startup_bench_') as tmpdir:
+        # Все файлы бота - во временном каталоге, а не в корне репозитория
+        env['DATA_ROOT_PATH'] = tmpdir
+        env['SHIPMENT_JOURNAL_PATH'] = os.path.join(tmpdir, 'journal.sqlite3')
+        env['SESSION_STORE_PATH'] = os.path.join(tmpdir, 'sessions.sqlite3')
+        env['TRANSCRIPT_CACHE_PATH'] = os.path.join(tmpdir, 'transcripts.sqlite3')
+        env['SHEETS_MIRROR_PATH'] = os.path.join(tmpdir, 'sheets_mirror')
+        started = time.time()
+        output = subprocess.run(
+            [sys.executable, '-c', CHILD, repr(started), mode],
+            cwd=ROOT, env=env, capture_output=True, text=True, check=True
+        ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time-to-first-reply to /start after process start")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--modes', nargs='+', default=['lazy', 'eager'], choices=['lazy', 'eager'])
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        results = [run_once(mode) for _ in range(args.runs)]
+        imports = [result['import'] for result in results]
+        replies = [result['first_reply'] for result in results]
+        print(f"{mode:>5}: import {statistics.median(imports):.3f}s, "
+              f"time-to-first-reply median {statistics.median(replies):.3f}s, "
+              f"min {min(replies):.3f}s, max {max(replies):.3f}s ({args.runs} runs)")
+
+
+if __name__ == '__main__':
+    main()
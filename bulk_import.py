@@ -0,0 +1,267 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Iterator, NamedTuple, Optional
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+import config
+from shipment_parser.parser import parse_shipment
+from shipment_parser.schema import Shipment, shipment_fields
+from storage_managers import google_sheets_man
+from storage_managers.batch_writer import SheetsBatchWriter
+
+# shipment_id импортированных отгрузок - uuid5 от записи источника: повторный импорт даёт те же id
+IMPORT_NAMESPACE = uuid.uuid5(uuid.NAMESPACE_URL, 'shipment_data_maintenance_bot/bulk_import')
+AUDIO_EXTENSIONS = ('.ogg', '.oga', '.opus', '.mp3', '.wav', '.m4a')
+
+
+class ImportRecord(NamedTuple):
+    key: str
+    text: Optional[str]
+    voice_path: Optional[str]
+
+
+def _is_voice_path(value, base_dir) -> bool:
+    value = value.strip()
+    return value.lower().endswith(AUDIO_EXTENSIONS) and os.path.isfile(os.path.join(base_dir, value))
+
+
+def _raw_records(path) -> Iterator[dict]:
+    # JSONL: {"text": ...} или {"voice": путь}, необязательный "id".
+    # CSV: колонки text / voice / id. Текст: записи разделены пустыми строками, строка с путём к аудио - голосовое.
+    base_dir = os.path.dirname(os.path.abspath(path))
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, encoding='utf-8', newline='') as f:
+        if extension in ('.jsonl', '.json'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        elif extension == '.csv':
+            yield from csv.DictReader(f)
+        else:
+            block = []
+            for line in f:
+                if line.strip():
+                    block.append(line.rstrip('\n'))
+                    continue
+                if block:
+                    yield {'text': '\n'.join(block)}
+                    block = []
+            if block:
+                yield {'text': '\n'.join(block)}
+
+
+def read_records(path) -> Iterator[ImportRecord]:
+    base_dir = os.path.dirname(os.path.abspath(path))
+    seen = Counter()
+    for raw in _raw_records(path):
+        text = (raw.get('text') or '').strip() or None
+        voice = (raw.get('voice') or '').strip() or None
+        if voice is None and text is not None and '\n' not in text and _is_voice_path(text, base_dir):
+            voice, text = text, None
+        if voice is not None:
+            voice = os.path.join(base_dir, voice)
+        if text is None and voice is None:
+            continue
+        key = str(raw.get('id') or '').strip()
+        if not key:
+            # Ключ по содержимому: вставка строк в файл не сдвигает ключи остальных записей
+            digest = hashlib.sha1((text or os.path.basename(voice)).encode('utf-8')).hexdigest()[:16]
+            seen[digest] += 1
+            key = f"{digest}:{seen[digest]}"
+        yield ImportRecord(key, text, voice)
+
+
+def validate_shipment(shipment: dict) -> dict:
+    # LLM иногда возвращает числа вместо строк
+    values = {field: str(value) if isinstance(value, (int, float)) else value for field, value in shipment.items()}
+    for procurement in values.get('procurements') or []:
+        for field, value in procurement.items():
+            if isinstance(value, (int, float)):
+                procurement[field] = str(value)
+    validated = Shipment.model_validate(values).model_dump()
+    if not any(validated.get(field) for field in shipment_fields):
+        raise ValueError("Shipment has no fields")
+    return validated
+
+
+def process_record(record: ImportRecord):
+    text = record.text
+    if record.voice_path is not None:
+        from vrecog.vrecog import recognise_text
+        with open(record.voice_path, 'rb') as f:
+            text = recognise_text(f.read())
+        if not text:
+            raise ValueError("Voice message was not recognised")
+    shipments = parse_shipment(text)
+    if not shipments:
+        raise ValueError("No shipments parsed")
+    result = []
+    for index, shipment in enumerate(shipments):
+        shipment = validate_shipment(shipment)
+        shipment['shipment_id'] = str(uuid.uuid5(IMPORT_NAMESPACE, f"{record.key}:{index}"))
+        result.append(shipment)
+    return result
+
+
+class Checkpoint:
+    # Ключи записей, строки которых уже в таблицах. Файл только дописывается, каждая строка - с fsync.
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        # Файл есть, даже если прошлый запуск прервался до первой отметки
+        self.resumed = os.path.exists(path)
+        if self.resumed:
+            with open(path, encoding='utf-8') as f:
+                self.done = {line.strip() for line in f if line.strip()}
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def mark(self, keys):
+        if not keys:
+            return
+        self._file.write(''.join(f"{key}\n" for key in keys))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.done.update(keys)
+
+    def close(self):
+        self._file.close()
+
+
+class Importer:
+    def __init__(self, args):
+        self.args = args
+        self.checkpoint = Checkpoint(args.checkpoint or args.input + '.checkpoint')
+        self.errors = open(args.errors or args.input + '.errors.jsonl', 'a', encoding='utf-8')
+        self.writer = SheetsBatchWriter(
+            flush_interval=args.flush_interval,
+            max_batch_rows=args.batch_rows,
+            requests_per_minute=config.SHEETS_REQUESTS_PER_MINUTE
+        )
+        self.existing_shipments = set()
+        self.existing_procurements = Counter()
+        self.started = time.monotonic()
+        self.stats = Counter()
+
+    def load_existing(self):
+        # После прерванного импорта часть строк могла попасть в таблицы без отметки в checkpoint
+        self.existing_shipments = set(google_sheets_man.shipment_store.get_column_values('shipment_id'))
+        self.existing_procurements = Counter(google_sheets_man.procurement_store.get_column_values('shipment_id'))
+        logger.info(f"Resuming: {len(self.checkpoint.done)} records done, "
+                    f"{len(self.existing_shipments)} shipments already in the sheet")
+
+    def enqueue_rows(self, shipments):
+        futures = []
+        for shipment in shipments:
+            procurements = google_sheets_man.shipment_procurements(shipment)
+            shipment_id = shipment['shipment_id']
+            if shipment_id not in self.existing_shipments:
+                futures.append(self.writer.append(google_sheets_man.shipment_store, shipment))
+                self.stats['shipment_rows'] += 1
+            for procurement in procurements[self.existing_procurements[shipment_id]:]:
+                futures.append(self.writer.append(google_sheets_man.procurement_store, procurement))
+                self.stats['procurement_rows'] += 1
+        return futures
+
+    def fail(self, record: ImportRecord, error):
+        self.stats['failed'] += 1
+        logger.error(f"Error importing record {record.key}: {str(error)}")
+        self.errors.write(json.dumps({
+            'key': record.key, 'text': record.text, 'voice': record.voice_path, 'error': str(error)
+        }, ensure_ascii=False) + '\n')
+        self.errors.flush()
+
+    def collect_written(self, writing, block=False):
+        # Запись отмечается в checkpoint, когда все её строки записаны
+        if block:
+            for _, futures in writing:
+                wait(futures)
+        done_keys = []
+        still_writing = []
+        for record, futures in writing:
+            if not all(future.done() for future in futures):
+                still_writing.append((record, futures))
+                continue
+            errors = [future.exception() for future in futures if future.exception() is not None]
+            if errors:
+                self.fail(record, errors[0])
+            else:
+                done_keys.append(record.key)
+        self.checkpoint.mark(done_keys)
+        self.stats['imported'] += len(done_keys)
+        return still_writing
+
+    def report(self, final=False):
+        elapsed = time.monotonic() - self.started
+        rows = self.stats['shipment_rows'] + self.stats['procurement_rows']
+        message = (f"{self.stats['imported']} records imported, {self.stats['skipped']} skipped, "
+                   f"{self.stats['failed']} failed, {rows} rows queued, "
+                   f"{rows / elapsed if elapsed else 0.0:.1f} rows/s, {elapsed:.0f}s")
+        print(("done: " if final else "") + message, file=sys.stderr, flush=True)
+
+    def run(self):
+        if self.checkpoint.resumed and not self.args.no_sheet_check:
+            self.load_existing()
+        max_in_flight = self.args.workers * 2
+        in_flight = {}
+        writing = []
+        last_report = time.monotonic()
+        records = read_records(self.args.input)
+        with ThreadPoolExecutor(max_workers=self.args.workers, thread_name_prefix='import') as executor:
+            exhausted = False
+            while not exhausted or in_flight:
+                # Распознавание и разбор идут параллельно, но не больше max_in_flight записей сразу
+                while not exhausted and len(in_flight) < max_in_flight:
+                    record = next(records, None)
+                    if record is None:
+                        exhausted = True
+                    elif record.key in self.checkpoint.done:
+                        self.stats['skipped'] += 1
+                    else:
+                        in_flight[executor.submit(process_record, record)] = record
+                if not in_flight:
+                    continue
+                finished, _ = wait(in_flight, timeout=1.0, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    record = in_flight.pop(future)
+                    try:
+                        writing.append((record, self.enqueue_rows(future.result())))
+                    except Exception as e:
+                        self.fail(record, e)
+                writing = self.collect_written(writing)
+                if time.monotonic() - last_report >= self.args.progress_interval:
+                    self.report()
+                    last_report = time.monotonic()
+        self.writer.close()
+        self.collect_written(writing, block=True)
+        self.checkpoint.close()
+        self.errors.close()
+        self.report(final=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import shipment descriptions or voice files into Google Sheets")
+    parser.add_argument('input', help="JSONL, CSV or text file")
+    parser.add_argument('--workers', type=int, default=4, help="records recognised and parsed in parallel")
+    parser.add_argument('--batch-rows', type=int, default=config.SHEETS_MAX_BATCH_ROWS, help="rows per append request")
+    parser.add_argument('--flush-interval', type=float, default=config.SHEETS_FLUSH_INTERVAL)
+    parser.add_argument('--checkpoint', help="default: <input>.checkpoint")
+    parser.add_argument('--errors', help="failed records, default: <input>.errors.jsonl")
+    parser.add_argument('--progress-interval', type=float, default=5.0)
+    parser.add_argument('--no-sheet-check', action='store_true',
+                        help="on resume, do not read existing shipment ids from the sheets")
+    Importer(parser.parse_args()).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -33,3 +33,122 @@ SHIPMENTS_SHEET_ID=os.environ.get('SHIPMENTS_SHEET_ID')
 PROCUREMENTS_SHEET_ID=os.environ.get('PROCUREMENTS_SHEET_ID')
 GOOGLE_SHEETS_CRED=os.environ.get('GOOGLE_SHEETS_CRED')
 WHISPER_MODEL = os.environ.get('WHISPER_MODEL', default='small')
+
+# Режим работы бота: polling (telebot.infinity_polling), async (параллельная обработка по пользователям), webhook
+# или sharded (несколько процессов, пользователи распределены по ним)
+BOT_RUNTIME_MODE = os.environ.get('BOT_RUNTIME_MODE', default='polling')
+ASYNC_MAX_WORKERS = int(os.environ.get('ASYNC_MAX_WORKERS', default='8'))
+USER_QUEUE_SIZE = int(os.environ.get('USER_QUEUE_SIZE', default='16'))
+MAX_PENDING_UPDATES = int(os.environ.get('MAX_PENDING_UPDATES', default='256'))
+
+# Webhook: публичный адрес (без него webhook не регистрируется), локальный сервер и число воркеров
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST', default='0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', default='8443'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', default='/telegram')
+WEBHOOK_SECRET_TOKEN = os.environ.get('WEBHOOK_SECRET_TOKEN')
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', default='8'))
+
+# Шарды: число процессов (0 - по числу ядер), потоков в каждом, размер очереди шарда, точек шарда на кольце хэшей.
+# Шард, упавший больше SHARD_MAX_RESTARTS раз за SHARD_RESTART_WINDOW секунд, выводится из кольца на это же время.
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', default='0'))
+SHARD_THREADS = int(os.environ.get('SHARD_THREADS', default='4'))
+SHARD_QUEUE_SIZE = int(os.environ.get('SHARD_QUEUE_SIZE', default='256'))
+SHARD_VNODES = int(os.environ.get('SHARD_VNODES', default='64'))
+SHARD_MAX_RESTARTS = int(os.environ.get('SHARD_MAX_RESTARTS', default='5'))
+SHARD_RESTART_WINDOW = float(os.environ.get('SHARD_RESTART_WINDOW', default='300'))
+SHARD_DRAIN_TIMEOUT = float(os.environ.get('SHARD_DRAIN_TIMEOUT', default='30'))
+
+# Исходящие сообщения: общий лимит и лимит на чат (сообщений в секунду), всплеск в чате, число отправляющих потоков
+OUTBOUND_GLOBAL_RATE = float(os.environ.get('OUTBOUND_GLOBAL_RATE', default='25'))
+OUTBOUND_CHAT_RATE = float(os.environ.get('OUTBOUND_CHAT_RATE', default='1'))
+OUTBOUND_CHAT_BURST = float(os.environ.get('OUTBOUND_CHAT_BURST', default='3'))
+OUTBOUND_WORKERS = int(os.environ.get('OUTBOUND_WORKERS', default='4'))
+
+# Отложенная пакетная запись в Google Sheets
+SHEETS_WRITE_BEHIND = os.environ.get('SHEETS_WRITE_BEHIND', default='False').lower() in ('true', '1', 'yes')
+SHEETS_FLUSH_INTERVAL = float(os.environ.get('SHEETS_FLUSH_INTERVAL', default='2.0'))
+SHEETS_MAX_BATCH_ROWS = int(os.environ.get('SHEETS_MAX_BATCH_ROWS', default='200'))
+SHEETS_REQUESTS_PER_MINUTE = int(os.environ.get('SHEETS_REQUESTS_PER_MINUTE', default='60'))
+# Клиент Sheets API: размер общего пула соединений, таймаут запроса и время жизни кэша заголовков листа (секунды)
+SHEETS_HTTP_POOL_SIZE = int(os.environ.get('SHEETS_HTTP_POOL_SIZE', default='10'))
+SHEETS_HTTP_TIMEOUT = float(os.environ.get('SHEETS_HTTP_TIMEOUT', default='60'))
+SHEETS_HEADER_CACHE_TTL = float(os.environ.get('SHEETS_HEADER_CACHE_TTL', default='300'))
+
+# Локальный журнал отгрузок (SQLite), из которого отгрузки переносятся в Google Sheets
+SHIPMENT_JOURNAL_ENABLED = os.environ.get('SHIPMENT_JOURNAL_ENABLED', default='True').lower() in ('true', '1', 'yes')
+SHIPMENT_JOURNAL_PATH = os.environ.get('SHIPMENT_JOURNAL_PATH', default=os.path.join(DATA_ROOT_PATH or '.', 'shipments_journal.sqlite3'))
+JOURNAL_REPLAY_INTERVAL = float(os.environ.get('JOURNAL_REPLAY_INTERVAL', default='5.0'))
+
+# Пул процессов распознавания речи: 0 - распознавание в потоке бота
+WHISPER_WORKERS = int(os.environ.get('WHISPER_WORKERS', default='0'))
+WHISPER_JOB_TIMEOUT = float(os.environ.get('WHISPER_JOB_TIMEOUT', default='300'))
+
+# Движок распознавания речи: whisper (openai-whisper) или faster_whisper (CTranslate2, int8 на CPU)
+ASR_BACKEND = os.environ.get('ASR_BACKEND', default='whisper')
+ASR_MODEL = os.environ.get('ASR_MODEL', default=WHISPER_MODEL)
+# Каталог с моделью: для faster_whisper - сконвертированная модель CTranslate2 (model.bin) или каталог загрузки
+ASR_MODEL_PATH = os.environ.get('ASR_MODEL_PATH', default=WHISPER_MODEL_PATH)
+ASR_COMPUTE_TYPE = os.environ.get('ASR_COMPUTE_TYPE', default='int8')
+ASR_LOCAL_FILES_ONLY = os.environ.get('ASR_LOCAL_FILES_ONLY', default='False').lower() in ('true', '1', 'yes')
+# 0 - по умолчанию: все ядра без пула, ядра поровну между воркерами с пулом
+ASR_CPU_THREADS = int(os.environ.get('ASR_CPU_THREADS', default='0'))
+# 0 - по умолчанию движка (whisper - жадный поиск, faster_whisper - 5)
+ASR_BEAM_SIZE = int(os.environ.get('ASR_BEAM_SIZE', default='0'))
+ASR_LANGUAGE = os.environ.get('ASR_LANGUAGE') or None
+
+# Ограничения на голосовые сообщения
+VOICE_MAX_BYTES = int(os.environ.get('VOICE_MAX_BYTES', default=str(20 * 1024 * 1024)))
+VOICE_MAX_SECONDS = float(os.environ.get('VOICE_MAX_SECONDS', default='900'))
+
+# Длинные голосовые делятся по паузам (энергетический VAD) и распознаются кусками параллельно
+VAD_CHUNKING = os.environ.get('VAD_CHUNKING', default='True').lower() in ('true', '1', 'yes')
+VAD_MIN_AUDIO_SECONDS = float(os.environ.get('VAD_MIN_AUDIO_SECONDS', default='45'))
+# Куски короче секунды Whisper не распознаёт осмысленно
+VAD_MAX_CHUNK_SECONDS = max(1.0, float(os.environ.get('VAD_MAX_CHUNK_SECONDS', default='30')))
+
+# Кэш распознанных голосовых: по file_unique_id и sha256 содержимого, в памяти и в SQLite
+TRANSCRIPT_CACHE_ENABLED = os.environ.get('TRANSCRIPT_CACHE_ENABLED', default='True').lower() in ('true', '1', 'yes')
+TRANSCRIPT_CACHE_PATH = os.environ.get('TRANSCRIPT_CACHE_PATH', default=os.path.join(DATA_ROOT_PATH or '.', 'transcripts.sqlite3'))
+TRANSCRIPT_CACHE_SIZE = int(os.environ.get('TRANSCRIPT_CACHE_SIZE', default='1024'))
+TRANSCRIPT_CACHE_TTL = float(os.environ.get('TRANSCRIPT_CACHE_TTL', default=str(30 * 24 * 3600)))
+
+# Фоновая загрузка модели Whisper, клиентов Google Sheets и LLM сразу после старта
+STARTUP_WARM_UP = os.environ.get('STARTUP_WARM_UP', default='True').lower() in ('true', '1', 'yes')
+
+# Пул ассистентов LLM и кэш результатов разбора
+LLM_ASSISTANT_POOL_SIZE = int(os.environ.get('LLM_ASSISTANT_POOL_SIZE', default='4'))
+LLM_CACHE_SIZE = int(os.environ.get('LLM_CACHE_SIZE', default='1024'))
+LLM_CACHE_TTL = float(os.environ.get('LLM_CACHE_TTL', default='3600'))
+
+# Провайдеры LLM: классы из AIAssistantsLib.assistants через запятую, первый - основной.
+# После имени через двоеточие - лимит одновременных запросов к провайдеру (по умолчанию LLM_ASSISTANT_POOL_SIZE)
+LLM_PROVIDERS = os.environ.get('LLM_PROVIDERS', default='JSONAssistantGPT')
+# Общий срок ответа LLM, секунды
+LLM_TIMEOUT = float(os.environ.get('LLM_TIMEOUT', default='60'))
+# Резервный провайдер спрашивается, если основной не ответил за свой p95 (пока замеров мало - за LLM_HEDGE_DELAY)
+LLM_HEDGING = os.environ.get('LLM_HEDGING', default='True').lower() in ('true', '1', 'yes')
+LLM_HEDGE_DELAY = float(os.environ.get('LLM_HEDGE_DELAY', default='10'))
+LLM_HEDGE_QUANTILE = float(os.environ.get('LLM_HEDGE_QUANTILE', default='0.95'))
+LLM_HEDGE_MIN_SAMPLES = int(os.environ.get('LLM_HEDGE_MIN_SAMPLES', default='20'))
+
+# Разбор отгрузок правилами без LLM
+RULES_FAST_PATH = os.environ.get('RULES_FAST_PATH', default='True').lower() in ('true', '1', 'yes')
+RULES_CONFIDENCE_THRESHOLD = float(os.environ.get('RULES_CONFIDENCE_THRESHOLD', default='0.9'))
+RULES_DICTIONARY_PATH = os.environ.get('RULES_DICTIONARY_PATH')
+
+# Локальная копия листов для /report: каталог и период синхронизации в секундах (0 - выключена)
+SHEETS_MIRROR_PATH = os.environ.get('SHEETS_MIRROR_PATH', default=os.path.join(DATA_ROOT_PATH or '.', 'sheets_mirror'))
+SHEETS_MIRROR_INTERVAL = float(os.environ.get('SHEETS_MIRROR_INTERVAL', default='300'))
+# Период полного перечитывания листов (правки прямо в таблице), 0 - только при старте и после исправлений ботом
+SHEETS_MIRROR_FULL_INTERVAL = float(os.environ.get('SHEETS_MIRROR_FULL_INTERVAL', default='3600'))
+
+# Хранилище сессий пользователей
+SESSION_STORE_PATH = os.environ.get('SESSION_STORE_PATH', default=os.path.join(DATA_ROOT_PATH or '.', 'sessions.sqlite3'))
+SESSION_IDLE_TIMEOUT = float(os.environ.get('SESSION_IDLE_TIMEOUT', default='1800'))
+SESSION_EVICT_INTERVAL = float(os.environ.get('SESSION_EVICT_INTERVAL', default='60'))
+
+# Метрики: HTTP-эндпоинт в формате Prometheus (0 - выключен) и периодический снимок в лог (0 - выключен)
+METRICS_PORT = int(os.environ.get('METRICS_PORT', default='0'))
+METRICS_HOST = os.environ.get('METRICS_HOST', default='127.0.0.1')
+METRICS_LOG_INTERVAL = float(os.environ.get('METRICS_LOG_INTERVAL', default='0'))
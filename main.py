@@ -5,22 +5,78 @@ logger = logging.getLogger(__name__)
 logger.info("Starting bot...")
 
 import telebot
-from telebot import types
+from telebot import types, apihelper
+import atexit
 import uuid
 import json
 import os
+import threading
+import time
+from vrecog import vrecog
 from vrecog.vrecog import recognise_text
-from storage_managers.google_sheets_man import store_shipment
+from vrecog.audio import AudioTooLong
+from vrecog.transcript_cache import TranscriptCache
+from storage_managers import google_sheets_man
+from storage_managers.google_sheets_man import store_shipment, store_shipment_idempotent, apply_shipment_update
+from storage_managers.journal import ShipmentJournal, JournalReplayer
+from storage_managers.session_store import SessionStore
+from storage_managers.sheets_mirror import SheetsMirror, report
+from shipment_parser import parser as shipment_parser
+from shipment_parser.parser import parse_shipment
+from shipment_parser.schema import shipment_fields, procurement_fields
+from monitoring.metrics import STAGE_SECONDS, ERRORS, UPDATES, QUEUE_DEPTH, ACTIVE_SESSIONS
+from runtime.outbound import OutboundScheduler, Priority
 from typing import List, Any, Optional, Dict, Tuple
 
-from AIAssistantsLib.assistants import JSONAssistantGPT
-
 import config
 
 bot = telebot.TeleBot(config.TELEGRAM_BOT_TOKEN)
 
-# Хранилище данных пользователей
-user_data = {}
+# Все ответы пользователям идут через очередь с лимитами Telegram, а не напрямую через bot
+outbound = OutboundScheduler(
+    bot,
+    global_rate=config.OUTBOUND_GLOBAL_RATE,
+    chat_rate=config.OUTBOUND_CHAT_RATE,
+    chat_burst=config.OUTBOUND_CHAT_BURST,
+    workers=config.OUTBOUND_WORKERS
+)
+
+# Хранилище данных пользователей: активные сессии в памяти, незавершённые диалоги - в SQLite
+user_data = SessionStore(config.SESSION_STORE_PATH, idle_timeout=config.SESSION_IDLE_TIMEOUT)
+
+def apply_saved_shipment_update(shipment_id, kind, payload, written_before=None):
+    apply_shipment_update(shipment_id, kind, payload, written_before)
+    if kind == 'fields' and sheets_mirror is not None:
+        # Исправленная строка осталась на месте, новых строк нет: копия для /report перечитает лист целиком
+        sheets_mirror.mark_stale('shipments')
+
+# Подтверждённые отгрузки сначала пишутся в локальный журнал, в Google Sheets их переносит replayer
+shipment_journal = ShipmentJournal(config.SHIPMENT_JOURNAL_PATH) if config.SHIPMENT_JOURNAL_ENABLED else None
+journal_replayer = JournalReplayer(
+    shipment_journal,
+    store_shipment_idempotent,
+    apply_update=apply_saved_shipment_update,
+    interval=config.JOURNAL_REPLAY_INTERVAL
+) if shipment_journal else None
+
+# Распознанный текст голосовых: повторно пересланное голосовое не скачивается и не распознаётся
+transcript_cache = TranscriptCache(
+    config.TRANSCRIPT_CACHE_PATH,
+    maxsize=config.TRANSCRIPT_CACHE_SIZE,
+    ttl=config.TRANSCRIPT_CACHE_TTL or None
+) if config.TRANSCRIPT_CACHE_ENABLED else None
+
+# Локальная копия листов: /report считается по ней, а не по Google Sheets
+sheets_mirror = SheetsMirror(
+    {'shipments': google_sheets_man.shipment_store, 'procurements': google_sheets_man.procurement_store},
+    config.SHEETS_MIRROR_PATH,
+    interval=config.SHEETS_MIRROR_INTERVAL,
+    full_interval=config.SHEETS_MIRROR_FULL_INTERVAL
+) if config.SHEETS_MIRROR_INTERVAL > 0 else None
+
+ACTIVE_SESSIONS.set_function(lambda: user_data.active_count)
+if shipment_journal is not None:
+    QUEUE_DEPTH.labels(queue='journal').set_function(shipment_journal.pending_count)
 
 # Состояния пользователей
 class UserState:
@@ -29,168 +85,266 @@ class UserState:
     CONFIRMING_SHIPMENT = 'confirming_shipment'
     CORRECTING_FIELD = 'correcting_field'
     AWAITING_NEXT_STEP = 'awaiting_next_step'
+    ADDING_PROCUREMENT = 'adding_procurement'
+    CORRECTING_SAVED = 'correcting_saved'
+
+class VoiceTooLarge(Exception):
+    pass
+
+def download_file_capped(file_info, max_bytes):
+    # Скачиваем файл потоком и прерываем загрузку, как только превышен лимит размера
+    if file_info.file_size and file_info.file_size > max_bytes:
+        raise VoiceTooLarge(f"File size {file_info.file_size} exceeds {max_bytes} bytes")
+    file_url = apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}"
+    url = file_url.format(config.TELEGRAM_BOT_TOKEN, file_info.file_path)
+    data = bytearray()
+    with apihelper._get_req_session().get(url, proxies=apihelper.proxy, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            data.extend(chunk)
+            if len(data) > max_bytes:
+                raise VoiceTooLarge(f"File is larger than {max_bytes} bytes")
+    return data
+
+def voice_progress(user_id, status_message, min_interval=2.0, max_length=3500):
+    # Одно сообщение о статусе редактируется по мере распознавания кусков длинной записи
+    last = {'text': None, 'at': 0.0}
+
+    def update(text, done, total):
+        now = time.monotonic()
+        if total <= 1 or not text or text == last['text']:
+            return
+        if done < total and now - last['at'] < min_interval:
+            return
+        shown = text if len(text) <= max_length else '…' + text[-max_length:]
+        outbound.edit_message_text(
+            f"Распознаю голосовое сообщение... ({done}/{total})\n\n{shown}",
+            chat_id=user_id,
+            message_id=status_message.result().message_id,
+            priority=Priority.STATUS
+        )
+        last['text'], last['at'] = text, now
+
+    return update
+
+def warm_up():
+    # Тяжёлые ресурсы загружаются в фоне, бот тем временем уже отвечает на команды
+    steps = (
+        ("whisper", vrecog.warm_up),
+        ("google sheets", google_sheets_man.warm_up),
+        ("llm", shipment_parser.warm_up),
+    )
+    started = time.monotonic()
+    for name, step in steps:
+        step_started = time.monotonic()
+        try:
+            step()
+            logger.info(f"Warm-up of {name} finished in {time.monotonic() - step_started:.1f}s")
+        except Exception as e:
+            logger.error(f"Warm-up of {name} failed: {str(e)}")
+    logger.info(f"Warm-up finished in {time.monotonic() - started:.1f}s")
 
-# Поля для корректировки
-shipment_fields = [
-    "shipment_date",
-    "shipment_time",
-    "customer_name",
-    "customer_address",
-    "good",
-    "good_volume",
-    "good_price",
-    "shipment_count",
-    "shipment_cost",
-    "supplier"
-]
-
-procurement_fields = [
-    "supplier",
-    "good",
-    "good_volume",
-    "good_price",
-    "supply_cost"
-]
-
-def parse_shipment(text):
-    from typing import Optional
-    from pydantic import BaseModel, Field
-
-    class Procurement(BaseModel):
-        supplier: Optional[str] = Field(default=None)
-        good: Optional[str] = Field(default=None)
-        good_volume: Optional[str] = Field(default=None)
-        good_price: Optional[str] = Field(default=None)
-        supply_cost: Optional[str] = Field(default=None)
-
-    class Shipment(BaseModel):
-        shipment_date: Optional[str] = Field(default=None)
-        shipment_time: Optional[str] = Field(default=None)
-        customer_name: Optional[str] = Field(default=None)
-        customer_address: Optional[str] = Field(default=None)
-        good: Optional[str] = Field(default=None)
-        good_volume: Optional[str] = Field(default=None)
-        good_price: Optional[str] = Field(default=None)
-        shipment_count: Optional[str] = Field(default=None)
-        shipment_cost: Optional[str] = Field(default=None)
-        supplier: Optional[str] = Field(default=None)
-        procurements: Optional[List[Procurement]] = Field(default=None)
-
-    class Shipments(BaseModel):
-        shipments: List[Shipment] = Field(description="List of shipments")
-
-    assistant = JSONAssistantGPT(schema=Shipments)
-    result = assistant.ask_question(text)
-    return json.loads(result).get('shipments')
+def start_warm_up():
+    thread = threading.Thread(target=warm_up, name='warm-up', daemon=True)
+    thread.start()
+    return thread
 
 def initialize_user(user_id):
-    if user_id not in user_data:
-        user_data[user_id] = {
-            'state': UserState.IDLE,
-            'shipments': [],
-            'shipment_queue': [],
-            'current_shipment_index': 0,
-            'current_field': None,
-            'procurement': {},
-            'shipment_id': None
-        }
+    return user_data.get(user_id)
 
 @bot.message_handler(commands=['start', 'help'])
 def send_welcome(message):
-    bot.reply_to(message, "Добро пожаловать! Используйте команду /add_shipment для добавления новой отгрузки.")
+    outbound.reply_to(message, "Добро пожаловать! Используйте команду /add_shipment для добавления новой отгрузки.")
 
 @bot.message_handler(commands=['add_shipment'])
 def add_shipment(message):
     user_id = message.from_user.id
     initialize_user(user_id)
-    user_data[user_id]['state'] = UserState.ADDING_SHIPMENT
-    bot.send_message(user_id, "Пожалуйста, отправьте информацию о отгрузке в виде текста или голосового сообщения.")
+    user_data[user_id].state = UserState.ADDING_SHIPMENT
+    user_data.save_user(user_id)
+    outbound.send_message(user_id, "Пожалуйста, отправьте информацию о отгрузке в виде текста или голосового сообщения.")
+
+REPORT_GROUP_NAMES = {
+    'supplier': 'supplier', 'поставщик': 'supplier', 'поставщики': 'supplier',
+    'customer': 'customer', 'клиент': 'customer', 'клиенты': 'customer',
+    'date': 'date', 'дата': 'date', 'дни': 'date',
+}
+REPORT_PERIODS = {
+    'day': 1, 'день': 1, 'сегодня': 1,
+    'week': 7, 'неделя': 7,
+    'month': 30, 'месяц': 30,
+    'all': None, 'всё': None, 'все': None,
+}
+REPORT_TITLES = {'supplier': 'поставщикам', 'customer': 'клиентам', 'date': 'дням'}
+
+def format_amount(value):
+    return f"{value:,.0f}".replace(',', ' ')
+
+def format_volume(value):
+    text = f"{value:,.1f}".replace(',', ' ')
+    return text[:-2] if text.endswith('.0') else text
+
+def report_text(rows, by, days):
+    period = "всё время" if days is None else f"{days} дн."
+    lines = [f"Отчёт по {REPORT_TITLES[by]} за {period}:"]
+    for row in rows:
+        key = row['key']
+        if by == 'date' and key:
+            # 2024-11-07 -> 07-11-2024, как в таблице
+            key = '-'.join(reversed(key.split('-')))
+        line = f"{key or '—'}: {row['shipments']} отгр., объём {format_volume(row['volume'])}, сумма {format_amount(row['amount'])} руб."
+        if row['delivery']:
+            line += f", доставка {format_amount(row['delivery'])} руб."
+        if row['purchased'] or row['supply_cost']:
+            line += f", закуплено {format_volume(row['purchased'])} на {format_amount(row['supply_cost'])} руб."
+        lines.append(line)
+    if sheets_mirror.synced_at:
+        lines.append(f"\nДанные на {time.strftime('%d.%m.%Y %H:%M', time.localtime(sheets_mirror.synced_at))}")
+    return '\n'.join(lines)
+
+@bot.message_handler(commands=['report'])
+def send_report(message):
+    # /report [поставщик|клиент|дата] [день|неделя|месяц|всё|N дней]
+    if sheets_mirror is None:
+        outbound.reply_to(message, "Отчёты отключены.")
+        return
+    by, days = 'supplier', 7
+    for arg in message.text.lower().split()[1:]:
+        if arg in REPORT_GROUP_NAMES:
+            by = REPORT_GROUP_NAMES[arg]
+        elif arg in REPORT_PERIODS:
+            days = REPORT_PERIODS[arg]
+        elif arg.isdigit() and int(arg) > 0:
+            days = int(arg)
+        else:
+            outbound.reply_to(message, "Формат: /report [поставщик|клиент|дата] [день|неделя|месяц|всё|число дней]")
+            return
+    shipments = sheets_mirror.table('shipments')
+    if not len(shipments):
+        outbound.reply_to(message, "Данные отгрузок ещё не загружены, попробуйте позже.")
+        return
+    with STAGE_SECONDS.labels(stage='report').time():
+        rows = report(shipments, sheets_mirror.table('procurements'), by=by, days=days)
+    if not rows:
+        outbound.reply_to(message, "За этот период отгрузок нет.")
+        return
+    outbound.reply_to(message, report_text(rows, by, days))
 
 @bot.message_handler(content_types=['text', 'voice'])
 def handle_message(message):
     user_id = message.from_user.id
     initialize_user(user_id)
-    state = user_data[user_id]['state']
-
-    if state == UserState.ADDING_SHIPMENT:
-        handle_adding_shipment(message, user_id)
-    elif state == UserState.CONFIRMING_SHIPMENT:
-        handle_confirming_shipment(message, user_id)
-    elif state == UserState.CORRECTING_FIELD:
-        handle_correcting_field(message, user_id)
-    elif state == UserState.AWAITING_NEXT_STEP:
-        handle_next_step(message, user_id)
-    else:
-        bot.send_message(user_id, "Для добавления новой отгрузки используйте команду /add_shipment.")
+    state = user_data[user_id].state
+    UPDATES.inc()
+
+    try:
+        if state == UserState.ADDING_SHIPMENT:
+            handle_adding_shipment(message, user_id)
+        elif state == UserState.CONFIRMING_SHIPMENT:
+            handle_confirming_shipment(message, user_id)
+        elif state == UserState.CORRECTING_FIELD:
+            handle_correcting_field(message, user_id)
+        elif state == UserState.AWAITING_NEXT_STEP:
+            handle_next_step(message, user_id)
+        elif state == UserState.ADDING_PROCUREMENT:
+            handle_adding_procurement(message, user_id)
+        elif state == UserState.CORRECTING_SAVED:
+            handle_correcting_saved(message, user_id)
+        else:
+            outbound.send_message(user_id, "Для добавления новой отгрузки используйте команду /add_shipment.")
+    finally:
+        # Состояние сохраняется после каждого сообщения: после перезапуска диалог продолжится с того же места
+        user_data.save_user(user_id)
+
+def recognise_voice(message, user_id):
+    file_unique_id = message.voice.file_unique_id
+    text = transcript_cache.get(file_unique_id=file_unique_id) if transcript_cache else None
+    if text is not None:
+        logger.info(f"Transcript of voice message {file_unique_id} taken from cache")
+        return text
+
+    status = "Распознаю голосовое сообщение..."
+    if not vrecog.is_ready():
+        # Модель ещё грузится в фоне (или загрузится этим запросом) - первое распознавание займёт дольше
+        status += " Модель распознавания ещё загружается, это может занять минуту."
+    status_message = outbound.send_message(user_id, status, priority=Priority.STATUS, merge=True)
+    with STAGE_SECONDS.labels(stage='download').time():
+        file_info = bot.get_file(message.voice.file_id)
+        voice_data = download_file_capped(file_info, config.VOICE_MAX_BYTES)
+    if transcript_cache is not None:
+        # То же содержимое могло прийти под другим file_unique_id
+        text = transcript_cache.get(data=voice_data)
+        if text is not None:
+            # Следующая пересылка этого файла найдётся без скачивания
+            transcript_cache.put(text, file_unique_id=file_unique_id)
+            return text
+
+    # Передаём байты OGG в recognise_text, декодирование идёт в памяти
+    with STAGE_SECONDS.labels(stage='recognise_text').time():
+        text = recognise_text(voice_data, on_progress=voice_progress(user_id, status_message))
+    if transcript_cache is not None:
+        transcript_cache.put(text, file_unique_id=file_unique_id, data=voice_data)
+    return text
 
 def handle_adding_shipment(message, user_id):
     if message.content_type == 'voice':
-        bot.send_message(user_id, "Распознаю голосовое сообщение...")
         try:
-            file_info = bot.get_file(message.voice.file_id)
-            downloaded_file = bot.download_file(file_info.file_path)
-            ogg_file_path = f"voice_{user_id}_{uuid.uuid4()}.ogg"
-            with open(ogg_file_path, 'wb') as f:
-                f.write(downloaded_file)
-            
-            # Передаём путь к OGG-файлу в recognise_text
-            text = recognise_text(ogg_file_path)
-            os.remove(ogg_file_path)
-            
+            text = recognise_voice(message, user_id)
+
             if not text:
-                bot.send_message(user_id, "Не удалось распознать голосовое сообщение. Пожалуйста, отправьте текст вручную или попробуйте снова.")
-                user_data[user_id]['state'] = UserState.IDLE
+                outbound.send_message(user_id, "Не удалось распознать голосовое сообщение. Пожалуйста, отправьте текст вручную или попробуйте снова.")
+                user_data[user_id].state = UserState.IDLE
                 return
             logger.info(f"Распознанный текст:\n{text}")
+        except (VoiceTooLarge, AudioTooLong) as e:
+            logger.warning(f"Voice message from {user_id} rejected: {str(e)}")
+            ERRORS.labels(stage='voice_too_long').inc()
+            outbound.send_message(user_id, "Голосовое сообщение слишком длинное. Пожалуйста, разбейте его на несколько сообщений или отправьте текст.")
+            user_data[user_id].state = UserState.IDLE
+            return
         except Exception as e:
             logger.error(f"Error processing voice message: {str(e)}")
-            bot.send_message(user_id, "Не удалось распознать голосовое сообщение. Пожалуйста, отправьте текст вручную или попробуйте снова.")
-            user_data[user_id]['state'] = UserState.IDLE
+            ERRORS.labels(stage='recognise_text').inc()
+            outbound.send_message(user_id, "Не удалось распознать голосовое сообщение. Пожалуйста, отправьте текст вручную или попробуйте снова.")
+            user_data[user_id].state = UserState.IDLE
             return
     else:
         text = message.text
 
     try:
-        shipments = parse_shipment(text)
+        with STAGE_SECONDS.labels(stage='parse_shipment').time():
+            shipments = parse_shipment(text)
         if not shipments:
-            bot.send_message(user_id, "Не удалось разобрать информацию о отгрузке. Пожалуйста, проверьте формат и попробуйте снова.")
-            user_data[user_id]['state'] = UserState.IDLE
+            outbound.send_message(user_id, "Не удалось разобрать информацию о отгрузке. Пожалуйста, проверьте формат и попробуйте снова.")
+            user_data[user_id].state = UserState.IDLE
             return
-        user_data[user_id]['shipments'] = shipments  # Original list
+        user_data[user_id].shipments = shipments  # Original list
         #user_data[user_id]['shipment_queue'] = shipments.copy()  # Clone for queue processing
-        user_data[user_id]['current_shipment_index'] = 0
-        user_data[user_id]['state'] = UserState.CONFIRMING_SHIPMENT
+        user_data[user_id].current_shipment_index = 0
+        user_data[user_id].state = UserState.CONFIRMING_SHIPMENT
         send_shipment_confirmation(user_id)
     except Exception as e:
         logger.error(f"Error processing shipment: {str(e)}")
-        bot.send_message(user_id, "Не удалось разобрать информацию о отгрузке. Пожалуйста, проверьте формат и попробуйте снова.")
-        user_data[user_id]['state'] = UserState.IDLE
+        ERRORS.labels(stage='parse_shipment').inc()
+        outbound.send_message(user_id, "Не удалось разобрать информацию о отгрузке. Пожалуйста, проверьте формат и попробуйте снова.")
+        user_data[user_id].state = UserState.IDLE
 
-def send_shipment_confirmation(user_id):
-    queue = user_data[user_id]['shipments']
-    index = user_data[user_id]['current_shipment_index']
-    
-    if index >= len(queue):
-        bot.send_message(user_id, "Все отгрузки обработаны.")
-        user_data[user_id]['state'] = UserState.IDLE
-        return
-    
-    current_shipment = queue[index]
-    user_data[user_id]['shipment'] = current_shipment  # Set current shipment for processing
+CARD_CALLBACK_PREFIX = 'ship'
 
+def shipment_card_text(shipment):
     confirmation_text = "Пожалуйста, подтвердите информацию об отгрузке:\n\n"
-    confirmation_text += f"Дата отгрузки: {current_shipment.get('shipment_date', '')}\n"
-    confirmation_text += f"Время отгрузки: {current_shipment.get('shipment_time', '')}\n"
-    confirmation_text += f"Наименование грузополучателя: {current_shipment.get('customer_name', '')}\n"
-    confirmation_text += f"Адрес грузополучателя: {current_shipment.get('customer_address', '')}\n"
-    confirmation_text += f"Наименование товара: {current_shipment.get('good', '')}\n"
-    confirmation_text += f"Объём/количество товара: {current_shipment.get('good_volume', '')}\n"
-    confirmation_text += f"Цена товара: {current_shipment.get('good_price', '')}\n"
-    confirmation_text += f"Количество отгрузок: {current_shipment.get('shipment_count', '')}\n"
-    confirmation_text += f"Стоимость отгрузки: {current_shipment.get('shipment_cost', '')}\n"
-    confirmation_text += f"Наименование поставщика: {current_shipment.get('supplier', '')}\n"
-    
-    procurements = current_shipment.get('procurements', [])
+    confirmation_text += f"Дата отгрузки: {shipment.get('shipment_date', '')}\n"
+    confirmation_text += f"Время отгрузки: {shipment.get('shipment_time', '')}\n"
+    confirmation_text += f"Наименование грузополучателя: {shipment.get('customer_name', '')}\n"
+    confirmation_text += f"Адрес грузополучателя: {shipment.get('customer_address', '')}\n"
+    confirmation_text += f"Наименование товара: {shipment.get('good', '')}\n"
+    confirmation_text += f"Объём/количество товара: {shipment.get('good_volume', '')}\n"
+    confirmation_text += f"Цена товара: {shipment.get('good_price', '')}\n"
+    confirmation_text += f"Количество отгрузок: {shipment.get('shipment_count', '')}\n"
+    confirmation_text += f"Стоимость отгрузки: {shipment.get('shipment_cost', '')}\n"
+    confirmation_text += f"Наименование поставщика: {shipment.get('supplier', '')}\n"
+
+    procurements = shipment.get('procurements', [])
     procurements = [] if procurements is None else procurements
     for procurement in procurements:
         confirmation_text += '--------------------------\n'
@@ -200,96 +354,275 @@ def send_shipment_confirmation(user_id):
         confirmation_text += f"\tОбъём/количество товара: {procurement.get('good_volume', '')}\n"
         confirmation_text += f"\tЦена товара: {procurement.get('good_price', '')}\n"
         confirmation_text += f"\tСтоимость поставки: {procurement.get('supply_cost', '')}\n"
-    confirmation_text += '===============================\n'
+    confirmation_text += '==============================='
+    return confirmation_text
+
+def card_callback(action, index, field=None):
+    return ':'.join(str(part) for part in (CARD_CALLBACK_PREFIX, action, index, field) if part is not None)
+
+def confirmation_markup(index):
+    markup = types.InlineKeyboardMarkup()
+    markup.row(
+        types.InlineKeyboardButton('Сохранить', callback_data=card_callback('save', index)),
+        types.InlineKeyboardButton('Исправить', callback_data=card_callback('correct', index))
+    )
+    return markup
+
+def fields_markup(index):
+    markup = types.InlineKeyboardMarkup(row_width=2)
+    markup.add(*[
+        types.InlineKeyboardButton(translate_field(field), callback_data=card_callback('field', index, field))
+        for field in shipment_fields
+    ])
+    markup.row(types.InlineKeyboardButton('Назад', callback_data=card_callback('back', index)))
+    return markup
+
+def show_shipment_card(user_id, footer='', markup=None):
+    # Карточка отгрузки - одно сообщение: подтверждение и исправления редактируют его, а не присылают новое
+    session = user_data[user_id]
+    text = shipment_card_text(session.shipment)
+    if footer:
+        text += f"\n\n{footer}"
+    if session.card_message_id is not None:
+        try:
+            outbound.edit_message_text(text, chat_id=user_id, message_id=session.card_message_id,
+                                       reply_markup=markup, priority=Priority.CONFIRMATION).result()
+            return
+        except apihelper.ApiTelegramException as e:
+            if 'message is not modified' in str(e):
+                return
+            # Сообщение удалено или слишком старое для редактирования - присылаем карточку заново
+            logger.warning(f"Cannot edit shipment card for user {user_id}: {str(e)}")
+    message = outbound.send_message(user_id, text, reply_markup=markup, priority=Priority.CONFIRMATION).result()
+    session.card_message_id = message.message_id
 
-    markup = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
-    markup.add('Сохранить', 'Исправить')
-    bot.send_message(user_id, confirmation_text, reply_markup=markup)
+def send_shipment_confirmation(user_id):
+    queue = user_data[user_id].shipments
+    index = user_data[user_id].current_shipment_index
+    
+    if index >= len(queue):
+        outbound.send_message(user_id, "Все отгрузки обработаны.")
+        user_data[user_id].state = UserState.IDLE
+        return
+    
+    user_data[user_id].shipment_index = index  # Set current shipment for processing
+    # Для каждой отгрузки - своя карточка
+    user_data[user_id].card_message_id = None
+    show_shipment_card(user_id, markup=confirmation_markup(index))
+
+def save_current_shipment(user_id):
+    shipment = user_data[user_id].shipment
+    shipment_id = str(uuid.uuid4())
+    shipment['shipment_id'] = shipment_id
+    try:
+        if shipment_journal is not None:
+            with STAGE_SECONDS.labels(stage='journal_record').time():
+                shipment_journal.record(shipment)
+            journal_replayer.wake()
+        else:
+            with STAGE_SECONDS.labels(stage='store_shipment').time():
+                # При SHEETS_WRITE_BEHIND без журнала ждём, пока строки попадут в таблицу:
+                # иначе ошибка фоновой записи потеряется, а пользователь увидит, что отгрузка сохранена
+                for future in store_shipment(json.dumps(shipment)) or []:
+                    future.result()
+    except Exception as e:
+        logger.error(f"Error storing shipment: {str(e)}")
+        ERRORS.labels(stage='store_shipment').inc()
+        outbound.send_message(user_id, "Не удалось сохранить отгрузку. Пожалуйста, попробуйте ещё раз.")
+        user_data[user_id].state = UserState.IDLE
+        return
+    # Закупки и исправления после сохранения адресуются строке отгрузки по этому ID
+    user_data[user_id].shipment_id = shipment_id
+    # Отгрузка уже записана: ошибка карточки не должна сбрасывать диалог,
+    # иначе повторное сохранение запишет её второй раз
+    try:
+        show_shipment_card(user_id, footer=f"Отгрузка сохранена с ID: {shipment_id}")
+    except Exception as e:
+        logger.error(f"Error showing saved shipment card: {str(e)}")
+        outbound.send_message(user_id, f"Отгрузка сохранена с ID: {shipment_id}")
+    # Move to the next shipment
+    user_data[user_id].current_shipment_index += 1
+    if user_data[user_id].current_shipment_index < len(user_data[user_id].shipments):
+        user_data[user_id].state = UserState.CONFIRMING_SHIPMENT
+        send_shipment_confirmation(user_id)
+    else:
+        offer_next_steps(user_id)
+        user_data[user_id].state = UserState.AWAITING_NEXT_STEP
+
+def start_correction(user_id):
+    user_data[user_id].current_field = None
+    user_data[user_id].state = UserState.CORRECTING_FIELD
+    show_shipment_card(user_id, footer="Какое поле вы хотите исправить?",
+                       markup=fields_markup(user_data[user_id].shipment_index))
+
+def choose_field(user_id, field):
+    user_data[user_id].current_field = field
+    user_data[user_id].state = UserState.CORRECTING_FIELD
+    back = types.InlineKeyboardMarkup()
+    back.row(types.InlineKeyboardButton('Назад', callback_data=card_callback('correct', user_data[user_id].shipment_index)))
+    show_shipment_card(user_id, footer=f"Введите новое значение для '{translate_field(field)}':", markup=back)
+
+def cancel_correction(user_id):
+    user_data[user_id].current_field = None
+    user_data[user_id].state = UserState.CONFIRMING_SHIPMENT
+    show_shipment_card(user_id, markup=confirmation_markup(user_data[user_id].shipment_index))
+
+@bot.callback_query_handler(func=lambda call: call.data and call.data.startswith(CARD_CALLBACK_PREFIX + ':'))
+def handle_shipment_card(call):
+    user_id = call.from_user.id
+    initialize_user(user_id)
+    session = user_data[user_id]
+    _, action, index, *rest = call.data.split(':')
+    try:
+        # Кнопки старой карточки (уже сохранённой отгрузки или прошлого диалога) не действуют
+        stale = (
+            session.state not in (UserState.CONFIRMING_SHIPMENT, UserState.CORRECTING_FIELD)
+            or session.shipment_index != int(index)
+            or session.card_message_id != call.message.message_id
+        )
+        if stale:
+            outbound.answer_callback_query(user_id, call.id, "Эта карточка уже неактуальна.")
+            return
+        outbound.answer_callback_query(user_id, call.id)
+        if action == 'save':
+            save_current_shipment(user_id)
+        elif action == 'correct':
+            start_correction(user_id)
+        elif action == 'field' and rest and rest[0] in shipment_fields:
+            choose_field(user_id, rest[0])
+        elif action == 'back':
+            cancel_correction(user_id)
+    finally:
+        user_data.save_user(user_id)
 
 def handle_confirming_shipment(message, user_id):
+    # Текстовый ответ вместо кнопок карточки тоже принимается
     response = message.text.strip().lower()
-    if response == 'да':
-        shipment = user_data[user_id]['shipment']
-        shipment_id = str(uuid.uuid4())
-        shipment['shipment_id'] = shipment_id
-        try:
-            store_shipment(json.dumps(shipment))
-            bot.send_message(user_id, f"Отгрузка сохранена с ID: {shipment_id}")
-            # Move to the next shipment
-            user_data[user_id]['current_shipment_index'] += 1
-            if user_data[user_id]['current_shipment_index'] < len(user_data[user_id]['shipments']):
-                send_shipment_confirmation(user_id)
-            else:
-                offer_next_steps(user_id)
-                user_data[user_id]['state'] = UserState.AWAITING_NEXT_STEP
-        except Exception as e:
-            logger.error(f"Error storing shipment: {str(e)}")
-            bot.send_message(user_id, "Не удалось сохранить отгрузку. Пожалуйста, попробуйте ещё раз.")
-            user_data[user_id]['state'] = UserState.IDLE
-    elif response == 'нет':
-        markup = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
-        for field in shipment_fields:
-            markup.add(translate_field(field))
-        bot.send_message(user_id, "Какое поле вы хотите исправить?", reply_markup=markup)
-        user_data[user_id]['state'] = UserState.CORRECTING_FIELD
+    if response in ('да', 'сохранить'):
+        save_current_shipment(user_id)
+    elif response in ('нет', 'исправить'):
+        start_correction(user_id)
     else:
-        bot.send_message(user_id, "Пожалуйста, выберите 'Да' или 'Нет'.")
+        outbound.send_message(user_id, "Пожалуйста, нажмите 'Сохранить' или 'Исправить' под карточкой отгрузки.")
 
 def handle_correcting_field(message, user_id):
+    # Поле уже выбрано - это сообщение содержит новое значение
+    if user_data[user_id].current_field:
+        process_field_correction(message, user_id)
+        return
     field = translate_field_to_key(message.text)
     if field and field in shipment_fields:
-        user_data[user_id]['current_field'] = field
-        bot.send_message(user_id, f"Введите новое значение для '{translate_field(field)}':")
-        # Register the next step handler
-        bot.register_next_step_handler(message, process_field_correction, user_id)
+        choose_field(user_id, field)
     else:
-        bot.send_message(user_id, "Некорректное поле. Пожалуйста, выберите из предложенных вариантов.")
+        outbound.send_message(user_id, "Некорректное поле. Пожалуйста, выберите поле кнопкой под карточкой отгрузки.")
 
 def process_field_correction(message, user_id):
-    field = user_data[user_id]['current_field']
+    field = user_data[user_id].current_field
     new_value = message.text
-    user_data[user_id]['shipment'][field] = new_value
-    bot.send_message(user_id, f"Поле '{translate_field(field)}' обновлено на '{new_value}'.")
-    user_data[user_id]['state'] = UserState.CONFIRMING_SHIPMENT
-    send_shipment_confirmation(user_id)
+    user_data[user_id].shipment[field] = new_value
+    user_data[user_id].current_field = None
+    user_data[user_id].state = UserState.CONFIRMING_SHIPMENT
+    show_shipment_card(user_id, footer=f"Поле '{translate_field(field)}' обновлено на '{new_value}'.",
+                       markup=confirmation_markup(user_data[user_id].shipment_index))
 
 def offer_next_steps(user_id):
     markup = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True)
     markup.add("Добавить новую отгрузку")
-    bot.send_message(user_id, "Что вы хотите сделать дальше?", reply_markup=markup)
+    if user_data[user_id].shipment_id:
+        # Закупка и исправление относятся к последней сохранённой отгрузке
+        markup.add("Добавить закупку", "Исправить сохранённую отгрузку")
+    outbound.send_message(user_id, "Что вы хотите сделать дальше?", reply_markup=markup)
 
 def handle_next_step(message, user_id):
-    response = message.text.strip()
+    response = (message.text or '').strip()
     if response == "Добавить новую отгрузку":
         add_shipment(message)
+    elif response == "Добавить закупку" and user_data[user_id].shipment_id:
+        start_adding_procurement(user_id)
+    elif response == "Исправить сохранённую отгрузку" and user_data[user_id].shipment_id:
+        start_saved_correction(user_id)
     else:
-        bot.send_message(user_id, "Пожалуйста, выберите один из предложенных вариантов.")
+        outbound.send_message(user_id, "Пожалуйста, выберите один из предложенных вариантов.")
+
+def start_adding_procurement(user_id):
+    user_data[user_id].procurement = {}
+    user_data[user_id].current_field = procurement_fields[0]
+    user_data[user_id].state = UserState.ADDING_PROCUREMENT
+    outbound.send_message(user_id, f"Пожалуйста, введите '{translate_field(procurement_fields[0])}':",
+                          reply_markup=types.ReplyKeyboardRemove())
 
 def handle_adding_procurement(message, user_id):
-    field = user_data[user_id]['current_field']
-    user_data[user_id]['procurement'][field] = message.text
+    if not message.text:
+        outbound.send_message(user_id, "Пожалуйста, отправьте значение текстом.")
+        return
+    field = user_data[user_id].current_field
+    user_data[user_id].procurement[field] = message.text
     if next_field := get_next_field(procurement_fields, field):
-        user_data[user_id]['current_field'] = next_field
-        bot.send_message(user_id, f"Пожалуйста, введите '{translate_field(next_field)}':")
+        user_data[user_id].current_field = next_field
+        outbound.send_message(user_id, f"Пожалуйста, введите '{translate_field(next_field)}':")
     else:
         # Все поля закупки введены
-        procurement = user_data[user_id]['procurement']
-        add_procurement_to_shipment(user_data[user_id]['shipment_id'], procurement, user_id)
-        bot.send_message(user_id, "Закупка успешно добавлена.")
-        user_data[user_id]['procurement'] = {}
+        procurement = user_data[user_id].procurement
+        if add_procurement_to_shipment(user_data[user_id].shipment_id, procurement, user_id):
+            outbound.send_message(user_id, "Закупка успешно добавлена.")
+        user_data[user_id].procurement = {}
+        user_data[user_id].current_field = None
         offer_next_steps(user_id)
-        user_data[user_id]['state'] = UserState.AWAITING_NEXT_STEP
+        user_data[user_id].state = UserState.AWAITING_NEXT_STEP
 
 def add_procurement_to_shipment(shipment_id, procurement, user_id):
+    if store_shipment_update(shipment_id, 'procurement', procurement):
+        return True
+    outbound.send_message(user_id, "К сожалению, не могу добавить закупку. Пожалуйста, попробуйте ещё раз.")
+    return False
+
+def start_saved_correction(user_id):
+    user_data[user_id].current_field = None
+    user_data[user_id].state = UserState.CORRECTING_SAVED
+    markup = types.ReplyKeyboardMarkup(one_time_keyboard=True, resize_keyboard=True, row_width=2)
+    markup.add(*[translate_field(field) for field in shipment_fields])
+    outbound.send_message(user_id, "Какое поле вы хотите исправить?", reply_markup=markup)
+
+def handle_correcting_saved(message, user_id):
+    session = user_data[user_id]
+    if not session.current_field:
+        field = translate_field_to_key(message.text)
+        if field not in shipment_fields:
+            outbound.send_message(user_id, "Некорректное поле. Пожалуйста, выберите поле из списка.")
+            return
+        session.current_field = field
+        outbound.send_message(user_id, f"Введите новое значение для '{translate_field(field)}':",
+                              reply_markup=types.ReplyKeyboardRemove())
+        return
+    if not message.text:
+        outbound.send_message(user_id, "Пожалуйста, отправьте значение текстом.")
+        return
+    field, new_value = session.current_field, message.text
+    session.current_field = None
+    # В таблице переписываются только ячейки этого поля в строке отгрузки
+    if store_shipment_update(session.shipment_id, 'fields', {field: new_value}):
+        outbound.send_message(user_id, f"Поле '{translate_field(field)}' обновлено на '{new_value}'.")
+    else:
+        outbound.send_message(user_id, "Не удалось исправить отгрузку. Пожалуйста, попробуйте ещё раз.")
+    offer_next_steps(user_id)
+    session.state = UserState.AWAITING_NEXT_STEP
+
+def store_shipment_update(shipment_id, kind, payload):
+    # Изменения сохранённой отгрузки идут тем же путём, что и сама отгрузка: при включённом журнале
+    # их переносит replayer, и только после того, как строка отгрузки записана
     try:
-        shipment = user_data[user_id]['shipment']
-        if 'procurements' not in shipment:
-            shipment['procurements'] = []
-        shipment['procurements'].append(procurement)
-        store_shipment(shipment)
+        if shipment_journal is not None:
+            with STAGE_SECONDS.labels(stage='journal_record').time():
+                shipment_journal.record_update(shipment_id, kind, payload)
+            journal_replayer.wake()
+        else:
+            with STAGE_SECONDS.labels(stage='store_update').time():
+                apply_saved_shipment_update(shipment_id, kind, payload)
+        return True
     except Exception as e:
-        logger.error(f"Error adding procurement to shipment: {str(e)}")
-        bot.send_message(user_id, "К сожалению, не могу добавить закупку. Пожалуйста, попробуйте ещё раз.")
+        logger.error(f"Error storing {kind} update of shipment {shipment_id}: {str(e)}")
+        ERRORS.labels(stage='store_update').inc()
+        return False
 
 def translate_field(field_key):
     translations = {
@@ -303,6 +636,7 @@ def translate_field(field_key):
         "shipment_count": "Количество отгрузок",
         "shipment_cost": "Стоимость отгрузки",
         "supplier": "Наименование поставщика",
+        "supply_cost": "Стоимость поставки",
         "procurement": "Закупка",
         "id": "ID"
     }
@@ -320,6 +654,7 @@ def translate_field_to_key(field_name):
         "Количество отгрузок": "shipment_count",
         "Стоимость отгрузки": "shipment_cost",
         "Наименование поставщика": "supplier",
+        "Стоимость поставки": "supply_cost",
         "Закупка": "procurement",
         "ID": "id"
     }
@@ -332,7 +667,68 @@ def get_next_field(fields, current_field):
     except (ValueError, IndexError):
         return None
 
-if __name__ == '__main__':
+def start_primary():
+    # Перенос журнала и синхронизация копии листов - в одном процессе на весь бот,
+    # остальные шарды только перечитывают копию с диска. Может вызываться в уже работающем шарде.
+    if journal_replayer is not None:
+        journal_replayer.start()
+    if sheets_mirror is not None:
+        sheets_mirror.start(follow=False)
+
+def start_background(primary=True):
     os.environ["LANGCHAIN_TRACING_V2"] = "true"
+    if config.STARTUP_WARM_UP:
+        start_warm_up()
+    user_data.start_evictor(config.SESSION_EVICT_INTERVAL)
+    if primary:
+        start_primary()
+    elif sheets_mirror is not None:
+        sheets_mirror.start(follow=True)
+    atexit.register(stop_background)
+    if config.METRICS_PORT:
+        from monitoring.exporter import start_http_server
+        start_http_server(config.METRICS_PORT, host=config.METRICS_HOST)
+    if config.METRICS_LOG_INTERVAL > 0:
+        from monitoring.exporter import start_summary_logger
+        start_summary_logger(config.METRICS_LOG_INTERVAL)
+
+def stop_background(timeout=10):
+    # Дописывает журнал, буфер Google Sheets и исходящие сообщения. Шард вызывает её сам:
+    # дочерний процесс multiprocessing завершается через os._exit и atexit не выполняет
+    if journal_replayer is not None:
+        journal_replayer.stop(timeout)
+    if sheets_mirror is not None:
+        sheets_mirror.stop(timeout)
+    google_sheets_man.close_batch_writer()
+    outbound.close(timeout)
+
+
+if __name__ == '__main__':
+    if config.BOT_RUNTIME_MODE == 'sharded':
+        # Супервизор сам обновления не обрабатывает: этот процесс заменяется его точкой входа
+        import sys
+        os.execv(sys.executable, [sys.executable, '-m', 'runtime.sharding'])
+    start_background()
     logger.info("Bot started...")
-    bot.infinity_polling()
+    if config.BOT_RUNTIME_MODE == 'async':
+        from runtime.async_runtime import run_async_polling
+        run_async_polling(
+            bot,
+            max_workers=config.ASYNC_MAX_WORKERS,
+            max_queue_size=config.USER_QUEUE_SIZE,
+            max_pending=config.MAX_PENDING_UPDATES
+        )
+    elif config.BOT_RUNTIME_MODE == 'webhook':
+        from runtime.webhook import run_webhook
+        run_webhook(
+            bot,
+            config.WEBHOOK_URL,
+            host=config.WEBHOOK_HOST,
+            port=config.WEBHOOK_PORT,
+            path=config.WEBHOOK_PATH,
+            secret_token=config.WEBHOOK_SECRET_TOKEN,
+            workers=config.WEBHOOK_WORKERS,
+            queue_size=config.MAX_PENDING_UPDATES
+        )
+    else:
+        bot.infinity_polling()
@@ -0,0 +1,54 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from monitoring.metrics import REGISTRY
+
+import logging
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def make_handler(registry):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] not in ('/metrics', '/'):
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Prometheus опрашивает часто, access log не нужен
+            pass
+
+    return MetricsHandler
+
+
+def start_http_server(port, host='127.0.0.1', registry=REGISTRY) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), make_handler(registry))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True)
+    thread.start()
+    logger.info(f"Metrics endpoint listening on http://{host}:{server.server_port}/metrics")
+    return server
+
+
+def start_summary_logger(interval, registry=REGISTRY) -> threading.Event:
+    # Периодически пишет снимок метрик в лог одной строкой JSON
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.wait(interval):
+            try:
+                logger.info(f"metrics {json.dumps(registry.summary(), ensure_ascii=False)}")
+            except Exception as e:
+                logger.error(f"Error dumping metrics: {str(e)}")
+
+    threading.Thread(target=run, name='metrics-log', daemon=True).start()
+    return stopped
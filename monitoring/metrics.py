@@ -0,0 +1,317 @@
+import threading
+import time
+from bisect import bisect_left
+from functools import wraps
+from typing import Callable, Dict, List, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def metrics(self):
+        with self._lock:
+            return list(self._metrics)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for metric in self.metrics():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> dict:
+        result = {}
+        for metric in self.metrics():
+            for labels, child in metric.children():
+                key = metric.name + _format_labels(labels)
+                result[key] = child.summary()
+        return result
+
+
+REGISTRY = Registry()
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + '}'
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Timer:
+    # Работает и как контекстный менеджер, и как декоратор
+    def __init__(self, observe: Callable[[float], None]):
+        self._observe = observe
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._observe(time.perf_counter() - self._started)
+        return False
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._observe(time.perf_counter() - started)
+        return wrapper
+
+
+class _CounterChild:
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.0):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+    def samples(self):
+        return [('', self._value)]
+
+    def summary(self):
+        return self._value
+
+
+class _GaugeChild:
+    def __init__(self):
+        self._value = 0.0
+        self._function = None
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self._value = float(value)
+
+    def inc(self, amount=1.0):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount=1.0):
+        self.inc(-amount)
+
+    def set_function(self, function: Callable[[], float]):
+        # Значение считывается при каждом экспорте, например глубина очереди
+        self._function = function
+
+    @property
+    def value(self) -> float:
+        if self._function is not None:
+            try:
+                return float(self._function())
+            except Exception:
+                return float('nan')
+        return self._value
+
+    def samples(self):
+        return [('', self.value)]
+
+    def summary(self):
+        return self.value
+
+
+class _HistogramChild:
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    def time(self) -> _Timer:
+        return _Timer(self.observe)
+
+    def _snapshot(self):
+        with self._lock:
+            return list(self._counts), self._sum, self._count
+
+    def samples(self):
+        counts, total, count = self._snapshot()
+        result = []
+        cumulative = 0
+        for bound, bucket_count in zip(self._buckets, counts):
+            cumulative += bucket_count
+            result.append(('_bucket', cumulative, {'le': _format_value(float(bound))}))
+        result.append(('_bucket', count, {'le': '+Inf'}))
+        result.append(('_sum', total, None))
+        result.append(('_count', count, None))
+        return result
+
+    def quantile(self, q) -> float:
+        # Оценка по границам корзин: верхняя граница корзины, в которую попадает квантиль
+        counts, _, count = self._snapshot()
+        if not count:
+            return 0.0
+        rank = q * count
+        cumulative = 0
+        for bound, bucket_count in zip(self._buckets, counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def summary(self):
+        _, total, count = self._snapshot()
+        return {
+            'count': count,
+            'sum': round(total, 6),
+            'avg': round(total / count, 6) if count else 0.0,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+        }
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name, documentation, labelnames: Tuple[str, ...] = (), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[tuple, object] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+        registry.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    child = self._new_child()
+                    self._children[key] = child
+        return child
+
+    def children(self) -> List[Tuple[Dict[str, str], object]]:
+        with self._lock:
+            items = list(self._children.items())
+        return [(dict(zip(self.labelnames, key)), child) for key, child in items]
+
+    def samples(self):
+        result = []
+        for labels, child in self.children():
+            for sample in child.samples():
+                if len(sample) == 3:
+                    suffix, value, extra = sample
+                    sample_labels = dict(labels, **extra) if extra else labels
+                else:
+                    suffix, value = sample
+                    sample_labels = labels
+                result.append((suffix, sample_labels, value))
+        return result
+
+    @property
+    def _default(self):
+        return self._children[()]
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1.0):
+        self._default.inc(amount)
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def set_function(self, function):
+        self._default.set_function(function)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self) -> _Timer:
+        return self._default.time()
+
+
+# Метрики бота
+STAGE_SECONDS = Histogram(
+    'shipment_bot_stage_seconds', "Duration of processing stages", ('stage',)
+)
+ERRORS = Counter(
+    'shipment_bot_errors_total', "Errors by processing stage", ('stage',)
+)
+RETRIES = Counter(
+    'shipment_bot_retries_total', "Retried remote operations", ('operation',)
+)
+UPDATES = Counter(
+    'shipment_bot_updates_total', "Processed Telegram updates"
+)
+QUEUE_DEPTH = Gauge(
+    'shipment_bot_queue_depth', "Items waiting in internal queues", ('queue',)
+)
+ACTIVE_SESSIONS = Gauge(
+    'shipment_bot_active_sessions', "User sessions held in memory"
+)
+CACHE_LOOKUPS = Counter(
+    'shipment_bot_cache_lookups_total', "Cache lookups by cache and result", ('cache', 'result')
+)
+RULES_PARSES = Counter(
+    'shipment_bot_rules_parses_total', "Messages tried by the rules parser by result", ('result',)
+)
+LLM_SECONDS = Histogram(
+    'shipment_bot_llm_seconds', "LLM call latency by provider", ('provider',)
+)
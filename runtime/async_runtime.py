@@ -0,0 +1,130 @@
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from monitoring.metrics import QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+# Типы событий Telegram, у которых есть from_user
+USER_EVENT_ATTRS = (
+    'message',
+    'edited_message',
+    'callback_query',
+    'inline_query',
+    'chosen_inline_result',
+    'shipping_query',
+    'pre_checkout_query',
+)
+
+
+def update_user_id(update) -> Optional[int]:
+    for attr in USER_EVENT_ATTRS:
+        event = getattr(update, attr, None)
+        if event is not None and getattr(event, 'from_user', None) is not None:
+            return event.from_user.id
+    return None
+
+
+# Обновления разных пользователей обрабатываются параллельно, обновления одного пользователя - строго по порядку.
+# У каждого пользователя ограниченная очередь: при переполнении поллер ждёт, а не копит работу в памяти.
+class UserUpdateDispatcher:
+    def __init__(self, process_update: Callable[[Any], None], max_workers=8, max_queue_size=16, max_pending=256):
+        self.process_update = process_update
+        self.max_queue_size = max_queue_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='user-worker')
+        self._queues: Dict[Any, asyncio.Queue] = {}
+        self._workers: Dict[Any, asyncio.Task] = {}
+        self._pending = asyncio.Semaphore(max_pending)
+
+    @property
+    def active_users(self) -> int:
+        return len(self._workers)
+
+    def queue_depth(self, user_id=None) -> int:
+        if user_id is not None:
+            queue = self._queues.get(user_id)
+            return queue.qsize() if queue else 0
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    async def submit(self, user_id, update):
+        # Ждём, пока освободится место: сначала в общем лимите, затем в очереди пользователя.
+        # Пока мы ждём, поллер не забирает новые обновления у Telegram.
+        await self._pending.acquire()
+        queue = self._queues.get(user_id)
+        if queue is None:
+            queue = asyncio.Queue(maxsize=self.max_queue_size)
+            self._queues[user_id] = queue
+        if queue.full():
+            logger.warning(f"Update queue for user {user_id} is full, waiting")
+        await queue.put(update)
+        if user_id not in self._workers:
+            self._workers[user_id] = asyncio.create_task(self._run_worker(user_id, queue))
+
+    async def _run_worker(self, user_id, queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        try:
+            while not queue.empty():
+                update = queue.get_nowait()
+                try:
+                    await loop.run_in_executor(self.executor, self.process_update, update)
+                except Exception as e:
+                    logger.error(f"Error processing update for user {user_id}: {str(e)}")
+                finally:
+                    queue.task_done()
+                    self._pending.release()
+        finally:
+            # Воркер завершается, когда очередь пуста: память не растёт с числом пользователей
+            self._workers.pop(user_id, None)
+            if self._queues.get(user_id) is queue and queue.empty():
+                self._queues.pop(user_id, None)
+
+    async def drain(self):
+        while self._workers:
+            await asyncio.gather(*list(self._workers.values()), return_exceptions=True)
+        self.executor.shutdown(wait=True)
+
+
+async def poll_updates(bot, dispatcher: UserUpdateDispatcher, timeout=20, limit=100):
+    loop = asyncio.get_running_loop()
+    offset = None
+    while True:
+        try:
+            updates = await loop.run_in_executor(
+                None,
+                functools.partial(bot.get_updates, offset=offset, limit=limit, timeout=timeout, long_polling_timeout=timeout)
+            )
+        except Exception as e:
+            logger.error(f"Error getting updates: {str(e)}")
+            await asyncio.sleep(3)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            await dispatcher.submit(update_user_id(update), update)
+
+
+async def _run(bot, max_workers, max_queue_size, max_pending):
+    dispatcher = UserUpdateDispatcher(
+        lambda update: bot.process_new_updates([update]),
+        max_workers=max_workers,
+        max_queue_size=max_queue_size,
+        max_pending=max_pending
+    )
+    QUEUE_DEPTH.labels(queue='updates').set_function(dispatcher.queue_depth)
+    QUEUE_DEPTH.labels(queue='active_users').set_function(lambda: dispatcher.active_users)
+    try:
+        await poll_updates(bot, dispatcher)
+    finally:
+        await dispatcher.drain()
+
+
+def run_async_polling(bot, max_workers=8, max_queue_size=16, max_pending=256):
+    # Обработчики выполняются прямо в потоке воркера пользователя, а не в пуле telebot,
+    # иначе порядок сообщений одного пользователя не гарантируется
+    bot.threaded = False
+    try:
+        asyncio.run(_run(bot, max_workers, max_queue_size, max_pending))
+    except KeyboardInterrupt:
+        logger.info("Bot stopped")
@@ -0,0 +1,247 @@
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Deque, Dict, List
+
+import requests
+from telebot import apihelper
+
+from utils.rate_limit import TokenBucket
+from monitoring.metrics import STAGE_SECONDS, ERRORS, RETRIES, QUEUE_DEPTH
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class Priority:
+    CONFIRMATION = 0
+    NORMAL = 1
+    STATUS = 2
+
+
+class OutboundJob:
+    __slots__ = ('method', 'args', 'kwargs', 'priority', 'merge', 'paced', 'futures', 'attempts')
+
+    def __init__(self, method, args, kwargs, priority, merge=None, paced=True):
+        self.method = method
+        self.args = list(args)
+        self.kwargs = kwargs
+        self.priority = priority
+        # Ключ слияния: ('status',) - дописать текст, ('edit', message_id) - заменить текст
+        self.merge = merge
+        # Ответ на нажатие кнопки - не сообщение в чат, лимит чата на него не тратится
+        self.paced = paced
+        self.futures: List[Future] = [Future()]
+        self.attempts = 0
+
+
+class _Chat:
+    __slots__ = ('jobs', 'busy', 'scheduled')
+
+    def __init__(self):
+        self.jobs: Deque[OutboundJob] = deque()
+        self.busy = False
+        self.scheduled = False
+
+
+# Очередь исходящих вызовов Telegram API. Сообщения одного чата уходят строго по порядку
+# и не чаще chat_rate в секунду, все чаты вместе - не чаще global_rate. Из готовых чатов
+# первым обслуживается тот, чьё сообщение срочнее. На 429 чат ставится на паузу retry_after.
+class OutboundScheduler:
+    def __init__(self, bot, global_rate=25.0, chat_rate=1.0, chat_burst=3, workers=4, max_retries=5,
+                 max_tracked_chats=10000):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_tracked_chats = max_tracked_chats
+        self.global_bucket = TokenBucket(rate=global_rate, capacity=global_rate)
+        self._buckets: 'OrderedDict[int, TokenBucket]' = OrderedDict()
+        self._chats: Dict[int, _Chat] = {}
+        self._ready = []
+        self._delayed = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._workers = [
+            threading.Thread(target=self._run, name=f'outbound-{index}', daemon=True) for index in range(workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+        QUEUE_DEPTH.labels(queue='outbound').set_function(self.pending)
+
+    # Интерфейс для обработчиков: те же аргументы, что у bot, но вызов ставится в очередь и возвращает Future
+
+    def send_message(self, chat_id, text, priority=Priority.NORMAL, merge=False, **kwargs) -> Future:
+        # merge=True - статусное сообщение: подряд идущие статусы одному чату уходят одним сообщением
+        return self.submit(chat_id, 'send_message', chat_id, text, priority=priority,
+                           merge=('status',) if merge else None, **kwargs)
+
+    def reply_to(self, message, text, priority=Priority.NORMAL, **kwargs) -> Future:
+        return self.submit(message.chat.id, 'reply_to', message, text, priority=priority, **kwargs)
+
+    def edit_message_text(self, text, chat_id, message_id, priority=Priority.NORMAL, **kwargs) -> Future:
+        # Несколько правок одного сообщения подряд - отправляется только последняя
+        return self.submit(chat_id, 'edit_message_text', text, priority=priority, merge=('edit', message_id),
+                           chat_id=chat_id, message_id=message_id, **kwargs)
+
+    def answer_callback_query(self, chat_id, callback_query_id, text=None, **kwargs) -> Future:
+        return self.submit(chat_id, 'answer_callback_query', callback_query_id, text,
+                           priority=Priority.CONFIRMATION, paced=False, **kwargs)
+
+    def submit(self, chat_id, method, /, *args, priority=Priority.NORMAL, merge=None, paced=True, **kwargs) -> Future:
+        job = OutboundJob(method, args, kwargs, priority, merge, paced)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Outbound scheduler is closed")
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = _Chat()
+            last = chat.jobs[-1] if chat.jobs else None
+            if last is not None and merge is not None and self._merge(last, job):
+                return job.futures[0]
+            chat.jobs.append(job)
+            self._schedule(chat_id, chat)
+        return job.futures[0]
+
+    def pending(self) -> int:
+        with self._cond:
+            return sum(len(chat.jobs) + chat.busy for chat in self._chats.values())
+
+    def flush(self, timeout=None) -> bool:
+        # Ждёт, пока очередь опустеет
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._chats:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining if remaining is not None else 0.5)
+        return True
+
+    def close(self, timeout=None):
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join(timeout)
+
+    @staticmethod
+    def _merge(last: OutboundJob, job: OutboundJob) -> bool:
+        if last.merge != job.merge or last.attempts:
+            return False
+        if job.merge[0] == 'status':
+            if last.kwargs != job.kwargs:
+                return False
+            last.args[1] = f"{last.args[1]}\n{job.args[1]}"
+        else:
+            last.args = job.args
+            last.kwargs = job.kwargs
+        last.priority = min(last.priority, job.priority)
+        last.futures.extend(job.futures)
+        return True
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._buckets[chat_id] = TokenBucket(rate=self.chat_rate, capacity=self.chat_burst)
+            if len(self._buckets) > self.max_tracked_chats:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(chat_id)
+        return bucket
+
+    def _schedule(self, chat_id, chat: _Chat, delay=0.0):
+        if chat.busy or chat.scheduled or not chat.jobs:
+            return
+        chat.scheduled = True
+        if delay > 0:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, next(self._seq), chat_id))
+        else:
+            heapq.heappush(self._ready, (chat.jobs[0].priority, next(self._seq), chat_id))
+        self._cond.notify()
+
+    def _next_chat(self):
+        while True:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, chat_id = heapq.heappop(self._delayed)
+                chat = self._chats.get(chat_id)
+                if chat is not None and chat.jobs:
+                    heapq.heappush(self._ready, (chat.jobs[0].priority, next(self._seq), chat_id))
+            while self._ready:
+                _, _, chat_id = heapq.heappop(self._ready)
+                chat = self._chats.get(chat_id)
+                if chat is None or not chat.jobs:
+                    continue
+                wait = self._bucket(chat_id).try_acquire() if chat.jobs[0].paced else 0.0
+                if wait > 0:
+                    heapq.heappush(self._delayed, (now + wait, next(self._seq), chat_id))
+                    continue
+                chat.scheduled = False
+                chat.busy = True
+                return chat_id, chat, chat.jobs.popleft()
+            if self._closed and not self._chats:
+                return None
+            self._cond.wait(self._delayed[0][0] - now if self._delayed else None)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                picked = self._next_chat()
+            if picked is None:
+                return
+            chat_id, chat, job = picked
+            self.global_bucket.acquire()
+            retry_in = self._execute(chat_id, job)
+            with self._cond:
+                chat.busy = False
+                if retry_in is not None:
+                    chat.jobs.appendleft(job)
+                    self._schedule(chat_id, chat, retry_in)
+                elif chat.jobs:
+                    self._schedule(chat_id, chat)
+                else:
+                    del self._chats[chat_id]
+                self._cond.notify_all()
+
+    def _execute(self, chat_id, job: OutboundJob):
+        # Возвращает, через сколько секунд повторить, или None, если с задачей покончено
+        try:
+            with STAGE_SECONDS.labels(stage='telegram_send').time():
+                result = getattr(self.bot, job.method)(*job.args, **job.kwargs)
+        except apihelper.ApiTelegramException as e:
+            if e.error_code == 429 and job.attempts < self.max_retries:
+                parameters = (e.result_json or {}).get('parameters') or {}
+                retry_after = float(parameters.get('retry_after', 1))
+                job.attempts += 1
+                RETRIES.labels(operation='telegram_send').inc()
+                logger.warning(f"Telegram rate limit for chat {chat_id}, retrying {job.method} in {retry_after:.0f}s")
+                return retry_after
+            self._fail(chat_id, job, e)
+            return None
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if job.attempts < self.max_retries:
+                job.attempts += 1
+                RETRIES.labels(operation='telegram_send').inc()
+                return min(30.0, 2.0 ** job.attempts)
+            self._fail(chat_id, job, e)
+            return None
+        except Exception as e:
+            self._fail(chat_id, job, e)
+            return None
+        for future in job.futures:
+            future.set_result(result)
+        return None
+
+    def _fail(self, chat_id, job: OutboundJob, error):
+        # 'message is not modified' - не ошибка доставки, вызывающий код разбирается с ней сам
+        if 'message is not modified' not in str(error):
+            logger.error(f"Error calling {job.method} for chat {chat_id}: {str(error)}")
+            ERRORS.labels(stage='telegram_send').inc()
+        for future in job.futures:
+            future.set_exception(error)
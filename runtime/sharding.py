@@ -0,0 +1,422 @@
+import bisect
+import hashlib
+import importlib
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+from multiprocessing.connection import wait as wait_sentinels
+from typing import List, Optional
+
+if __name__ == '__main__':
+    import sys
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config
+from runtime.async_runtime import USER_EVENT_ATTRS
+from monitoring.metrics import ERRORS, RETRIES, QUEUE_DEPTH
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def raw_update_user_id(update: dict) -> Optional[int]:
+    # То же, что update_user_id, но для JSON обновления из getUpdates
+    for key in USER_EVENT_ATTRS:
+        event = update.get(key)
+        if event and event.get('from'):
+            return event['from'].get('id')
+    return None
+
+
+def routing_key(user_id, update: dict):
+    # Обновления без пользователя (например, статус опроса) раскладываются по update_id
+    return user_id if user_id is not None else f"update:{update.get('update_id')}"
+
+
+# Консистентное хэширование: у каждого шарда vnodes точек на кольце, ключ принадлежит первой точке
+# по часовой стрелке. При выходе шарда из кольца переезжают только его пользователи.
+class HashRing:
+    def __init__(self, nodes=(), vnodes=64):
+        self.vnodes = vnodes
+        self._points = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key) -> int:
+        return int.from_bytes(hashlib.md5(str(key).encode('utf-8')).digest()[:8], 'big')
+
+    def add(self, node):
+        for replica in range(self.vnodes):
+            bisect.insort(self._points, (self._hash(f"{node}#{replica}"), node))
+
+    def remove(self, node):
+        self._points = [point for point in self._points if point[1] != node]
+
+    @property
+    def nodes(self) -> List:
+        return sorted({node for _, node in self._points})
+
+    def node(self, key):
+        if not self._points:
+            raise LookupError("Hash ring is empty")
+        index = bisect.bisect_left(self._points, (self._hash(key),))
+        return self._points[index % len(self._points)][1]
+
+
+def _shard_main(index, inbox, acks, overrides, threads=4, app='main', primary=False):
+    # Ctrl+C приходит всей группе процессов, а останавливает шарды супервизор
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for name, value in overrides.items():
+        setattr(config, name, value)
+    from telebot import types
+    bot_app = importlib.import_module(app)
+    # Обработчики выполняются в потоке шарда, иначе telebot перемешает сообщения одного пользователя
+    bot_app.bot.threaded = False
+    bot_app.start_background(primary=primary)
+    lanes = [queue.Queue() for _ in range(max(1, threads))]
+
+    def run_lane(lane):
+        while True:
+            update = lane.get()
+            try:
+                if update is None:
+                    return
+                bot_app.bot.process_new_updates([update])
+            except Exception as e:
+                logger.error(f"Error processing update {update.update_id} in shard {index}: {str(e)}")
+            finally:
+                lane.task_done()
+
+    workers = [threading.Thread(target=run_lane, args=(lane,), name=f'shard-{index}-lane-{number}', daemon=True)
+               for number, lane in enumerate(lanes)]
+    for worker in workers:
+        worker.start()
+    logger.info(f"Shard {index} started, pid {os.getpid()}")
+    while True:
+        message = inbox.get()
+        if message[0] == 'update':
+            _, user_id, update = message
+            lanes[hash(user_id) % len(lanes)].put(types.Update.de_json(update))
+        elif message[0] == 'flush':
+            # Дорабатываем всё, что пришло до перебалансировки, и сохраняем сессии в общий SQLite
+            for lane in lanes:
+                lane.join()
+            bot_app.user_data.flush()
+            acks.put((index, message[1]))
+        elif message[0] == 'primary':
+            # Шард, который вёл журнал и копию листов, выведен из кольца - теперь это делает этот
+            bot_app.start_primary()
+            logger.info(f"Shard {index} took over journal replay and sheets mirror sync")
+        elif message[0] == 'stop':
+            break
+    for lane in lanes:
+        lane.put(None)
+    for worker in workers:
+        worker.join()
+    bot_app.stop_background()
+    bot_app.user_data.close()
+    logger.info(f"Shard {index} stopped")
+
+
+class Shard:
+    def __init__(self, index, inbox):
+        self.index = index
+        self.inbox = inbox
+        self.process = None
+        self.restarts: List[float] = []
+        self.down_until = 0.0
+
+
+# Супервизор: получает обновления и раскладывает их по процессам-шардам по хэшу user_id,
+# поэтому весь диалог пользователя обрабатывается в одном процессе и состояние не делится между процессами.
+# Упавший шард перезапускается; шард, который падает раз за разом, на время выводится из кольца.
+class ShardSupervisor:
+    def __init__(self, shards, threads=4, queue_size=256, vnodes=64, max_restarts=5, restart_window=300.0,
+                 drain_timeout=30.0, app='main'):
+        self.context = multiprocessing.get_context('spawn')
+        self.threads = threads
+        self.queue_size = queue_size
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
+        self.drain_timeout = drain_timeout
+        self.app = app
+        self.shards = [Shard(index, self.context.Queue(maxsize=queue_size)) for index in range(shards)]
+        self.ring = HashRing(range(shards), vnodes)
+        self._acks = self.context.Queue()
+        self._epoch = 0
+        # Шард, который переносит журнал и синхронизирует копию листов
+        self._primary = 0
+        self._lock = threading.RLock()
+        self._stopping = threading.Event()
+        self._monitor = None
+
+    def _overrides(self, index) -> dict:
+        count = len(self.shards)
+        # Лимит Telegram на все сообщения бота делится между шардами, лимит на чат - нет:
+        # чат всегда обслуживает один шард
+        # Так же делится квота записи в Google Sheets: она общая на проект
+        overrides = {
+            'OUTBOUND_GLOBAL_RATE': config.OUTBOUND_GLOBAL_RATE / count,
+            'SHEETS_REQUESTS_PER_MINUTE': config.SHEETS_REQUESTS_PER_MINUTE / count,
+        }
+        if config.METRICS_PORT:
+            overrides['METRICS_PORT'] = config.METRICS_PORT + index
+        if not config.ASR_CPU_THREADS:
+            overrides['ASR_CPU_THREADS'] = max(1, (os.cpu_count() or 1) // (count * max(1, config.WHISPER_WORKERS)))
+        return overrides
+
+    def _spawn(self, shard: Shard):
+        shard.process = self.context.Process(
+            target=_shard_main,
+            args=(shard.index, shard.inbox, self._acks, self._overrides(shard.index), self.threads, self.app,
+                  shard.index == self._primary),
+            name=f'shard-{shard.index}'
+        )
+        shard.process.start()
+
+    def start(self):
+        for shard in self.shards:
+            self._spawn(shard)
+        self._monitor = threading.Thread(target=self._run_monitor, name='shard-monitor', daemon=True)
+        self._monitor.start()
+        logger.info(f"Started {len(self.shards)} shards")
+
+    def queue_depth(self) -> int:
+        depth = 0
+        for shard in self.shards:
+            try:
+                depth += shard.inbox.qsize()
+            except NotImplementedError:
+                # macOS не умеет qsize у multiprocessing.Queue
+                return 0
+        return depth
+
+    def route(self, update: dict):
+        user_id = raw_update_user_id(update)
+        key = routing_key(user_id, update)
+        message = ('update', user_id, update)
+        while True:
+            # Кладём под блокировкой: иначе _restart может забрать очередь шарда и заменить её
+            # между выбором шарда и put, и обновление останется в брошенной очереди
+            with self._lock:
+                shard = self.shards[self.ring.node(key)]
+                try:
+                    # Пока очередь шарда переполнена, поллер ждёт и не забирает новые обновления;
+                    # между попытками блокировка отпускается, чтобы монитор мог перезапустить шард
+                    shard.inbox.put(message, timeout=1.0)
+                    return
+                except queue.Full:
+                    pass
+            logger.warning(f"Queue of shard {shard.index} is full, waiting")
+
+    def _rebalance(self, change):
+        # Перед сменой владельцев шарды дорабатывают свои очереди и сохраняют сессии в общий SQLite:
+        # новый владелец пользователя загрузит его диалог оттуда. Вызывается под self._lock.
+        self._epoch += 1
+        live = [shard for shard in self.shards if shard.process is not None and shard.process.is_alive()]
+        waiting = set()
+        for shard in live:
+            try:
+                shard.inbox.put(('flush', self._epoch), timeout=self.drain_timeout)
+                waiting.add(shard.index)
+            except queue.Full:
+                logger.warning(f"Shard {shard.index} is not consuming updates, rebalancing without its flush")
+        deadline = time.monotonic() + self.drain_timeout
+        while waiting:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                index, epoch = self._acks.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if epoch == self._epoch:
+                waiting.discard(index)
+        if waiting:
+            logger.warning(f"Shards {sorted(waiting)} did not flush sessions in {self.drain_timeout:.0f}s")
+        change()
+        logger.info(f"Hash ring rebalanced, shards in ring: {self.ring.nodes}")
+
+    def _take_queued(self, shard: Shard) -> list:
+        # Обновления из очереди мёртвого шарда. Если он умер посреди чтения, очередь может быть
+        # заблокирована - тогда эти обновления потеряны
+        messages = []
+        while True:
+            try:
+                message = shard.inbox.get_nowait()
+            except (queue.Empty, OSError, EOFError):
+                break
+            if message[0] == 'update':
+                messages.append(message)
+        return messages
+
+    def _restart(self, shard: Shard):
+        queued = self._take_queued(shard)
+        shard.inbox = self.context.Queue(maxsize=self.queue_size)
+        for message in queued:
+            shard.inbox.put(message)
+        RETRIES.labels(operation='shard_restart').inc()
+        self._spawn(shard)
+        logger.info(f"Shard {shard.index} restarted, {len(queued)} queued updates kept")
+
+    def _on_exit(self, shard: Shard):
+        shard.process.join(1.0)
+        code = shard.process.exitcode
+        shard.process = None
+        if self._stopping.is_set():
+            return
+        logger.error(f"Shard {shard.index} exited with code {code}")
+        ERRORS.labels(stage='shard').inc()
+        now = time.monotonic()
+        shard.restarts = [at for at in shard.restarts if now - at < self.restart_window] + [now]
+        if len(shard.restarts) <= self.max_restarts:
+            self._restart(shard)
+            return
+        shard.down_until = now + self.restart_window
+        if len(self.ring.nodes) <= 1:
+            logger.error(f"Shard {shard.index} keeps crashing, next restart in {self.restart_window:.0f}s")
+            return
+        # Шард падает раз за разом: его пользователи переезжают на остальные, пока он не оживёт
+        logger.error(f"Shard {shard.index} keeps crashing, moving its users to other shards")
+        queued = self._take_queued(shard)
+        self._rebalance(lambda: self.ring.remove(shard.index))
+        for message in queued:
+            self.shards[self.ring.node(routing_key(message[1], message[2]))].inbox.put(message)
+        if shard.index == self._primary:
+            self._hand_over_primary()
+
+    def _hand_over_primary(self):
+        # Журнал и копию листов берёт первый живой шард из кольца; вызывается под self._lock
+        for index in self.ring.nodes:
+            shard = self.shards[index]
+            if shard.process is None or not shard.process.is_alive():
+                continue
+            try:
+                shard.inbox.put(('primary',), timeout=self.drain_timeout)
+            except queue.Full:
+                logger.warning(f"Shard {index} is not consuming updates, cannot hand over primary duties")
+                continue
+            self._primary = index
+            logger.info(f"Primary duties moved to shard {index}")
+            return
+        logger.error("No live shard to take over journal replay and sheets mirror sync")
+
+    def _revive(self, shard: Shard):
+        shard.restarts = []
+        if self._primary not in self.ring.nodes:
+            # Передать журнал было некому - его берёт оживший шард
+            self._primary = shard.index
+        self._restart(shard)
+        if shard.index not in self.ring.nodes:
+            self._rebalance(lambda: self.ring.add(shard.index))
+
+    def _run_monitor(self):
+        while not self._stopping.is_set():
+            with self._lock:
+                sentinels = {shard.process.sentinel: shard for shard in self.shards if shard.process is not None}
+            if sentinels:
+                ready = wait_sentinels(list(sentinels), timeout=1.0)
+            else:
+                ready = []
+                self._stopping.wait(1.0)
+            with self._lock:
+                for sentinel in ready:
+                    self._on_exit(sentinels[sentinel])
+                now = time.monotonic()
+                for shard in self.shards:
+                    if shard.process is None and shard.down_until and now >= shard.down_until and not self._stopping.is_set():
+                        shard.down_until = 0.0
+                        self._revive(shard)
+
+    def poll(self, token, timeout=20, limit=100):
+        from telebot import apihelper
+        offset = None
+        try:
+            while not self._stopping.is_set():
+                try:
+                    updates = apihelper.get_updates(token, offset=offset, limit=limit, timeout=timeout,
+                                                    long_polling_timeout=timeout)
+                except Exception as e:
+                    logger.error(f"Error getting updates: {str(e)}")
+                    self._stopping.wait(3)
+                    continue
+                for update in updates:
+                    offset = update['update_id'] + 1
+                    self.route(update)
+        finally:
+            if offset is not None:
+                # Подтверждаем Telegram уже разложенные обновления, иначе после перезапуска они придут снова
+                try:
+                    apihelper.get_updates(token, offset=offset, limit=1, timeout=0, long_polling_timeout=0)
+                except Exception as e:
+                    logger.error(f"Error confirming updates: {str(e)}")
+
+    def stop(self, timeout=None):
+        # Плавная остановка: шарды дорабатывают очереди, сохраняют сессии и дописывают буферы
+        self._stopping.set()
+        if self._monitor is not None:
+            self._monitor.join()
+        deadline = time.monotonic() + (self.drain_timeout if timeout is None else timeout)
+        with self._lock:
+            running = [shard for shard in self.shards if shard.process is not None]
+            stopping = []
+            for shard in running:
+                try:
+                    shard.inbox.put(('stop',), timeout=max(0.1, deadline - time.monotonic()))
+                    stopping.append(shard)
+                except (queue.Full, OSError, ValueError):
+                    # Очередь забита или сломана - шард команду не получит, ждать его нечего
+                    logger.warning(f"Cannot send stop to shard {shard.index}, terminating")
+                    shard.process.terminate()
+        for shard in running:
+            if shard in stopping:
+                shard.process.join(max(0.0, deadline - time.monotonic()))
+            if shard.process.is_alive():
+                logger.warning(f"Shard {shard.index} did not stop in time, terminating")
+                shard.process.terminate()
+                shard.process.join(5)
+        logger.info("All shards stopped")
+
+
+def _raise_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
+def run_sharded(token, shards=0, threads=4, queue_size=256, vnodes=64, max_restarts=5, restart_window=300.0,
+                drain_timeout=30.0):
+    supervisor = ShardSupervisor(
+        shards or os.cpu_count() or 1,
+        threads=threads,
+        queue_size=queue_size,
+        vnodes=vnodes,
+        max_restarts=max_restarts,
+        restart_window=restart_window,
+        drain_timeout=drain_timeout
+    )
+    # SIGTERM от systemd/docker - такая же плавная остановка, как Ctrl+C
+    signal.signal(signal.SIGTERM, _raise_interrupt)
+    QUEUE_DEPTH.labels(queue='shards').set_function(supervisor.queue_depth)
+    supervisor.start()
+    try:
+        supervisor.poll(token)
+    except KeyboardInterrupt:
+        logger.info("Bot stopped")
+    finally:
+        supervisor.stop()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    run_sharded(
+        config.TELEGRAM_BOT_TOKEN,
+        shards=config.SHARD_COUNT,
+        threads=config.SHARD_THREADS,
+        queue_size=config.SHARD_QUEUE_SIZE,
+        vnodes=config.SHARD_VNODES,
+        max_restarts=config.SHARD_MAX_RESTARTS,
+        restart_window=config.SHARD_RESTART_WINDOW,
+        drain_timeout=config.SHARD_DRAIN_TIMEOUT
+    )
@@ -0,0 +1,157 @@
+import json
+import queue
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+from telebot import types
+
+from runtime.async_runtime import update_user_id
+from monitoring.metrics import ERRORS, QUEUE_DEPTH
+
+import logging
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+MAX_BODY_BYTES = 1024 * 1024
+
+
+class UpdateDeduplicator:
+    # Помнит последние update_id: Telegram повторяет доставку, если не дождался ответа
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, update_id) -> bool:
+        with self._lock:
+            if update_id in self._seen:
+                return False
+            self._seen[update_id] = None
+            if len(self._seen) > self.maxsize:
+                self._seen.popitem(last=False)
+            return True
+
+    def discard(self, update_id):
+        with self._lock:
+            self._seen.pop(update_id, None)
+
+
+# Принимает обновления по HTTP, сразу отвечает Telegram и раскладывает обновления по очередям воркеров.
+# Воркер выбирается по user_id, поэтому сообщения одного пользователя обрабатываются строго по порядку.
+class WebhookServer:
+    def __init__(self, bot, host='0.0.0.0', port=8443, path='/telegram', secret_token=None,
+                 workers=8, queue_size=256, dedupe_size=10000):
+        self.bot = bot
+        self.path = path
+        self.secret_token = secret_token
+        self.deduplicator = UpdateDeduplicator(dedupe_size)
+        self._queues: List[queue.Queue] = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._workers: List[threading.Thread] = []
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        QUEUE_DEPTH.labels(queue='webhook').set_function(self.queue_depth)
+
+    @property
+    def port(self) -> int:
+        return self._server.server_port
+
+    def queue_depth(self) -> int:
+        return sum(worker_queue.qsize() for worker_queue in self._queues)
+
+    def submit(self, update) -> bool:
+        # False - очередь воркера переполнена, Telegram повторит доставку позже
+        if not self.deduplicator.add(update.update_id):
+            logger.info(f"Duplicate update {update.update_id} skipped")
+            return True
+        user_id = update_user_id(update)
+        worker_queue = self._queues[hash(user_id) % len(self._queues)]
+        try:
+            worker_queue.put_nowait(update)
+        except queue.Full:
+            self.deduplicator.discard(update.update_id)
+            return False
+        return True
+
+    def _make_handler(self):
+        server = self
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path.split('?', 1)[0] != server.path:
+                    self.send_error(404)
+                    return
+                if server.secret_token and self.headers.get(SECRET_HEADER) != server.secret_token:
+                    logger.warning(f"Webhook request with wrong secret token from {self.client_address[0]}")
+                    self.send_error(403)
+                    return
+                length = int(self.headers.get('Content-Length') or 0)
+                if length <= 0 or length > MAX_BODY_BYTES:
+                    self.send_error(400)
+                    return
+                try:
+                    update = types.Update.de_json(json.loads(self.rfile.read(length)))
+                except Exception as e:
+                    logger.error(f"Error decoding webhook update: {str(e)}")
+                    ERRORS.labels(stage='webhook').inc()
+                    self.send_error(400)
+                    return
+                if not server.submit(update):
+                    logger.warning(f"Webhook queue is full, update {update.update_id} rejected")
+                    self.send_error(503)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        return WebhookHandler
+
+    def _run_worker(self, worker_queue: queue.Queue):
+        while True:
+            update = worker_queue.get()
+            if update is None:
+                return
+            try:
+                self.bot.process_new_updates([update])
+            except Exception as e:
+                logger.error(f"Error processing webhook update {update.update_id}: {str(e)}")
+
+    def start(self):
+        for index, worker_queue in enumerate(self._queues):
+            worker = threading.Thread(target=self._run_worker, args=(worker_queue,), name=f'webhook-worker-{index}', daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        threading.Thread(target=self._server.serve_forever, name='webhook-http', daemon=True).start()
+        logger.info(f"Webhook server listening on port {self.port}, path {self.path}")
+
+    def stop(self, timeout=None):
+        # Перестаём принимать обновления и дорабатываем то, что уже в очередях
+        self._server.shutdown()
+        self._server.server_close()
+        for worker_queue in self._queues:
+            worker_queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout)
+
+
+def run_webhook(bot, url, host='0.0.0.0', port=8443, path='/telegram', secret_token: Optional[str] = None,
+                workers=8, queue_size=256):
+    # Обработчики выполняются в потоке воркера, иначе telebot перемешает сообщения одного пользователя
+    bot.threaded = False
+    server = WebhookServer(bot, host=host, port=port, path=path, secret_token=secret_token,
+                           workers=workers, queue_size=queue_size)
+    server.start()
+    if url:
+        bot.set_webhook(url=url.rstrip('/') + path, secret_token=secret_token, max_connections=min(100, workers * 5))
+        logger.info(f"Webhook set to {url.rstrip('/') + path}")
+    stopped = threading.Event()
+    try:
+        stopped.wait()
+    except KeyboardInterrupt:
+        logger.info("Bot stopped")
+    finally:
+        server.stop()
@@ -0,0 +1,202 @@
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+from shipment_parser.schema import Shipments
+from monitoring.metrics import ERRORS, RETRIES, LLM_SECONDS
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class LLMTimeout(TimeoutError):
+    pass
+
+
+class LLMUnavailable(RuntimeError):
+    pass
+
+
+# Пул ассистентов: каждый экземпляр в каждый момент используется только одним потоком
+class AssistantPool:
+    def __init__(self, factory, size=4):
+        self.factory = factory
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _take(self, timeout=None):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return self.factory()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get(timeout=timeout)
+
+    @contextmanager
+    def acquire(self, timeout=None):
+        assistant = self._take(timeout)
+        try:
+            yield assistant
+        finally:
+            self._idle.put(assistant)
+
+    def warm_up(self):
+        with self.acquire():
+            pass
+
+
+# Задержки последних успешных ответов провайдера
+class LatencyTracker:
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    def __len__(self):
+        with self._lock:
+            return len(self._samples)
+
+
+# Провайдер LLM: пул ассистентов размера max_concurrency - одновременно к провайдеру идёт
+# не больше max_concurrency запросов
+class LLMProvider:
+    def __init__(self, name, factory, max_concurrency=4):
+        self.name = name
+        self.pool = AssistantPool(factory, size=max_concurrency)
+        self.latency = LatencyTracker()
+
+    def ask(self, text, timeout=None) -> str:
+        try:
+            with self.pool.acquire(timeout=timeout) as assistant:
+                started = time.monotonic()
+                result = assistant.ask_question(text)
+        except queue.Empty:
+            raise LLMUnavailable(f"All {self.pool.size} {self.name} assistants are busy")
+        elapsed = time.monotonic() - started
+        self.latency.observe(elapsed)
+        LLM_SECONDS.labels(provider=self.name).observe(elapsed)
+        return result
+
+    def stats(self) -> dict:
+        return {
+            'samples': len(self.latency),
+            'p50': self.latency.quantile(0.5),
+            'p95': self.latency.quantile(0.95),
+        }
+
+
+def validate_result(result) -> str:
+    # Ответ засчитывается, только если это JSON по схеме Shipments
+    data = json.loads(result) if isinstance(result, (str, bytes)) else result
+    Shipments.model_validate(data)
+    return result if isinstance(result, str) else json.dumps(data, ensure_ascii=False)
+
+
+# Запрос к провайдерам с общим сроком. Первым спрашивается основной провайдер; если он не ответил
+# за свой p95 (или ответил ошибкой), параллельно спрашивается следующий. Побеждает первый валидный ответ,
+# запоздавшие ответы отбрасываются, но их задержка учитывается.
+class LLMRouter:
+    def __init__(self, providers: List[LLMProvider], timeout=60.0, hedge=True, hedge_delay=10.0,
+                 hedge_quantile=0.95, hedge_min_samples=20, min_hedge_delay=0.5,
+                 validate: Callable[[str], str] = validate_result):
+        self.providers = providers
+        self.timeout = timeout
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.min_hedge_delay = min_hedge_delay
+        self.validate = validate
+        workers = 2 * sum(provider.pool.size for provider in providers) or 1
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='llm')
+
+    def hedge_after(self, provider: LLMProvider) -> float:
+        if len(provider.latency) < self.hedge_min_samples:
+            return self.hedge_delay
+        return max(self.min_hedge_delay, provider.latency.quantile(self.hedge_quantile))
+
+    def _call(self, provider: LLMProvider, text, deadline):
+        result = provider.ask(text, timeout=max(0.0, deadline - time.monotonic()))
+        return self.validate(result)
+
+    def ask(self, text, timeout=None) -> str:
+        if not self.providers:
+            raise LLMUnavailable("No LLM providers configured")
+        deadline = time.monotonic() + (timeout or self.timeout)
+        backups = list(self.providers)
+        pending = {}
+        errors = []
+
+        def launch():
+            provider = backups.pop(0)
+            pending[self._executor.submit(self._call, provider, text, deadline)] = provider
+            return provider
+
+        launch()
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            wait_for = remaining
+            if self.hedge and backups:
+                # Резервный провайдер подключается, когда самый свежий запрос дольше p95 своего провайдера
+                newest = list(pending.values())[-1]
+                wait_for = min(remaining, self.hedge_after(newest))
+            done, _ = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+            for future in done:
+                provider = pending.pop(future)
+                try:
+                    return future.result()
+                except Exception as e:
+                    logger.warning(f"LLM provider {provider.name} failed: {str(e)}")
+                    ERRORS.labels(stage='llm').inc()
+                    errors.append(f"{provider.name}: {e}")
+            if not backups or deadline <= time.monotonic():
+                continue
+            if done:
+                # Ошибка или невалидный ответ - сразу спрашиваем следующего
+                launch()
+            elif self.hedge:
+                RETRIES.labels(operation='llm_hedge').inc()
+                logger.info(f"LLM provider {list(pending.values())[-1].name} is slow, asking {backups[0].name}")
+                launch()
+        if pending:
+            raise LLMTimeout(f"No valid LLM answer in {timeout or self.timeout:.1f}s")
+        raise LLMUnavailable(f"All LLM providers failed: {'; '.join(errors)}")
+
+    def stats(self) -> dict:
+        return {provider.name: provider.stats() for provider in self.providers}
+
+    def warm_up(self):
+        for provider in self.providers:
+            try:
+                provider.pool.warm_up()
+            except Exception as e:
+                logger.error(f"Warm-up of LLM provider {provider.name} failed: {str(e)}")
@@ -0,0 +1,86 @@
+import json
+import re
+import unicodedata
+
+import config
+from shipment_parser.schema import Shipments
+from shipment_parser.rules import extract_shipments
+from shipment_parser.llm_pool import LLMProvider, LLMRouter
+from utils.cache import TTLCache
+from monitoring.metrics import CACHE_LOOKUPS, RULES_PARSES
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def assistant_factory(class_name):
+    def create():
+        from AIAssistantsLib import assistants
+        return getattr(assistants, class_name)(schema=Shipments)
+    return create
+
+
+def create_providers(spec, default_concurrency):
+    # "JSONAssistantGPT:4,JSONAssistantYA:2" -> провайдеры в порядке предпочтения
+    providers = []
+    for item in spec.split(','):
+        name, _, concurrency = item.strip().partition(':')
+        if name:
+            providers.append(LLMProvider(name, assistant_factory(name), int(concurrency or default_concurrency)))
+    return providers
+
+
+llm_router = LLMRouter(
+    create_providers(config.LLM_PROVIDERS, config.LLM_ASSISTANT_POOL_SIZE),
+    timeout=config.LLM_TIMEOUT,
+    hedge=config.LLM_HEDGING,
+    hedge_delay=config.LLM_HEDGE_DELAY,
+    hedge_quantile=config.LLM_HEDGE_QUANTILE,
+    hedge_min_samples=config.LLM_HEDGE_MIN_SAMPLES
+)
+parse_cache = TTLCache(maxsize=config.LLM_CACHE_SIZE, ttl=config.LLM_CACHE_TTL)
+
+_whitespace = re.compile(r'\s+')
+
+
+def normalize_text(text: str) -> str:
+    # Пересланный или повторно отправленный текст может отличаться только пробелами и формой Unicode
+    return _whitespace.sub(' ', unicodedata.normalize('NFC', text)).strip()
+
+
+def ask_llm(text):
+    return llm_router.ask(text)
+
+
+def parse_with_rules(text):
+    # Типовые сообщения разбираются регулярными выражениями, LLM нужна только при низкой уверенности
+    extraction = extract_shipments(text)
+    confident = bool(extraction.shipments) and extraction.confidence >= config.RULES_CONFIDENCE_THRESHOLD
+    # confident - ответ без LLM, fallback - сообщение уходит в LLM
+    RULES_PARSES.labels(result='confident' if confident else 'fallback').inc()
+    if confident:
+        logger.info(f"Shipment parsed by rules, confidence {extraction.confidence:.2f}")
+        return extraction.shipments
+    return None
+
+
+def parse_shipment(text):
+    if config.RULES_FAST_PATH:
+        shipments = parse_with_rules(text)
+        if shipments:
+            return shipments
+    key = normalize_text(text)
+    result = parse_cache.get(key)
+    CACHE_LOOKUPS.labels(cache='llm_parse', result='miss' if result is None else 'hit').inc()
+    if result is None:
+        result = ask_llm(text)
+        # В кэше хранится исходная строка JSON: каждый вызов получает свои копии отгрузок
+        shipments = json.loads(result).get('shipments')
+        if shipments:
+            parse_cache.put(key, result)
+        return shipments
+    return json.loads(result).get('shipments')
+
+
+def warm_up():
+    llm_router.warm_up()
@@ -0,0 +1,212 @@
+import json
+import os
+import re
+from typing import List, NamedTuple, Tuple
+
+import config
+from shipment_parser.schema import shipment_fields, procurement_fields
+
+DICTIONARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dictionaries.json')
+
+NUMBER = r'\d+(?:[  ]\d{3})*(?:[.,]\d+)?'
+CURRENCY = r'(?:руб(?:лей|ля|ль)?\.?|р\.|₽)'
+
+DATE_RE = re.compile(r'(?<![\d.\-/])(\d{1,2})[.\-/](\d{1,2})[.\-/](\d{4}|\d{2})(?![\d.\-/]\d)')
+TIME_RE = re.compile(r'(?<![\d:])(?:в\s*)?([01]?\d|2[0-3]):([0-5]\d)(?![\d:])')
+DELIVERY_RE = re.compile(
+    rf'(?:стоимость\s+)?(?:доставк[аиуой]|перевозк[аиуой])\s*[:\-–]?\s*({NUMBER})\s*{CURRENCY}?', re.I
+)
+# Закупочная цена: "закупка по 4000 руб.", "закуп 4000", "входная цена 3900 р."
+PURCHASE_PRICE_RE = re.compile(
+    rf'(?:закуп(?:ка|ки|очная(?:\s+цена)?)?|входная\s+цена|покупка)\s*(?:по|цена|за)?\s*[:\-–]?\s*({NUMBER})\s*{CURRENCY}?',
+    re.I
+)
+PRICE_RE = re.compile(rf'(?:(?:по|цена|за)\s*)?({NUMBER})\s*{CURRENCY}', re.I)
+PRICE_WORD_RE = re.compile(rf'(?:по|цена)\s*({NUMBER})(?![\d.,]*\s*(?:куб|м3|м³|т\b|тонн|шт))', re.I)
+VOLUME_RE = re.compile(
+    rf'({NUMBER})\s*(куб(?:ометр(?:а|ов)?|а|ов)?\.?|м3|м³|тонн(?:а|ы)?|т\.?|шт\.?)(?![а-яёa-z0-9])', re.I
+)
+COUNT_RE = re.compile(r'(\d+)\s*(?:рейс(?:а|ов)?|машин(?:а|ы)?|отгруз(?:ка|ки|ок))(?![а-яё])', re.I)
+ADDRESS_RE = re.compile(
+    r'(?<![а-яё])(?:ш\.|шоссе|ул\.|ул|улица|пр-т|проспект|пер\.|переулок|бульвар|б-р|наб\.|набережная|'
+    r'проезд|пл\.|площадь|д\.|дом|км|корп\.?|стр\.|г\.|город|мкр\.?|пос\.|посёлок|поселок|дер\.|деревня|снт)(?![а-яё])',
+    re.I
+)
+# Уточнения после названия товара: марка (М220, В22.5, П4, F150, W6) и фракция (фр. 20-40, 5-20 мм)
+GOOD_QUALIFIERS_RE = re.compile(
+    r'(?:\s*(?:[МмMВвBПпFW]\s?\d+(?:[.,]\d+)?|фр(?:акци[яи])?\.?\s*\d+(?:[-–]\d+)?|\d+[-–]\d+(?:\s*мм)?)(?![а-яёa-z0-9]))*',
+    re.I
+)
+# Грузополучатель похож на название организации: форма собственности, кавычки, "ТехноСтрой" или "Мастер Строй"
+CUSTOMER_NAME_RE = re.compile(
+    r'(?<![А-ЯЁа-яёA-Za-z])(?:ООО|ОАО|ЗАО|ПАО|АО|ИП|ТОО|ЧП)(?![А-ЯЁа-яёA-Za-z])|[«"]|[а-яё][А-ЯЁ]|'
+    r'^[А-ЯЁA-Z]\S*(?:\s+[А-ЯЁA-Z0-9]\S*)+$'
+)
+SEGMENT_SPLIT_RE = re.compile(r'[,;](?!\d)')
+SPACES_RE = re.compile(r'\s+')
+EDGE_JUNK = ' .:;-–—()"\''
+
+# Поля, без которых разбор правилами считается неуверенным
+REQUIRED_FIELDS = ('shipment_date', 'customer_name', 'customer_address', 'good', 'good_volume', 'good_price', 'supplier')
+
+
+class Extraction(NamedTuple):
+    shipments: List[dict]
+    confidence: float
+
+
+def load_dictionaries(path=None):
+    with open(DICTIONARY_PATH, encoding='utf-8') as f:
+        dictionaries = json.load(f)
+    extra_path = path or config.RULES_DICTIONARY_PATH
+    if extra_path and os.path.exists(extra_path):
+        with open(extra_path, encoding='utf-8') as f:
+            extra = json.load(f)
+        for key in ('goods', 'suppliers', 'customers'):
+            dictionaries[key] = dictionaries.get(key, []) + extra.get(key, [])
+    # Длинные названия проверяем первыми: "цементный раствор" раньше "раствор"
+    goods = sorted({good.casefold() for good in dictionaries.get('goods', [])}, key=len, reverse=True)
+    suppliers = {supplier.casefold(): supplier for supplier in dictionaries.get('suppliers', [])}
+    customers = {customer.casefold(): customer for customer in dictionaries.get('customers', [])}
+    return goods, suppliers, customers
+
+
+GOODS, SUPPLIERS, CUSTOMERS = load_dictionaries()
+GOOD_RE = re.compile(r'(?<![а-яё])(?:' + '|'.join(re.escape(good) for good in GOODS) + r')(?![а-яё])', re.I) if GOODS else None
+
+
+def _clean(text: str) -> str:
+    return SPACES_RE.sub(' ', text).strip(EDGE_JUNK)
+
+
+def _number(text: str) -> str:
+    return text.replace(' ', '').replace(' ', '')
+
+
+def _money(text: str) -> str:
+    return f"{_number(text)} руб."
+
+
+def _take(pattern, text):
+    # Находит первое совпадение и вырезает его из текста
+    match = pattern.search(text)
+    if match is None:
+        return None, text
+    return match, text[:match.start()] + ' ' + text[match.end():]
+
+
+def _split_good(segment: str, good) -> Tuple[str, List[str]]:
+    # Товар - название из словаря с марками и фракциями после него, остальное в сегменте - лишний текст
+    qualifiers = GOOD_QUALIFIERS_RE.match(segment, good.end())
+    leftover = [_clean(segment[:good.start()]), _clean(segment[qualifiers.end():])]
+    return _clean(segment[good.start():qualifiers.end()]), [part for part in leftover if part]
+
+
+def _extract_one(text: str) -> Extraction:
+    shipment = {field: None for field in shipment_fields}
+    purchase_price = None
+    # Нераспознанные фрагменты и кандидаты в товар - с номером сегмента, чтобы сохранить порядок
+    unclassified = []
+    goods = []
+    supplier_guessed = False
+
+    for position, raw_segment in enumerate(SEGMENT_SPLIT_RE.split(text)):
+        segment = raw_segment
+        match, segment = _take(DATE_RE, segment)
+        if match and shipment['shipment_date'] is None:
+            day, month, year = match.groups()
+            year = year if len(year) == 4 else f"20{year}"
+            shipment['shipment_date'] = f"{int(day):02d}-{int(month):02d}-{year}"
+        match, segment = _take(TIME_RE, segment)
+        if match and shipment['shipment_time'] is None:
+            shipment['shipment_time'] = f"{int(match.group(1)):02d}:{match.group(2)}"
+        match, segment = _take(DELIVERY_RE, segment)
+        if match and shipment['shipment_cost'] is None:
+            shipment['shipment_cost'] = _money(match.group(1))
+        match, segment = _take(PURCHASE_PRICE_RE, segment)
+        if match and purchase_price is None:
+            purchase_price = _money(match.group(1))
+        volume, segment = _take(VOLUME_RE, segment)
+        if volume and shipment['good_volume'] is None:
+            shipment['good_volume'] = f"{volume.group(1).replace(' ', '')} {volume.group(2)}"
+        price, segment = _take(PRICE_RE, segment)
+        if price is None:
+            price, segment = _take(PRICE_WORD_RE, segment)
+        if price and shipment['good_price'] is None:
+            shipment['good_price'] = _money(price.group(1))
+        match, segment = _take(COUNT_RE, segment)
+        if match and shipment['shipment_count'] is None:
+            shipment['shipment_count'] = match.group(1)
+
+        segment = _clean(segment)
+        if not segment:
+            continue
+        folded = segment.casefold()
+        if folded in SUPPLIERS and shipment['supplier'] is None:
+            shipment['supplier'] = SUPPLIERS[folded]
+        elif GOOD_RE is not None and (good := GOOD_RE.search(segment)):
+            goods.append((position, segment, good, bool(volume or price)))
+        elif ADDRESS_RE.search(segment) and shipment['customer_address'] is None:
+            shipment['customer_address'] = segment
+        else:
+            unclassified.append((position, segment))
+
+    leftover = []
+    if goods:
+        # Товар - сегмент с объёмом или ценой ("ООО Песок и Камень" - это грузополучатель), иначе первый
+        chosen = next((candidate for candidate in goods if candidate[3]), goods[0])
+        shipment['good'], leftover = _split_good(chosen[1], chosen[2])
+        unclassified.extend((position, segment) for position, segment, _, _ in goods if position != chosen[0])
+        unclassified.sort()
+    unclassified = [segment for _, segment in unclassified]
+
+    # Грузополучатель - первый нераспознанный фрагмент, поставщик - последний, если его нет в словаре
+    if unclassified and shipment['customer_name'] is None:
+        shipment['customer_name'] = unclassified.pop(0)
+    if unclassified and shipment['supplier'] is None and shipment['good'] is not None:
+        shipment['supplier'] = unclassified.pop()
+        supplier_guessed = True
+
+    # Догадки не засчитываются: поставщик не из словаря и грузополучатель, не похожий на название
+    # организации ("срочно", "оплата наличными"), отправляют сообщение в LLM
+    guessed = {'supplier'} if supplier_guessed else set()
+    customer = shipment['customer_name']
+    if customer is not None and customer.casefold() not in CUSTOMERS and not CUSTOMER_NAME_RE.search(customer):
+        guessed.add('customer_name')
+    score = sum(1.0 for field in REQUIRED_FIELDS if shipment[field] is not None and field not in guessed)
+    confidence = score / len(REQUIRED_FIELDS)
+    # Каждый непонятый фрагмент (и лишний текст рядом с товаром) - информация, которую правила потеряли
+    confidence *= 0.8 ** (len(unclassified) + len(leftover))
+
+    if shipment['supplier'] is not None and shipment['good'] is not None:
+        procurement = {field: None for field in procurement_fields}
+        procurement.update({
+            'supplier': shipment['supplier'],
+            'good': shipment['good'],
+            'good_volume': shipment['good_volume'],
+            # Цена закупки - только если она указана явно, цена продажи для неё не подходит
+            'good_price': purchase_price,
+        })
+        shipment['procurements'] = [procurement]
+    else:
+        shipment['procurements'] = []
+    return Extraction([shipment], confidence)
+
+
+def extract_shipments(text: str) -> Extraction:
+    # Каждая непустая строка с товаром - отдельная отгрузка, иначе весь текст - одна отгрузка
+    lines = [line for line in text.splitlines() if line.strip()]
+    if GOOD_RE is not None and len(lines) > 1 and all(GOOD_RE.search(line) for line in lines):
+        parts = lines
+    else:
+        parts = [', '.join(lines)]
+    if not parts or not parts[0]:
+        return Extraction([], 0.0)
+    shipments = []
+    confidence = 1.0
+    for part in parts:
+        extraction = _extract_one(part)
+        shipments.extend(extraction.shipments)
+        confidence = min(confidence, extraction.confidence)
+    return Extraction(shipments, confidence)
+
@@ -0,0 +1,51 @@
+from typing import List, Optional
+
+from pydantic import BaseModel, Field
+
+# Поля для корректировки
+shipment_fields = [
+    "shipment_date",
+    "shipment_time",
+    "customer_name",
+    "customer_address",
+    "good",
+    "good_volume",
+    "good_price",
+    "shipment_count",
+    "shipment_cost",
+    "supplier"
+]
+
+procurement_fields = [
+    "supplier",
+    "good",
+    "good_volume",
+    "good_price",
+    "supply_cost"
+]
+
+
+class Procurement(BaseModel):
+    supplier: Optional[str] = Field(default=None)
+    good: Optional[str] = Field(default=None)
+    good_volume: Optional[str] = Field(default=None)
+    good_price: Optional[str] = Field(default=None)
+    supply_cost: Optional[str] = Field(default=None)
+
+
+class Shipment(BaseModel):
+    shipment_date: Optional[str] = Field(default=None)
+    shipment_time: Optional[str] = Field(default=None)
+    customer_name: Optional[str] = Field(default=None)
+    customer_address: Optional[str] = Field(default=None)
+    good: Optional[str] = Field(default=None)
+    good_volume: Optional[str] = Field(default=None)
+    good_price: Optional[str] = Field(default=None)
+    shipment_count: Optional[str] = Field(default=None)
+    shipment_cost: Optional[str] = Field(default=None)
+    supplier: Optional[str] = Field(default=None)
+    procurements: Optional[List[Procurement]] = Field(default=None)
+
+
+class Shipments(BaseModel):
+    shipments: List[Shipment] = Field(description="List of shipments")
@@ -0,0 +1,152 @@
+import random
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Tuple
+
+from utils.rate_limit import TokenBucket
+from monitoring.metrics import STAGE_SECONDS, ERRORS, RETRIES
+
+import logging
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+
+def http_status(error) -> int:
+    # googleapiclient.errors.HttpError хранит ответ в resp
+    resp = getattr(error, 'resp', None)
+    try:
+        return int(getattr(resp, 'status', 0) or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+# Отложенная запись в Google Sheets: строки от разных пользователей копятся в буфере листа
+# и уходят одним append на много строк - по таймеру или при достижении лимита размера.
+class SheetsBatchWriter:
+    def __init__(self, flush_interval=2.0, max_batch_rows=200, requests_per_minute=60,
+                 max_retries=5, backoff_base=1.0, backoff_max=64.0):
+        self.flush_interval = flush_interval
+        self.max_batch_rows = max_batch_rows
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.bucket = TokenBucket(rate=requests_per_minute / 60.0, capacity=max(1.0, requests_per_minute / 6.0))
+        self._buffers: Dict[Any, List[Tuple[dict, Future]]] = {}
+        self._first_enqueued: Dict[Any, float] = {}
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='sheets-batch-writer', daemon=True)
+        self._thread.start()
+
+    def append(self, manager, data: dict) -> Future:
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Batch writer is closed")
+            buffer = self._buffers.setdefault(manager, [])
+            first = not buffer
+            if first:
+                self._first_enqueued[manager] = time.monotonic()
+            buffer.append((data, future))
+            # Первая строка в пустом буфере запускает таймер сброса: поток писателя мог спать без срока
+            if first or len(buffer) >= self.max_batch_rows:
+                self._cond.notify()
+        return future
+
+    def pending_rows(self) -> int:
+        with self._cond:
+            return sum(len(buffer) for buffer in self._buffers.values())
+
+    def flush(self):
+        # Синхронно записывает всё, что накопилось
+        with self._cond:
+            batches = self._take_batches(force=True)
+        for manager, batch in batches:
+            self._write_batch(manager, batch)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _take_batches(self, force=False):
+        now = time.monotonic()
+        batches = []
+        for manager, buffer in list(self._buffers.items()):
+            if not buffer:
+                continue
+            due = now - self._first_enqueued[manager] >= self.flush_interval
+            if force or due or len(buffer) >= self.max_batch_rows:
+                batches.append((manager, buffer[:self.max_batch_rows]))
+                rest = buffer[self.max_batch_rows:]
+                self._buffers[manager] = rest
+                if rest:
+                    self._first_enqueued[manager] = now
+        return batches
+
+    def _next_wait(self):
+        if not self._first_enqueued or not any(self._buffers.values()):
+            return None
+        now = time.monotonic()
+        waits = [self._first_enqueued[manager] + self.flush_interval - now
+                 for manager, buffer in self._buffers.items() if buffer]
+        return max(0.0, min(waits))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batches = self._take_batches(force=self._closed)
+                while not batches and not self._closed:
+                    self._cond.wait(self._next_wait())
+                    batches = self._take_batches(force=self._closed)
+                if not batches and self._closed:
+                    return
+            for manager, batch in batches:
+                self._write_batch(manager, batch)
+
+    def _write_batch(self, manager, batch: List[Tuple[dict, Future]]):
+        live = [(data, future) for data, future in batch if future.set_running_or_notify_cancel()]
+        if not live:
+            return
+        items = [data for data, _ in live]
+        futures = [future for _, future in live]
+        attempt = 0
+        while True:
+            self.bucket.acquire()
+            try:
+                with STAGE_SECONDS.labels(stage='sheets_append').time():
+                    rows = manager.rows_from_json(items)
+                    result = manager.append_rows(rows)
+                logger.info(f"Appended {len(rows)} rows to {manager.worksheet}")
+                for future in futures:
+                    future.set_result(result)
+                return
+            except Exception as e:
+                status = http_status(e)
+                if status in RETRYABLE_STATUSES and attempt < self.max_retries:
+                    delay = min(self.backoff_max, self.backoff_base * 2 ** attempt) + random.uniform(0, 1)
+                    logger.warning(f"Sheets returned {status} for {manager.worksheet}, retrying in {delay:.1f}s")
+                    attempt += 1
+                    RETRIES.labels(operation='sheets_append').inc()
+                    if status == 429:
+                        # Квота исчерпана: останавливаем все запросы писателя, а не только этот
+                        self.bucket.pause(delay)
+                    else:
+                        time.sleep(delay)
+                    continue
+                if status == 400 and attempt == 0 and hasattr(manager, 'invalidate_headers'):
+                    # Схема листа могла измениться: строки пересобираются по перечитанным заголовкам
+                    logger.warning(f"Sheets returned 400 for {manager.worksheet}, retrying with fresh headers")
+                    attempt += 1
+                    RETRIES.labels(operation='sheets_append').inc()
+                    manager.invalidate_headers()
+                    continue
+                error = e
+            logger.error(f"Error appending {len(items)} rows to {manager.worksheet}: {str(error)}")
+            ERRORS.labels(stage='sheets_append').inc()
+            for future in futures:
+                future.set_exception(error)
+            return
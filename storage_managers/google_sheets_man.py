@@ -1,45 +1,243 @@
 import os
-from typing import List, Any
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-from google.oauth2 import service_account
+from typing import Dict, List, Any
 import json
+import re
+import time
+import atexit
+import threading
 
 # Add the parent directory to sys.path
 if __name__ == '__main__':
     import sys
     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import config
+from storage_managers.batch_writer import SheetsBatchWriter, http_status
+from monitoring.metrics import QUEUE_DEPTH
 
 import logging
 logger = logging.getLogger(__name__)
 
+def column_letter(index: int) -> str:
+    # 0 -> A, 25 -> Z, 26 -> AA
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+def column_index(letters: str) -> int:
+    # A -> 0, AA -> 26
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+class _SessionHttp:
+    # Транспорт для googleapiclient поверх requests.Session: пул keep-alive соединений,
+    # которым можно пользоваться из нескольких потоков (httplib2.Http для этого не годится)
+    def __init__(self, session, timeout=None):
+        self.session = session
+        self.timeout = timeout
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=None, connection_type=None):
+        import httplib2
+        response = self.session.request(method, uri, data=body, headers=headers, timeout=self.timeout)
+        info = {key: value for key, value in response.headers.items() if key.lower() != 'content-encoding'}
+        info['status'] = str(response.status_code)
+        return httplib2.Response(info), response.content
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+def get_shared_service(credentials_file):
+    # Один клиент Sheets API и один пул соединений на файл учётных данных для всех листов.
+    # Описание API берётся из копии в пакете googleapiclient, при старте discovery не запрашивается.
+    with _services_lock:
+        service = _services.get(credentials_file)
+        if service is None:
+            import requests
+            from google.oauth2 import service_account
+            from google.auth.transport.requests import AuthorizedSession
+            from googleapiclient.discovery import build
+            creds = service_account.Credentials.from_service_account_file(
+                credentials_file,
+                scopes=['https://www.googleapis.com/auth/spreadsheets']
+            )
+            session = AuthorizedSession(creds)
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=config.SHEETS_HTTP_POOL_SIZE)
+            session.mount('https://', adapter)
+            http = _SessionHttp(session, timeout=config.SHEETS_HTTP_TIMEOUT)
+            service = build('sheets', 'v4', http=http, static_discovery=True, cache_discovery=False)
+            _services[credentials_file] = service
+        return service
+
+
 class GoogleSheetsManager:
-    def __init__(self, credentials_file, spreadsheet_id, worksheet='Sheet1'):
+    def __init__(self, credentials_file, spreadsheet_id, worksheet='Sheet1', headers_ttl=None, key='shipment_id'):
         self.credentials_file = credentials_file
         self.spreadsheet_id = spreadsheet_id
         self.worksheet = worksheet
-        self.service = self._create_service()
+        self.key = key
+        self.headers_ttl = config.SHEETS_HEADER_CACHE_TTL if headers_ttl is None else headers_ttl
+        self._service = None
+        self._service_lock = threading.Lock()
+        # Заголовки листа запрашиваются раз в headers_ttl секунд, а не перед каждой записью
+        self._headers = None
+        self._headers_at = 0.0
+        # Индекс значение key -> номера строк листа (у закупок на одну отгрузку строк несколько).
+        # Читается из листа один раз, дальше пополняется по ответам append.
+        self._row_index = None
+        self._next_row = None
+        self._index_lock = threading.Lock()
+
+    @property
+    def service(self):
+        # Клиент Google API создаётся при первом запросе, а не при импорте модуля
+        if self._service is None:
+            with self._service_lock:
+                if self._service is None:
+                    self._service = self._create_service()
+        return self._service
 
     def _create_service(self):
-        creds = service_account.Credentials.from_service_account_file(
-            self.credentials_file, 
-            scopes=['https://www.googleapis.com/auth/spreadsheets']
-        )
-        return build('sheets', 'v4', credentials=creds)
+        return get_shared_service(self.credentials_file)
+
+    def invalidate_headers(self):
+        self._headers = None
 
     def append_row(self, values: List[Any]):
+        return self.append_rows([values])
+
+    def append_rows(self, rows: List[List[Any]]):
+        # Один запрос append на все строки
         sheet = self.service.spreadsheets()
-        result = sheet.values().append(
+        try:
+            result = sheet.values().append(
+                spreadsheetId=self.spreadsheet_id,
+                range=self.worksheet,  # Adjust if your sheet has a different name
+                valueInputOption='USER_ENTERED',
+                insertDataOption='INSERT_ROWS',
+                body={'values': rows}
+            ).execute()
+        except Exception as e:
+            if http_status(e) == 400:
+                # Лист переименован или изменён: заголовки перечитаем перед следующей записью
+                self.invalidate_headers()
+            raise
+        self._check_table_width(result)
+        self._index_appended(rows, result)
+        return result
+
+    def _index_appended(self, rows, result):
+        # updatedRange ответа append - куда легли строки, например "shipments!A121:K123"
+        updated_range = ((result or {}).get('updates') or {}).get('updatedRange') or ''
+        match = re.match(r"^.*!([A-Z]+)(\d+)(?::[A-Z]+\d+)?$", updated_range)
+        with self._index_lock:
+            if self._row_index is None:
+                return
+            first_row = int(match.group(2)) if match else None
+            headers = self._headers
+            if first_row is None or first_row < self._next_row or headers is None or self.key not in headers:
+                # Лист меняли в обход индекса (удаляли строки, сортировали) - перечитаем
+                self.invalidate_index()
+                return
+            if first_row > self._next_row:
+                # Перед новыми строками есть не попавшие в индекс: пустые ячейки key в конце столбца,
+                # которые не вернул get_column_values, или строки, дописанные другим процессом
+                self._index_cells(self._next_row, self.get_column_values(self.key, self._next_row, first_row - 1))
+            position = headers.index(self.key)
+            for offset, row in enumerate(rows):
+                value = str(row[position]) if position < len(row) else ''
+                if value:
+                    self._row_index.setdefault(value, []).append(first_row + offset)
+            self._next_row = first_row + len(rows)
+
+    def invalidate_index(self):
+        self._row_index = None
+        self._next_row = None
+
+    def find_rows(self, value) -> List[int]:
+        # Номера строк листа с данным значением key
+        with self._index_lock:
+            if self._row_index is None:
+                self._row_index = {}
+                # Пустые ячейки в конце столбца API не возвращает, так что _next_row может оказаться меньше
+                # настоящего конца таблицы - недостающие строки дочитает _index_appended
+                self._index_cells(2, self.get_column_values(self.key))
+            return list(self._row_index.get(str(value), []))
+
+    def _index_cells(self, first_row, values):
+        for row, cell in enumerate(values, start=first_row):
+            if cell:
+                self._row_index.setdefault(cell, []).append(row)
+        self._next_row = first_row + len(values)
+
+    def _rows_match(self, value, rows) -> bool:
+        # Строки могли сдвинуть вручную (сортировка, удаление): перед записью сверяем key в этих строках
+        column = column_letter(self.get_headers().index(self.key))
+        result = self.service.spreadsheets().values().batchGet(
             spreadsheetId=self.spreadsheet_id,
-            range=self.worksheet,  # Adjust if your sheet has a different name
-            valueInputOption='USER_ENTERED',
-            insertDataOption='INSERT_ROWS',
-            body={'values': [values]}
+            ranges=[f"{self.worksheet}!{column}{row}" for row in rows],
+            majorDimension='ROWS'
         ).execute()
-        return result
-    
-    def get_headers(self) -> List[str]:
+        cells = [(item.get('values') or [['']])[0][0] for item in result.get('valueRanges', [])]
+        return cells == [str(value)] * len(rows)
+
+    def update_rows(self, updates: Dict[int, dict]):
+        # Один batchUpdate: в каждой строке пишутся только переданные поля
+        headers = self.get_headers()
+        data = [
+            {'range': f"{self.worksheet}!{column_letter(headers.index(field))}{row}", 'values': [[value]]}
+            for row, fields in updates.items()
+            for field, value in fields.items()
+            if field in headers
+        ]
+        if not data:
+            return None
+        return self.service.spreadsheets().values().batchUpdate(
+            spreadsheetId=self.spreadsheet_id,
+            body={'valueInputOption': 'USER_ENTERED', 'data': data}
+        ).execute()
+
+    def update_by_key(self, value, fields: dict) -> int:
+        # Исправление уже записанных строк без перезаписи листа; возвращает число обновлённых строк
+        rows = self.find_rows(value)
+        if rows and not self._rows_match(value, rows):
+            logger.warning(f"Row index of {self.worksheet} is stale, rebuilding")
+            with self._index_lock:
+                self.invalidate_index()
+            rows = self.find_rows(value)
+        if not rows:
+            return 0
+        self.update_rows({row: fields for row in rows})
+        return len(rows)
+
+    def upsert_from_json(self, data):
+        # Строка с таким key уже есть - обновляем её поля, иначе дописываем новую
+        if not self.update_by_key(data[self.key], data):
+            self.append_row_from_json(data)
+
+    def _check_table_width(self, result):
+        # tableRange ответа append - текущая таблица листа, например "shipments!A1:K120".
+        # Если её ширина не совпадает с закэшированными заголовками, в листе добавили или удалили колонки.
+        headers = self._headers
+        table_range = (result or {}).get('tableRange') or ''
+        match = re.match(r"^.*!([A-Z]+)\d+:([A-Z]+)\d+$", table_range)
+        if headers is None or match is None:
+            return
+        width = column_index(match.group(2)) - column_index(match.group(1)) + 1
+        if width != len(headers):
+            logger.warning(f"Columns of {self.worksheet} changed ({width} instead of {len(headers)}), refreshing headers")
+            self.invalidate_headers()
+
+    def get_headers(self, refresh=False) -> List[str]:
+        headers = self._headers
+        if not refresh and headers is not None and time.monotonic() - self._headers_at < self.headers_ttl:
+            return headers
         sheet = self.service.spreadsheets()
         range_name = f"{self.worksheet}!1:1"
         values = sheet.values().get(
@@ -48,33 +246,162 @@ class GoogleSheetsManager:
             majorDimension='ROWS'  # Ensures data is returned row-wise
         ).execute()
         headers = values.get('values', [])[0]
+        self._headers, self._headers_at = headers, time.monotonic()
         return headers
 
-    def append_row_from_json(self, data):
+    def get_column_values(self, header, first_row=2, last_row='') -> List[str]:
+        headers = self.get_headers()
+        if header not in headers:
+            return []
+        column = column_letter(headers.index(header))
+        sheet = self.service.spreadsheets()
+        values = sheet.values().get(
+            spreadsheetId=self.spreadsheet_id,
+            range=f"{self.worksheet}!{column}{first_row}:{column}{last_row}",
+            majorDimension='COLUMNS'
+        ).execute()
+        columns = values.get('values', [])
+        return columns[0] if columns else []
+
+    def get_rows(self, first_row, width) -> List[List[str]]:
+        # Строки начиная с first_row (нумерация листа, 1 - заголовки) до конца данных
+        sheet = self.service.spreadsheets()
+        values = sheet.values().get(
+            spreadsheetId=self.spreadsheet_id,
+            range=f"{self.worksheet}!A{first_row}:{column_letter(width - 1)}",
+            majorDimension='ROWS',
+            valueRenderOption='FORMATTED_VALUE'
+        ).execute()
+        return values.get('values', [])
+
+    def rows_from_json(self, items: List[dict]) -> List[List[Any]]:
         headers = self.get_headers()
-        values = [data.get(header, "") for header in headers]
-        self.append_row(values)
+        return [[data.get(header, "") for header in headers] for data in items]
+
+    def append_row_from_json(self, data):
+        try:
+            self.append_rows(self.rows_from_json([data]))
+        except Exception as e:
+            if http_status(e) != 400:
+                raise
+            # Один повтор с перечитанными заголовками
+            self.append_rows(self.rows_from_json([data]))
 
 # Создаем экземпляр GoogleSheetsManager с нужными параметрами
 shipment_store = GoogleSheetsManager(credentials_file=config.GOOGLE_SHEETS_CRED, spreadsheet_id=config.SHIPMENTS_SHEET_ID, worksheet='shipments')
 procurement_store = GoogleSheetsManager(credentials_file=config.GOOGLE_SHEETS_CRED, spreadsheet_id=config.PROCUREMENTS_SHEET_ID, worksheet='procurements')
 
 
+def warm_up():
+    for store in (shipment_store, procurement_store):
+        store.service
+
+
+_batch_writer = None
+_batch_writer_lock = threading.Lock()
+
+def get_batch_writer() -> SheetsBatchWriter:
+    global _batch_writer
+    with _batch_writer_lock:
+        if _batch_writer is None:
+            _batch_writer = SheetsBatchWriter(
+                flush_interval=config.SHEETS_FLUSH_INTERVAL,
+                max_batch_rows=config.SHEETS_MAX_BATCH_ROWS,
+                requests_per_minute=config.SHEETS_REQUESTS_PER_MINUTE
+            )
+            QUEUE_DEPTH.labels(queue='sheets_write_behind').set_function(_batch_writer.pending_rows)
+        return _batch_writer
+
+
+def close_batch_writer():
+    # Дописывает буфер write-behind; повторный вызов ничего не делает
+    global _batch_writer
+    with _batch_writer_lock:
+        writer, _batch_writer = _batch_writer, None
+    if writer is not None:
+        writer.close()
+
+# Дописываем буфер при остановке бота
+atexit.register(close_batch_writer)
+
+
+def shipment_procurements(shipment):
+    procurements = shipment.get('procurements')
+    if procurements is None:
+        return []
+    procurements = procurements if isinstance(procurements, list) else [procurements]
+    for procurement in procurements:
+        procurement['shipment_id'] = shipment['shipment_id']
+    return procurements
+
+
 def store_shipment(shipment_json):
     # Добавляем данные в таблицу
     
     shipment = json.loads(shipment_json)
+    procurements = shipment_procurements(shipment)
+    if config.SHEETS_WRITE_BEHIND:
+        # Строки уходят в таблицу пачкой в фоне, результат записи - в возвращаемых Future
+        writer = get_batch_writer()
+        futures = [writer.append(shipment_store, shipment)]
+        futures.extend(writer.append(procurement_store, procurement) for procurement in procurements)
+        return futures
     shipment_store.append_row_from_json(shipment)
-    shipment_id = shipment['shipment_id']
-    procurements = shipment['procurements']
-    if procurements is None:
-        return
-    procurements = procurements if isinstance(procurements, list) else [procurements]
     for procurement in procurements:
-        procurement['shipment_id'] = shipment_id
         procurement_store.append_row_from_json(procurement)
 
 
+def _append_items(manager, items):
+    if not items:
+        return
+    if config.SHEETS_WRITE_BEHIND:
+        writer = get_batch_writer()
+        futures = [writer.append(manager, item) for item in items]
+        for future in futures:
+            future.result()
+    else:
+        manager.append_rows(manager.rows_from_json(items))
+
+
+def store_shipment_idempotent(shipment, resume=False):
+    # Повторный вызов для той же отгрузки не создаёт дублей: при resume=True
+    # проверяем по shipment_id, какие строки уже есть в таблицах
+    procurements = shipment_procurements(shipment)
+    shipment_id = str(shipment['shipment_id'])
+    if resume:
+        if not shipment_store.find_rows(shipment_id):
+            _append_items(shipment_store, [shipment])
+        written = len(procurement_store.find_rows(shipment_id))
+        _append_items(procurement_store, procurements[written:])
+    else:
+        _append_items(shipment_store, [shipment])
+        _append_items(procurement_store, procurements)
+
+
+def add_procurement(shipment_id, procurement):
+    # Закупка к сохранённой отгрузке - одна новая строка в листе закупок, строка отгрузки не переписывается
+    _append_items(procurement_store, [dict(procurement, shipment_id=str(shipment_id))])
+
+
+def update_shipment_fields(shipment_id, fields: dict) -> int:
+    # Исправление сохранённой отгрузки - запись только изменённых ячеек её строки
+    return shipment_store.update_by_key(str(shipment_id), fields)
+
+
+def apply_shipment_update(shipment_id, kind, payload, written_before=None):
+    # Изменение сохранённой отгрузки из журнала. written_before передаётся при повторе:
+    # если закупок в таблице уже больше, прошлая попытка успела дописать строку
+    if kind == 'procurement':
+        if written_before is not None and len(procurement_store.find_rows(str(shipment_id))) > written_before:
+            return
+        add_procurement(shipment_id, payload)
+    elif kind == 'fields':
+        if not update_shipment_fields(shipment_id, payload):
+            raise LookupError(f"Shipment {shipment_id} not found in {shipment_store.worksheet}")
+    else:
+        raise ValueError(f"Unknown shipment update: {kind}")
+
+
 if __name__ == '__main__':
     shipment = """{
         "shipment_id": 1,
@@ -0,0 +1,248 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from monitoring.metrics import STAGE_SECONDS, ERRORS, RETRIES
+
+import logging
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = 'pending'
+STATUS_STORED = 'stored'
+
+
+# Локальный журнал подтверждённых отгрузок. Отгрузка сначала фиксируется в SQLite (с fsync),
+# а в Google Sheets её переносит JournalReplayer в фоне.
+class ShipmentJournal:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS shipments (
+                shipment_id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                next_attempt_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS shipments_pending ON shipments (status, next_attempt_at)"
+        )
+        # Изменения уже сохранённых отгрузок: закупки (kind='procurement') и исправленные поля (kind='fields')
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS shipment_updates (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                shipment_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                next_attempt_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS shipment_updates_pending ON shipment_updates (status, shipment_id, id)"
+        )
+
+    def record(self, shipment: dict):
+        # Повторная запись той же отгрузки ничего не меняет
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO shipments (shipment_id, payload, created_at, next_attempt_at) VALUES (?, ?, ?, ?)",
+                (str(shipment['shipment_id']), json.dumps(shipment, ensure_ascii=False), now, now)
+            )
+
+    def pending(self, limit=50) -> List[Tuple[str, dict, int]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT shipment_id, payload, attempts FROM shipments "
+                "WHERE status = ? AND next_attempt_at <= ? ORDER BY created_at LIMIT ?",
+                (STATUS_PENDING, time.time(), limit)
+            ).fetchall()
+        return [(shipment_id, json.loads(payload), attempts) for shipment_id, payload, attempts in rows]
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT (SELECT COUNT(*) FROM shipments WHERE status = ?) + "
+                "(SELECT COUNT(*) FROM shipment_updates WHERE status = ?)", (STATUS_PENDING, STATUS_PENDING)
+            ).fetchone()[0]
+
+    def record_update(self, shipment_id, kind, payload: dict):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO shipment_updates (shipment_id, kind, payload, created_at, next_attempt_at) VALUES (?, ?, ?, ?, ?)",
+                (str(shipment_id), kind, json.dumps(payload, ensure_ascii=False), now, now)
+            )
+
+    def pending_updates(self, limit=50) -> List[Tuple[int, str, str, dict, int]]:
+        # Изменение переносится, только когда сама отгрузка уже в таблице
+        # и все более ранние изменения этой отгрузки перенесены
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT u.id, u.shipment_id, u.kind, u.payload, u.attempts FROM shipment_updates u "
+                "WHERE u.status = ? AND u.next_attempt_at <= ? "
+                "AND NOT EXISTS (SELECT 1 FROM shipments s WHERE s.shipment_id = u.shipment_id AND s.status = ?) "
+                "AND NOT EXISTS (SELECT 1 FROM shipment_updates e WHERE e.shipment_id = u.shipment_id "
+                "AND e.status = ? AND e.id < u.id) "
+                "ORDER BY u.id LIMIT ?",
+                (STATUS_PENDING, time.time(), STATUS_PENDING, STATUS_PENDING, limit)
+            ).fetchall()
+        return [(update_id, shipment_id, kind, json.loads(payload), attempts)
+                for update_id, shipment_id, kind, payload, attempts in rows]
+
+    def procurements_before(self, shipment_id, update_id) -> int:
+        # Сколько строк закупок отгрузки должно быть в таблице до этого изменения
+        with self._lock:
+            row = self._conn.execute("SELECT payload FROM shipments WHERE shipment_id = ?", (shipment_id,)).fetchone()
+            added = self._conn.execute(
+                "SELECT COUNT(*) FROM shipment_updates WHERE shipment_id = ? AND kind = 'procurement' "
+                "AND status = ? AND id < ?", (shipment_id, STATUS_STORED, update_id)
+            ).fetchone()[0]
+        procurements = json.loads(row[0]).get('procurements') if row else None
+        if isinstance(procurements, dict):
+            procurements = [procurements]
+        return len(procurements or []) + added
+
+    def mark_update_stored(self, update_id):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE shipment_updates SET status = ?, last_error = NULL WHERE id = ?", (STATUS_STORED, update_id)
+            )
+
+    def mark_update_attempt(self, update_id):
+        with self._lock:
+            self._conn.execute("UPDATE shipment_updates SET attempts = attempts + 1 WHERE id = ?", (update_id,))
+
+    def mark_update_failed(self, update_id, error, retry_in):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE shipment_updates SET last_error = ?, next_attempt_at = ? WHERE id = ?",
+                (str(error), time.time() + retry_in, update_id)
+            )
+
+    def mark_stored(self, shipment_id):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE shipments SET status = ?, last_error = NULL WHERE shipment_id = ?",
+                (STATUS_STORED, shipment_id)
+            )
+
+    def mark_attempt(self, shipment_id):
+        # Попытка засчитывается до записи в таблицу: если процесс упадёт после записи, но до mark_stored,
+        # следующая попытка пойдёт с resume=True и не задвоит строки
+        with self._lock:
+            self._conn.execute("UPDATE shipments SET attempts = attempts + 1 WHERE shipment_id = ?", (shipment_id,))
+
+    def mark_failed(self, shipment_id, error, retry_in):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE shipments SET last_error = ?, next_attempt_at = ? WHERE shipment_id = ?",
+                (str(error), time.time() + retry_in, shipment_id)
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# Переносит записи журнала в хранилище. store(shipment, resume) должна быть идемпотентной:
+# при resume=True предыдущая попытка могла успеть записать часть строк.
+# apply_update(shipment_id, kind, payload, written_before) переносит изменения сохранённых отгрузок;
+# written_before - число строк закупок отгрузки до этого изменения, передаётся только при повторе.
+class JournalReplayer:
+    def __init__(self, journal: ShipmentJournal, store: Callable[[dict, bool], None],
+                 apply_update: Callable[[str, str, dict, Optional[int]], None] = None,
+                 interval=5.0, batch_size=50, max_backoff=300.0):
+        self.journal = journal
+        self.store = store
+        self.apply_update = apply_update
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_backoff = max_backoff
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='journal-replayer', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def wake(self):
+        self._wakeup.set()
+
+    def replay_once(self) -> int:
+        stored = 0
+        for shipment_id, shipment, attempts in self.journal.pending(self.batch_size):
+            if self._stopped.is_set():
+                break
+            if attempts > 0:
+                RETRIES.labels(operation='journal_replay').inc()
+            self.journal.mark_attempt(shipment_id)
+            try:
+                with STAGE_SECONDS.labels(stage='journal_replay').time():
+                    self.store(shipment, attempts > 0)
+            except Exception as e:
+                ERRORS.labels(stage='journal_replay').inc()
+                retry_in = min(self.max_backoff, self.interval * 2 ** attempts)
+                logger.error(f"Error replaying shipment {shipment_id}, retry in {retry_in:.0f}s: {str(e)}")
+                self.journal.mark_failed(shipment_id, e, retry_in)
+                continue
+            self.journal.mark_stored(shipment_id)
+            stored += 1
+        if self.apply_update is not None:
+            stored += self._replay_updates()
+        return stored
+
+    def _replay_updates(self) -> int:
+        stored = 0
+        for update_id, shipment_id, kind, payload, attempts in self.journal.pending_updates(self.batch_size):
+            if self._stopped.is_set():
+                break
+            written_before = None
+            if attempts > 0:
+                RETRIES.labels(operation='journal_replay').inc()
+                written_before = self.journal.procurements_before(shipment_id, update_id)
+            self.journal.mark_update_attempt(update_id)
+            try:
+                with STAGE_SECONDS.labels(stage='journal_replay').time():
+                    self.apply_update(shipment_id, kind, payload, written_before)
+            except Exception as e:
+                ERRORS.labels(stage='journal_replay').inc()
+                retry_in = min(self.max_backoff, self.interval * 2 ** attempts)
+                logger.error(f"Error replaying {kind} update of shipment {shipment_id}, retry in {retry_in:.0f}s: {str(e)}")
+                self.journal.mark_update_failed(update_id, e, retry_in)
+                continue
+            self.journal.mark_update_stored(update_id)
+            stored += 1
+        return stored
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                stored = self.replay_once()
+                if stored:
+                    logger.info(f"Replayed {stored} shipments from journal")
+            except Exception as e:
+                logger.error(f"Error reading shipment journal: {str(e)}")
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
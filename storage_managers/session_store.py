@@ -0,0 +1,188 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+import logging
+logger = logging.getLogger(__name__)
+
+IDLE_STATE = 'idle'
+
+
+# Состояние диалога одного пользователя
+class Session:
+    __slots__ = (
+        'user_id',
+        'state',
+        'shipments',
+        'current_shipment_index',
+        'shipment_index',
+        'current_field',
+        'procurement',
+        'shipment_id',
+        'card_message_id',
+        'last_active',
+    )
+
+    def __init__(self, user_id, state=IDLE_STATE):
+        self.user_id = user_id
+        self.state = state
+        self.shipments: List[dict] = []
+        self.current_shipment_index = 0
+        # Индекс отгрузки, с которой сейчас работает пользователь (подтверждение, исправление, закупки)
+        self.shipment_index: Optional[int] = None
+        self.current_field: Optional[str] = None
+        self.procurement: dict = {}
+        self.shipment_id: Optional[str] = None
+        # Сообщение с карточкой подтверждения текущей отгрузки, оно редактируется на месте
+        self.card_message_id: Optional[int] = None
+        self.last_active = time.time()
+
+    @property
+    def shipment(self) -> Optional[dict]:
+        if self.shipment_index is None or not 0 <= self.shipment_index < len(self.shipments):
+            return None
+        return self.shipments[self.shipment_index]
+
+    def is_empty(self) -> bool:
+        # В состоянии idle данные прошлого диалога уже не нужны
+        return self.state == IDLE_STATE
+
+    def to_json(self) -> str:
+        return json.dumps({
+            'state': self.state,
+            'shipments': self.shipments,
+            'current_shipment_index': self.current_shipment_index,
+            'shipment_index': self.shipment_index,
+            'current_field': self.current_field,
+            'procurement': self.procurement,
+            'shipment_id': self.shipment_id,
+            'card_message_id': self.card_message_id,
+        }, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, user_id, payload: str, last_active: float) -> 'Session':
+        data = json.loads(payload)
+        session = cls(user_id, data.get('state', IDLE_STATE))
+        session.shipments = data.get('shipments') or []
+        session.current_shipment_index = data.get('current_shipment_index', 0)
+        session.shipment_index = data.get('shipment_index')
+        session.current_field = data.get('current_field')
+        session.procurement = data.get('procurement') or {}
+        session.shipment_id = data.get('shipment_id')
+        session.card_message_id = data.get('card_message_id')
+        session.last_active = last_active
+        return session
+
+
+# Активные сессии держатся в памяти, все незавершённые - в SQLite.
+# Сессии, неактивные дольше idle_timeout, сохраняются и выгружаются из памяти.
+class SessionStore:
+    def __init__(self, path, idle_timeout=1800.0):
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self._sessions: Dict[int, Session] = {}
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                user_id INTEGER PRIMARY KEY,
+                payload TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._stopped = threading.Event()
+        self._evictor = None
+
+    def _load(self, user_id) -> Optional[Session]:
+        row = self._conn.execute(
+            "SELECT payload, updated_at FROM sessions WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        try:
+            return Session.from_json(user_id, row[0], row[1])
+        except (ValueError, TypeError) as e:
+            logger.error(f"Broken session record for user {user_id}: {str(e)}")
+            return None
+
+    def get(self, user_id) -> Session:
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is None:
+                session = self._load(user_id) or Session(user_id)
+                self._sessions[user_id] = session
+            session.last_active = time.time()
+            return session
+
+    __getitem__ = get
+
+    def __contains__(self, user_id) -> bool:
+        with self._lock:
+            if user_id in self._sessions:
+                return True
+            return self._conn.execute(
+                "SELECT 1 FROM sessions WHERE user_id = ?", (user_id,)
+            ).fetchone() is not None
+
+    def save(self, session: Session):
+        with self._lock:
+            if session.is_empty():
+                # Закончившие диалог пользователи не занимают места и на диске
+                self._conn.execute("DELETE FROM sessions WHERE user_id = ?", (session.user_id,))
+            else:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO sessions (user_id, payload, updated_at) VALUES (?, ?, ?)",
+                    (session.user_id, session.to_json(), session.last_active)
+                )
+
+    def save_user(self, user_id):
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is not None:
+                self.save(session)
+
+    def evict_idle(self, idle_timeout=None) -> int:
+        idle_timeout = self.idle_timeout if idle_timeout is None else idle_timeout
+        deadline = time.time() - idle_timeout
+        with self._lock:
+            idle = [session for session in self._sessions.values() if session.last_active < deadline]
+            for session in idle:
+                self.save(session)
+                del self._sessions[session.user_id]
+        return len(idle)
+
+    def flush(self):
+        # Сохраняет и выгружает все сессии, например перед остановкой процесса
+        with self._lock:
+            for session in self._sessions.values():
+                self.save(session)
+            self._sessions.clear()
+
+    @property
+    def active_count(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+    def start_evictor(self, interval=60.0):
+        def run():
+            while not self._stopped.wait(interval):
+                try:
+                    evicted = self.evict_idle()
+                    if evicted:
+                        logger.info(f"Evicted {evicted} idle sessions, {self.active_count} active")
+                except Exception as e:
+                    logger.error(f"Error evicting sessions: {str(e)}")
+
+        if self._evictor is None:
+            self._evictor = threading.Thread(target=run, name='session-evictor', daemon=True)
+            self._evictor.start()
+
+    def close(self):
+        self._stopped.set()
+        self.flush()
+        with self._lock:
+            self._conn.close()
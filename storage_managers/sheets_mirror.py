@@ -0,0 +1,299 @@
+import io
+import json
+import os
+import re
+import threading
+import time
+from datetime import date
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from monitoring.metrics import STAGE_SECONDS, ERRORS
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Колонки, которые дополнительно хранятся числом (<колонка>_num) и датой (<колонка>_day)
+NUMERIC_COLUMNS = ('good_volume', 'good_price', 'shipment_count', 'shipment_cost', 'supply_cost')
+DATE_COLUMNS = ('shipment_date',)
+
+# "4 850,50 руб." -> 4850.5, "7000-7500" -> 7250, "1 куб" -> 1
+_number = r'\d+(?:[ \u00a0]\d{3})*(?:[.,]\d+)?'
+_number_re = re.compile(rf'({_number})(?:\s*[-–—]\s*({_number}))?')
+_date_re = re.compile(r'(\d{1,2})[.\-/](\d{1,2})[.\-/](\d{2,4})')
+
+
+def _to_float(text: str) -> float:
+    return float(text.replace(' ', '').replace('\u00a0', '').replace(',', '.'))
+
+
+def parse_number(value: str) -> float:
+    match = _number_re.search(value or '')
+    if match is None:
+        return np.nan
+    low = _to_float(match.group(1))
+    # Диапазон "7000-7500 руб." считаем по середине
+    return (low + _to_float(match.group(2))) / 2 if match.group(2) else low
+
+
+def parse_date(value: str) -> np.datetime64:
+    match = _date_re.search(value or '')
+    if match is None:
+        return np.datetime64('NaT', 'D')
+    day, month, year = (int(part) for part in match.groups())
+    if year < 100:
+        year += 2000
+    try:
+        return np.datetime64(date(year, month, day), 'D')
+    except ValueError:
+        return np.datetime64('NaT', 'D')
+
+
+# Лист в колоночном виде: по массиву numpy на колонку. Строковые колонки - как в таблице,
+# для чисел и дат - разобранные копии.
+class SheetTable:
+    def __init__(self, headers: List[str] = None, columns: Dict[str, np.ndarray] = None, synced_rows: int = 0):
+        self.headers = headers or []
+        self.columns = columns if columns is not None else self._empty_columns(self.headers)
+        self.synced_rows = synced_rows
+
+    @staticmethod
+    def _empty_columns(headers):
+        columns = {header: np.array([], dtype=str) for header in headers}
+        for header in headers:
+            if header in NUMERIC_COLUMNS:
+                columns[f'{header}_num'] = np.array([], dtype=np.float64)
+            if header in DATE_COLUMNS:
+                columns[f'{header}_day'] = np.array([], dtype='datetime64[D]')
+        return columns
+
+    def __len__(self):
+        return self.synced_rows
+
+    def column(self, name) -> np.ndarray:
+        if name in self.columns:
+            return self.columns[name]
+        if name.endswith('_num'):
+            return np.full(self.synced_rows, np.nan)
+        if name.endswith('_day'):
+            return np.full(self.synced_rows, np.datetime64('NaT'), dtype='datetime64[D]')
+        return np.full(self.synced_rows, '', dtype=str)
+
+    def appended(self, rows: List[List[str]]) -> 'SheetTable':
+        # Новый снимок с дописанными строками: читатели старого снимка работают без блокировок
+        width = len(self.headers)
+        rows = [[str(value) for value in row[:width]] + [''] * (width - len(row)) for row in rows]
+        columns = {}
+        for index, header in enumerate(self.headers):
+            values = [row[index].strip() for row in rows]
+            columns[header] = np.concatenate([self.columns[header], np.array(values, dtype=str)])
+            if header in NUMERIC_COLUMNS:
+                parsed = np.array([parse_number(value) for value in values], dtype=np.float64)
+                columns[f'{header}_num'] = np.concatenate([self.columns[f'{header}_num'], parsed])
+            if header in DATE_COLUMNS:
+                parsed = np.array([parse_date(value) for value in values], dtype='datetime64[D]')
+                columns[f'{header}_day'] = np.concatenate([self.columns[f'{header}_day'], parsed])
+        return SheetTable(self.headers, columns, self.synced_rows + len(rows))
+
+    def save(self, path):
+        buffer = io.BytesIO()
+        meta = json.dumps({'headers': self.headers, 'synced_rows': self.synced_rows}, ensure_ascii=False)
+        np.savez(buffer, __meta__=np.array(meta), **self.columns)
+        # Файл подменяется целиком: при падении посреди записи остаётся прошлый снимок
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(buffer.getvalue())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path) -> Optional['SheetTable']:
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data['__meta__']))
+            columns = {name: data[name] for name in data.files if name != '__meta__'}
+        return cls(meta['headers'], columns, meta['synced_rows'])
+
+
+# Локальная копия листов Google Sheets. sync() забирает только строки, дописанные после прошлой
+# синхронизации; отчёты считаются по копии и никогда не читают таблицу.
+class SheetsMirror:
+    def __init__(self, stores: dict, directory, interval=300.0, full_interval=3600.0):
+        self.stores = stores
+        self.directory = directory
+        self.interval = interval
+        self.full_interval = full_interval
+        # Когда лист последний раз перечитывался целиком; первая синхронизация после старта - полная
+        self._full_synced_at: Dict[str, float] = {}
+        self._tables: Dict[str, SheetTable] = {}
+        self._loaded_at: Dict[str, float] = {}
+        self._sync_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.follow = False
+        os.makedirs(directory, exist_ok=True)
+        for name in stores:
+            try:
+                self._tables[name] = SheetTable.load(self._path(name)) or SheetTable()
+            except Exception as e:
+                logger.error(f"Error loading mirror of {name}, it will be rebuilt: {str(e)}")
+                self._tables[name] = SheetTable()
+        self.synced_at = None
+
+    def _path(self, name):
+        return os.path.join(self.directory, f"{name}.npz")
+
+    def _stale_path(self, name):
+        return os.path.join(self.directory, f"{name}.stale")
+
+    def mark_stale(self, name):
+        # Строки листа исправлены на месте, дописанных строк sync() не увидит: следующая синхронизация
+        # перечитает лист целиком. Отметка - файл, её видит и процесс, который синхронизирует копию
+        with open(self._stale_path(name), 'w'):
+            pass
+
+    def table(self, name) -> SheetTable:
+        return self._tables[name]
+
+    def sync(self, full=False) -> Dict[str, int]:
+        appended = {}
+        with self._sync_lock:
+            for name, store in self.stores.items():
+                stale = self._take_stale(name)
+                last_full = self._full_synced_at.get(name)
+                table_full = full or stale or last_full is None or (
+                    self.full_interval > 0 and time.time() - last_full >= self.full_interval
+                )
+                try:
+                    with STAGE_SECONDS.labels(stage='mirror_sync').time():
+                        appended[name] = self._sync_table(name, store, table_full)
+                except Exception:
+                    if table_full:
+                        self.mark_stale(name)
+                    raise
+                if table_full:
+                    self._full_synced_at[name] = time.time()
+            self.synced_at = time.time()
+        return appended
+
+    def _take_stale(self, name) -> bool:
+        # Отметка снимается до чтения листа: исправление во время синхронизации оставит новую
+        try:
+            os.remove(self._stale_path(name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _sync_table(self, name, store, full) -> int:
+        table = self._tables[name]
+        headers = store.get_headers()
+        if not headers:
+            return 0
+        if full or headers != table.headers:
+            if table.headers and headers != table.headers:
+                logger.info(f"Headers of {name} changed, rebuilding mirror")
+            table = SheetTable(headers)
+        rows = store.get_rows(table.synced_rows + 2, len(headers))
+        if not rows and table is self._tables[name]:
+            return 0
+        table = table.appended(rows)
+        table.save(self._path(name))
+        self._tables[name] = table
+        if rows:
+            logger.info(f"Mirrored {len(rows)} new rows of {name}, {len(table)} total")
+        return len(rows)
+
+    def reload(self) -> List[str]:
+        # Подхватывает снимки, записанные sync() другого процесса
+        reloaded = []
+        for name in self.stores:
+            path = self._path(name)
+            try:
+                mtime = os.path.getmtime(path) if os.path.exists(path) else None
+                if mtime is not None and mtime != self._loaded_at.get(name):
+                    self._tables[name] = SheetTable.load(path)
+                    self._loaded_at[name] = mtime
+                    reloaded.append(name)
+            except Exception as e:
+                logger.error(f"Error reloading mirror of {name}: {str(e)}")
+        return reloaded
+
+    def start(self, follow=False):
+        # follow=True - таблицу не читаем, только перечитываем файлы копии.
+        # Флаг можно снять на ходу: процесс, которому передали синхронизацию, начнёт читать таблицу сам
+        self.follow = follow
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='sheets-mirror', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if self.follow:
+                self._stopped.wait(min(self.interval, 30.0))
+                self.reload()
+                continue
+            try:
+                self.sync()
+            except Exception as e:
+                ERRORS.labels(stage='mirror_sync').inc()
+                logger.error(f"Error syncing sheets mirror: {str(e)}")
+            self._stopped.wait(self.interval)
+
+
+REPORT_GROUPS = {
+    'supplier': 'supplier',
+    'customer': 'customer_name',
+    'date': 'shipment_date_day',
+}
+
+
+def report(shipments: SheetTable, procurements: SheetTable, by='supplier', days: Optional[int] = None,
+           today: date = None, limit=30) -> List[dict]:
+    # Отгрузки (число, объём, сумма, доставка) и закупки (объём, стоимость) по поставщику, клиенту или дню
+    dates = shipments.column('shipment_date_day')
+    mask = np.ones(len(shipments), dtype=bool)
+    if days is not None:
+        since = np.datetime64(today or date.today(), 'D') - np.timedelta64(days - 1, 'D')
+        mask = dates >= since
+    keys = shipments.column(REPORT_GROUPS[by])[mask]
+    if by == 'date':
+        keys = np.where(np.isnat(keys), '', np.datetime_as_string(keys, unit='D'))
+    procurement_keys = np.array([], dtype=str)
+    procurement_mask = np.zeros(len(procurements), dtype=bool)
+    if by == 'supplier' and len(procurements):
+        # Закупки относятся к периоду через дату своей отгрузки
+        procurement_mask = np.isin(procurements.column('shipment_id'), shipments.column('shipment_id')[mask])
+        procurement_keys = procurements.column('supplier')[procurement_mask]
+
+    groups, inverse = np.unique(np.concatenate([keys, procurement_keys]), return_inverse=True)
+    shipment_index, procurement_index = inverse[:len(keys)], inverse[len(keys):]
+
+    def total(index, values):
+        return np.bincount(index, weights=np.nan_to_num(values), minlength=len(groups))
+
+    volume = shipments.column('good_volume_num')[mask]
+    counts = np.bincount(shipment_index, minlength=len(groups))
+    volumes = total(shipment_index, volume)
+    amounts = total(shipment_index, volume * shipments.column('good_price_num')[mask])
+    deliveries = total(shipment_index, shipments.column('shipment_cost_num')[mask])
+    purchased = total(procurement_index, procurements.column('good_volume_num')[procurement_mask])
+    supply_costs = total(procurement_index, procurements.column('supply_cost_num')[procurement_mask])
+
+    order = np.arange(len(groups))[::-1] if by == 'date' else np.argsort(-(amounts + deliveries + supply_costs), kind='stable')
+    return [{
+        'key': str(groups[i]),
+        'shipments': int(counts[i]),
+        'volume': float(volumes[i]),
+        'amount': float(amounts[i]),
+        'delivery': float(deliveries[i]),
+        'purchased': float(purchased[i]),
+        'supply_cost': float(supply_costs[i]),
+    } for i in order[:limit]]
@@ -1,3 +1,4 @@
+import bisect
 import re
 
 #def escape_markdown_v2(text):
@@ -43,50 +44,109 @@ def escape_markdown_v2_old(text):
 
     return ''.join(result)
 
+# Символы, которые MarkdownV2 требует экранировать вне разметки
+ESCAPE_TABLE = str.maketrans({char: '\\' + char for char in '_*[]()~`>#+-=|{}.!'})
+# Символы, с которых может начинаться конструкция разметки
+MARKUP_START_RE = re.compile(r'[`*_~|\[!]')
+EMOJI_LINK_PREFIX = '](tg://emoji?id='
+
+
+class _DelimiterFinder:
+    # str.find с запоминанием: поиск идёт только вперёд, поэтому найденная позиция
+    # остаётся ответом, пока начало поиска её не обогнало. Весь проход - O(n).
+    def __init__(self, text):
+        self.text = text
+        self._found = {}
+
+    def find(self, delimiter, start):
+        cached = self._found.get(delimiter)
+        if cached is not None:
+            searched_from, index = cached
+            if searched_from <= start and (index == -1 or index >= start):
+                return index
+        index = self.text.find(delimiter, start)
+        self._found[delimiter] = (start, index)
+        return index
+
+
+def _markup_end(text, i, finder):
+    # Конец конструкции разметки, начинающейся в позиции i, или -1.
+    # Порядок проверок повторяет порядок шаблонов: inline code, code block, bold, italic, underline,
+    # strikethrough, spoiler, link (ссылки и упоминания), custom emoji.
+    char = text[i]
+    following = text[i + 1:i + 2]
+    if char == '`':
+        end = finder.find('`', i + 1)
+        if end > i + 1:
+            return end + 1
+        if text.startswith('```', i):
+            end = finder.find('```', i + 3)
+            if end != -1:
+                return end + 3
+    elif char == '*':
+        if following == '*':
+            end = finder.find('*', i + 2)
+            if end > i + 2 and text.startswith('**', end):
+                return end + 2
+    elif char == '_':
+        end = finder.find('_', i + 1)
+        if end > i + 1:
+            return end + 1
+        if following == '_':
+            end = finder.find('_', i + 2)
+            if end > i + 2 and text.startswith('__', end):
+                return end + 2
+    elif char == '~':
+        end = finder.find('~', i + 1)
+        if end > i + 1:
+            return end + 1
+    elif char == '|':
+        if following == '|':
+            end = finder.find('|', i + 2)
+            if end > i + 2 and text.startswith('||', end):
+                return end + 2
+    elif char == '[':
+        close = finder.find(']', i + 1)
+        if close > i + 1 and text.startswith('(', close + 1):
+            end = finder.find(')', close + 2)
+            if end > close + 2:
+                return end + 1
+    elif char == '!':
+        if following == '[':
+            close = finder.find(']', i + 2)
+            if close != -1 and text.startswith(EMOJI_LINK_PREFIX, close):
+                digits_start = close + len(EMOJI_LINK_PREFIX)
+                digits_end = digits_start
+                while digits_end < len(text) and text[digits_end].isdecimal():
+                    digits_end += 1
+                if digits_end > digits_start and text.startswith(')', digits_end):
+                    return digits_end + 1
+    return -1
+
+
 def escape_markdown_v2(text):
-    # Define the special characters that need to be escaped
-    special_chars = r'([_*\[\]()~`>#+\-=|{}.!])'
-
-    # Patterns to identify Markdown constructs
-    patterns = {
-        'inline_code': r'(`[^`]+`)',  # Inline code
-        'code_block': r'(```[\s\S]*?```)',  # Code block
-        'bold': r'(\*\*[^*]+\*\*)',
-        'italic': r'(_[^_]+_)',
-        'underline': r'(__[^_]+__)',
-        'strikethrough': r'(~[^~]+~)',
-        'spoiler': r'(\|\|[^|]+\|\|)',
-        'link': r'(\[([^\]]+)\]\(([^)]+)\))',  # Links
-        'mention': r'(\[([^\]]+)\]\((tg://user\?id=\d+)\))',  # User mentions
-        'custom_emoji': r'(!\[[^\]]*\]\(tg://emoji\?id=\d+\))',  # Custom emojis
-        # Add more patterns as needed
-    }
-
-    # Combine all patterns into one regex
-    combined_pattern = '|'.join(patterns.values())
-
-    # Split the text into segments: those that match Markdown constructs and those that don't
-    segments = re.split(f'({combined_pattern})', text)
-
-    escaped_segments = []
-    for segment in segments:
-        if not segment:
+    # Один проход слева направо: конструкции разметки (код, блоки кода, жирный, курсив, подчёркнутый,
+    # зачёркнутый, спойлер, ссылки, упоминания, custom emoji) остаются как есть, остальной текст экранируется.
+    finder = _DelimiterFinder(text)
+    parts = []
+    plain_start = 0
+    pos = 0
+    while True:
+        match = MARKUP_START_RE.search(text, pos)
+        if match is None:
+            break
+        i = match.start()
+        end = _markup_end(text, i, finder)
+        if end == -1:
+            pos = i + 1
             continue
-        # Check if the segment matches any Markdown construct
-        is_markdown = False
-        for pattern in patterns.values():
-            if re.fullmatch(pattern, segment):
-                is_markdown = True
-                break
-        if is_markdown:
-            # Do not escape Markdown constructs
-            escaped_segments.append(segment)
-        else:
-            # Escape special characters in non-Markdown segments
-            escaped = re.sub(special_chars, r'\\\1', segment)
-            escaped_segments.append(escaped)
-
-    return ''.join(escaped_segments)
+        if plain_start < i:
+            parts.append(text[plain_start:i].translate(ESCAPE_TABLE))
+        parts.append(text[i:end])
+        plain_start = pos = end
+    if plain_start < len(text):
+        parts.append(text[plain_start:].translate(ESCAPE_TABLE))
+    return ''.join(parts)
 
 def escape_markdown_v3(text):
     # Characters that need escaping in most contexts
@@ -177,13 +237,16 @@ def escape_markdown_v3(text):
 
     return ''.join(result)
 
+TABLE_SEPARATOR_RE = re.compile(r'^[\s\|\-]+$')
+TABLE_RE = re.compile(r'\n(\|.+\|\n\|[-\s|]+\|\n(?:\|.+\|\n)+)')
+
 def format_table_as_list(table_text):
     lines = table_text.strip().split('\n')
     if len(lines) < 3:
         return table_text  # Not enough lines for a table
 
     # Check if the second line contains only dashes and pipes
-    if not re.match(r'^[\s\|\-]+$', lines[1]):
+    if not TABLE_SEPARATOR_RE.match(lines[1]):
         return table_text  # Not a table
 
     headers = [cell.strip() for cell in lines[0].split('|') if cell.strip()]
@@ -205,29 +268,146 @@ def format_table_as_list(table_text):
 
     return '\n\n'.join(formatted_output)
 
-def split_string(text, max_length=4096):
-    chunks = []
-    lines = text.split('\n')
-    current_chunk = ""
+TELEGRAM_MESSAGE_LIMIT = 4096
+CODE_FENCE = '```'
+CODE_FENCE_LINE_RE = re.compile(r'^```[\w+-]*$')
+# Однострочные сущности MarkdownV2, внутри которых длинную строку резать нельзя
+INLINE_ENTITY_RE = re.compile(
+    r'!?\[(?:\\.|[^\]\\])*\]\((?:\\.|[^)\\])*\)'  # ссылки, упоминания, custom emoji
+    r'|`(?:\\.|[^`\\])*`'  # inline code
+    r'|(\|\||__|[*_~])(?:\\.|(?!\1)[^\\])+?\1'  # жирный, курсив, подчёркнутый, зачёркнутый, спойлер
+)
+
+
+def _iter_lines(pieces):
+    # Склеивает поток кусков текста в строки, не дожидаясь конца потока
+    partial = []
+    for piece in pieces:
+        lines = piece.split('\n')
+        if len(lines) == 1:
+            partial.append(piece)
+            continue
+        partial.append(lines[0])
+        yield ''.join(partial)
+        yield from lines[1:-1]
+        partial = [lines[-1]]
+    yield ''.join(partial)
+
+
+def _code_fence(line):
+    # Граница блока кода: строка "```" или "```python" целиком, либо строка с нечётным числом ```.
+    # Возвращает то, чем блок открывается заново в следующем куске - только ``` и язык
+    stripped = line.strip()
+    if CODE_FENCE_LINE_RE.match(stripped):
+        return stripped
+    if stripped.count(CODE_FENCE) % 2:
+        return CODE_FENCE
+    return None
+
+
+def _span_at(spans, starts, pos):
+    index = bisect.bisect_left(starts, pos) - 1
+    if index >= 0 and spans[index][0] < pos < spans[index][1]:
+        return spans[index]
+    return None
+
+
+def _safe_cut(line, start, end, spans, starts):
+    # Последний пробел вне сущностей, иначе начало сущности, которую пересекает лимит, иначе жёсткий разрез
+    pos = end
+    while pos > start + 1:
+        space = line.rfind(' ', start + 1, pos)
+        if space == -1:
+            break
+        span = _span_at(spans, starts, space)
+        if span is None:
+            return space + 1
+        pos = span[0]
+    span = _span_at(spans, starts, end)
+    if span is not None and span[0] > start:
+        return span[0]
+    cut = end
+    # Не отрываем обратный слэш от экранируемого символа
+    slashes = 0
+    while cut - slashes - 1 > start and line[cut - slashes - 1] == '\\':
+        slashes += 1
+    return cut - 1 if slashes % 2 else cut
+
+
+def _split_long_line(line, limit, in_code):
+    if len(line) <= limit:
+        return [line]
+    spans = [] if in_code else [match.span() for match in INLINE_ENTITY_RE.finditer(line)]
+    starts = [span[0] for span in spans]
+    parts = []
+    start = 0
+    while len(line) - start > limit:
+        cut = _safe_cut(line, start, start + limit, spans, starts)
+        parts.append(line[start:cut])
+        start = cut
+    parts.append(line[start:])
+    return parts
+
+
+def iter_chunks(text, max_length=TELEGRAM_MESSAGE_LIMIT):
+    # text - строка или поток кусков строки (например, ответ LLM по мере генерации).
+    # Отдаёт готовые к отправке куски не длиннее max_length, как только кусок заполнен.
+    # Строки режутся по пробелам вне сущностей разметки, блок кода закрывается в конце куска
+    # и открывается заново в начале следующего.
+    pieces = [text] if isinstance(text, str) else text
+    chunk = []
+    size = 0
+    fence = None
+
+    def finish():
+        if fence is not None and chunk and chunk[-1].strip() == fence:
+            # Блок кода только что открылся: его первая строка уходит в следующий кусок
+            return '\n'.join(chunk[:-1]).strip()
+        result = '\n'.join(chunk)
+        if fence is not None:
+            result += '\n' + CODE_FENCE
+        return result.strip()
+
+    for line in _iter_lines(pieces):
+        line_fence = _code_fence(line)
+        is_fence = line_fence is not None
+        # Место под закрывающий ``` нужно, пока мы внутри блока кода или открываем его этой строкой.
+        # Если строка с ``` режется на части, куски до последней части ещё могут оказаться внутри блока
+        closing = len(CODE_FENCE) + 1
+        line_reserve = closing if (fence is not None) != is_fence else 0
+        part_reserve = closing if fence is not None or is_fence else 0
+        limit = max_length - part_reserve - (len(fence) + 1 if fence is not None else 0)
+        parts = _split_long_line(line, max(1, limit), fence is not None)
+        for number, part in enumerate(parts):
+            reserve = line_reserve if number == len(parts) - 1 else part_reserve
+            needed = len(part) + (1 if chunk else 0)
+            if chunk and size + needed + reserve > max_length:
+                ready = finish()
+                if ready:
+                    yield ready
+                chunk = [fence] if fence is not None else []
+                size = len(fence) if fence is not None else 0
+                needed = len(part) + (1 if chunk else 0)
+            chunk.append(part)
+            size += needed
+        if is_fence:
+            if fence is not None:
+                fence = None
+            else:
+                # Если язык с ``` не помещается в кусок рядом со строкой кода, открываем блок без него
+                fence = line_fence if len(line_fence) + len(CODE_FENCE) + 3 <= max_length else CODE_FENCE
 
-    for line in lines:
-        if len(current_chunk) + len(line) + 1 > max_length:
-            chunks.append(current_chunk.strip())
-            current_chunk = line
-        else:
-            if current_chunk:
-                current_chunk += '\n'
-            current_chunk += line
+    ready = finish()
+    if ready:
+        yield ready
 
-    if current_chunk:
-        chunks.append(current_chunk.strip())
 
-    return chunks
+def split_string(text, max_length=TELEGRAM_MESSAGE_LIMIT):
+    return list(iter_chunks(text, max_length))
 
 def process_text_with_tables(text):
     # Find all tables in the text
-    table_pattern = r'\n(\|.+\|\n\|[-\s|]+\|\n(?:\|.+\|\n)+)'
-    table_matches = list(re.finditer(table_pattern, text))
+    table_matches = list(TABLE_RE.finditer(text))
     
     if not table_matches:
         return text
@@ -0,0 +1,29 @@
+import re
+
+# Эталон: те же шаблоны, что были в escape_markdown_v2 до однопроходного сканера, но через finditer.
+# re.split с вложенными группами дублировал найденные конструкции, поэтому сравниваем с задуманным поведением.
+REFERENCE_PATTERNS = (
+    r'`[^`]+`',
+    r'```[\s\S]*?```',
+    r'\*\*[^*]+\*\*',
+    r'_[^_]+_',
+    r'__[^_]+__',
+    r'~[^~]+~',
+    r'\|\|[^|]+\|\|',
+    r'\[[^\]]+\]\([^)]+\)',
+    r'\[[^\]]+\]\(tg://user\?id=\d+\)',
+    r'!\[[^\]]*\]\(tg://emoji\?id=\d+\)',
+)
+REFERENCE_RE = re.compile('|'.join(f'(?:{pattern})' for pattern in REFERENCE_PATTERNS))
+REFERENCE_SPECIAL_RE = re.compile(r'([_*\[\]()~`>#+\-=|{}.!])')
+
+
+def escape_reference(text):
+    parts = []
+    last = 0
+    for match in REFERENCE_RE.finditer(text):
+        parts.append(REFERENCE_SPECIAL_RE.sub(r'\\\1', text[last:match.start()]))
+        parts.append(match.group(0))
+        last = match.end()
+    parts.append(REFERENCE_SPECIAL_RE.sub(r'\\\1', text[last:]))
+    return ''.join(parts)
@@ -0,0 +1,94 @@
+import pytest
+
+from storage_managers.journal import ShipmentJournal, JournalReplayer
+
+
+class FakeSheet:
+    # Идемпотентная запись как store_shipment_idempotent: при resume=True уже записанные строки пропускаются
+    def __init__(self):
+        self.rows = []
+        self.updates = []
+
+    def store(self, shipment, resume):
+        if resume and shipment['shipment_id'] in self.rows:
+            return
+        self.rows.append(shipment['shipment_id'])
+
+    def apply_update(self, shipment_id, kind, payload, written_before):
+        if written_before is not None and len(self.updates) > written_before:
+            return
+        self.updates.append((shipment_id, kind))
+
+
+class Crash(BaseException):
+    pass
+
+
+def crash_after_store(journal, method):
+    # Процесс падает после записи в таблицу, но до отметки в журнале
+    def crash(*args):
+        raise Crash()
+    setattr(journal, method, crash)
+
+
+def test_replay_stores_and_marks(tmp_path):
+    journal = ShipmentJournal(str(tmp_path / 'journal.sqlite3'))
+    sheet = FakeSheet()
+    journal.record({'shipment_id': 's1'})
+    journal.record({'shipment_id': 's1'})
+    assert JournalReplayer(journal, sheet.store).replay_once() == 1
+    assert sheet.rows == ['s1']
+    assert journal.pending_count() == 0
+
+
+def test_crash_before_mark_stored_does_not_duplicate(tmp_path):
+    path = str(tmp_path / 'journal.sqlite3')
+    sheet = FakeSheet()
+    journal = ShipmentJournal(path)
+    journal.record({'shipment_id': 's1'})
+    crash_after_store(journal, 'mark_stored')
+    with pytest.raises(Crash):
+        JournalReplayer(journal, sheet.store).replay_once()
+    journal.close()
+
+    journal = ShipmentJournal(path)
+    assert JournalReplayer(journal, sheet.store).replay_once() == 1
+    assert sheet.rows == ['s1']
+    assert journal.pending_count() == 0
+
+
+def test_failed_store_is_retried_with_resume(tmp_path):
+    journal = ShipmentJournal(str(tmp_path / 'journal.sqlite3'))
+    calls = []
+
+    def store(shipment, resume):
+        calls.append(resume)
+        if len(calls) == 1:
+            raise RuntimeError('quota')
+
+    journal.record({'shipment_id': 's1'})
+    replayer = JournalReplayer(journal, store, interval=0)
+    assert replayer.replay_once() == 0
+    assert replayer.replay_once() == 1
+    assert calls == [False, True]
+
+
+def test_updates_wait_for_shipment_and_survive_crash(tmp_path):
+    path = str(tmp_path / 'journal.sqlite3')
+    sheet = FakeSheet()
+    journal = ShipmentJournal(path)
+    journal.record({'shipment_id': 's1'})
+    journal.record_update('s1', 'procurement', {'good': 'песок'})
+    assert journal.pending_updates() == []
+
+    crash_after_store(journal, 'mark_update_stored')
+    with pytest.raises(Crash):
+        JournalReplayer(journal, sheet.store, apply_update=sheet.apply_update).replay_once()
+    assert sheet.rows == ['s1']
+    assert sheet.updates == [('s1', 'procurement')]
+    journal.close()
+
+    journal = ShipmentJournal(path)
+    JournalReplayer(journal, sheet.store, apply_update=sheet.apply_update).replay_once()
+    assert sheet.updates == [('s1', 'procurement')]
+    assert journal.pending_count() == 0
@@ -0,0 +1,114 @@
+import json
+import threading
+import time
+
+import pytest
+
+from shipment_parser.llm_pool import LLMProvider, LLMRouter, LLMTimeout, LLMUnavailable
+
+ANSWER = json.dumps({'shipments': [{'good': 'бетон'}]}, ensure_ascii=False)
+
+
+class FakeAssistant:
+    # Вместо AIAssistantsLib: отвечает через delay секунд, answer может быть исключением
+    def __init__(self, calls, delay=0.0, answer=ANSWER):
+        self.calls = calls
+        self.delay = delay
+        self.answer = answer
+
+    def ask_question(self, text):
+        self.calls.append(text)
+        time.sleep(self.delay)
+        if isinstance(self.answer, Exception):
+            raise self.answer
+        return self.answer
+
+
+def provider(name, calls, concurrency=2, **kwargs):
+    return LLMProvider(name, lambda: FakeAssistant(calls, **kwargs), concurrency)
+
+
+def test_primary_answer_wins_without_backup():
+    primary_calls, backup_calls = [], []
+    router = LLMRouter([provider('primary', primary_calls), provider('backup', backup_calls)], hedge_delay=1.0)
+    assert router.ask('текст') == ANSWER
+    assert primary_calls == ['текст']
+    assert backup_calls == []
+
+
+@pytest.mark.parametrize('answer', [RuntimeError('500'), '{"shipments": "не список"}', 'не json'])
+def test_error_or_invalid_answer_falls_back_immediately(answer):
+    backup_calls = []
+    router = LLMRouter([provider('primary', [], answer=answer), provider('backup', backup_calls)], hedge_delay=10.0)
+    started = time.monotonic()
+    assert router.ask('текст') == ANSWER
+    assert backup_calls == ['текст']
+    assert time.monotonic() - started < 1.0
+
+
+def test_slow_primary_is_hedged():
+    backup_calls = []
+    router = LLMRouter([provider('primary', [], delay=2.0), provider('backup', backup_calls)], hedge_delay=0.1)
+    started = time.monotonic()
+    assert router.ask('текст') == ANSWER
+    assert backup_calls == ['текст']
+    assert time.monotonic() - started < 1.0
+
+
+def test_no_hedging_waits_for_primary():
+    backup_calls = []
+    router = LLMRouter([provider('primary', [], delay=0.3), provider('backup', backup_calls)],
+                       hedge=False, hedge_delay=0.05)
+    assert router.ask('текст') == ANSWER
+    assert backup_calls == []
+
+
+def test_hedge_delay_follows_observed_latency():
+    router = LLMRouter([provider('primary', [], delay=0.01)], hedge_min_samples=5, min_hedge_delay=0.2,
+                       hedge_delay=10.0)
+    primary = router.providers[0]
+    assert router.hedge_after(primary) == 10.0
+    for _ in range(5):
+        router.ask('текст')
+    assert router.hedge_after(primary) == 0.2
+
+
+def test_all_providers_failing():
+    router = LLMRouter([provider('primary', [], answer=RuntimeError('500')),
+                        provider('backup', [], answer=RuntimeError('503'))])
+    with pytest.raises(LLMUnavailable):
+        router.ask('текст')
+
+
+def test_deadline():
+    router = LLMRouter([provider('primary', [], delay=1.0)], timeout=0.1)
+    started = time.monotonic()
+    with pytest.raises(LLMTimeout):
+        router.ask('текст')
+    assert time.monotonic() - started < 0.5
+
+
+def test_provider_concurrency_is_bounded():
+    active, peak = [0], [0]
+    lock = threading.Lock()
+
+    class Counting(FakeAssistant):
+        def ask_question(self, text):
+            with lock:
+                active[0] += 1
+                peak[0] = max(peak[0], active[0])
+            try:
+                return super().ask_question(text)
+            finally:
+                with lock:
+                    active[0] -= 1
+
+    calls = []
+    router = LLMRouter([LLMProvider('primary', lambda: Counting(calls, delay=0.05), 2)], hedge=False)
+    threads = [threading.Thread(target=router.ask, args=('текст',)) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 6
+    assert peak[0] <= 2
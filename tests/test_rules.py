@@ -0,0 +1,34 @@
+import config
+from shipment_parser.rules import extract_shipments
+
+MESSAGE = "07-11-2024 14:00, {customer}, Ярославское шоссе 114, бетон М220 1 куб по 4850 руб., доставка 7000, {supplier}"
+
+
+def extract(customer='Мастер Строй', supplier='Евробетон'):
+    extraction = extract_shipments(MESSAGE.format(customer=customer, supplier=supplier))
+    return extraction.shipments[0], extraction.confidence
+
+
+def test_typical_message_takes_fast_path():
+    shipment, confidence = extract()
+    assert confidence >= config.RULES_CONFIDENCE_THRESHOLD
+    assert shipment['customer_name'] == 'Мастер Строй'
+    assert shipment['supplier'] == 'Евробетон'
+    assert shipment['good'] == 'бетон М220'
+
+
+def test_guessed_supplier_goes_to_llm():
+    shipment, confidence = extract(supplier='оплата наличными')
+    assert shipment['supplier'] == 'оплата наличными'
+    assert confidence < config.RULES_CONFIDENCE_THRESHOLD
+
+
+def test_guessed_customer_goes_to_llm():
+    shipment, confidence = extract(customer='срочно')
+    assert shipment['customer_name'] == 'срочно'
+    assert confidence < config.RULES_CONFIDENCE_THRESHOLD
+
+
+def test_customer_with_legal_form_is_trusted():
+    _, confidence = extract(customer='ООО «Ромашка»')
+    assert confidence >= config.RULES_CONFIDENCE_THRESHOLD
@@ -0,0 +1,51 @@
+from storage_managers.sheets_mirror import SheetsMirror
+
+
+class FakeStore:
+    # Лист: первая строка - заголовки
+    def __init__(self, rows):
+        self.rows = rows
+
+    def get_headers(self):
+        return self.rows[0]
+
+    def get_rows(self, first_row, width):
+        return [list(row) for row in self.rows[first_row - 1:]]
+
+
+def make_mirror(tmp_path, store, full_interval=0):
+    return SheetsMirror({'shipments': store}, str(tmp_path), interval=300, full_interval=full_interval)
+
+
+def test_sync_appends_only_new_rows(tmp_path):
+    store = FakeStore([['shipment_id', 'good'], ['s1', 'бетон']])
+    mirror = make_mirror(tmp_path, store)
+    mirror.sync()
+    store.rows.append(['s2', 'песок'])
+    assert mirror.sync() == {'shipments': 1}
+    assert list(mirror.table('shipments').column('good')) == ['бетон', 'песок']
+
+
+def test_corrected_row_is_resynced_after_mark_stale(tmp_path):
+    store = FakeStore([['shipment_id', 'good'], ['s1', 'бетон']])
+    mirror = make_mirror(tmp_path, store)
+    mirror.sync()
+    store.rows[1][1] = 'щебень'
+    mirror.sync()
+    assert list(mirror.table('shipments').column('good')) == ['бетон']
+
+    # Отметку может поставить другой процесс с тем же каталогом копии
+    make_mirror(tmp_path, store).mark_stale('shipments')
+    mirror.sync()
+    assert list(mirror.table('shipments').column('good')) == ['щебень']
+    assert len(mirror.table('shipments')) == 1
+
+
+def test_periodic_full_resync(tmp_path):
+    store = FakeStore([['shipment_id', 'good'], ['s1', 'бетон']])
+    mirror = make_mirror(tmp_path, store, full_interval=3600)
+    mirror.sync()
+    store.rows[1][1] = 'щебень'
+    mirror._full_synced_at['shipments'] -= 3600
+    mirror.sync()
+    assert list(mirror.table('shipments').column('good')) == ['щебень']
@@ -0,0 +1,32 @@
+import random
+
+import pytest
+
+from telegram_formatter import escape_markdown_v2
+from tests.markdown_reference import escape_reference
+
+ALPHABET = list('ab цд 1\n') + list('_*[]()~`>#+-=|{}.!') + ['```', '**', '__', '||', '](', 'tg://emoji?id=', '٣']
+
+
+def random_text(rng, length):
+    return ''.join(rng.choice(ALPHABET) for _ in range(length))
+
+
+@pytest.mark.parametrize('seed', range(4))
+def test_scanner_matches_reference_on_random_texts(seed):
+    rng = random.Random(seed)
+    for _ in range(5000):
+        text = random_text(rng, rng.randint(0, 60))
+        assert escape_markdown_v2(text) == escape_reference(text), text
+
+
+@pytest.mark.parametrize('text', [
+    '',
+    'Цена 4850 руб. (доставка 7000-7500 руб.)!',
+    '**Мастер Строй** на _Ярославское шоссе 114_',
+    '```python\ntotal = a * b\n```',
+    '[отчёт](https://example.com/report?id=42) и `shipments.xlsx`',
+    '[' * 200 + ']' + 'x' * 200,
+])
+def test_scanner_matches_reference_on_samples(text):
+    assert escape_markdown_v2(text) == escape_reference(text)
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from vrecog.audio import SAMPLE_RATE
+from vrecog.vad import FRAME_MS, _split_long, split_on_silence
+
+
+def speech_with_pauses(seconds=(2.0, 0.8, 3.0, 0.8, 1.5)):
+    # Чередование "речи" (шум) и тишины, начинается с речи
+    rng = np.random.default_rng(0)
+    parts = []
+    for index, length in enumerate(seconds):
+        samples = int(length * SAMPLE_RATE)
+        if index % 2 == 0:
+            parts.append(rng.normal(0, 0.3, samples).astype(np.float32))
+        else:
+            parts.append(np.zeros(samples, dtype=np.float32))
+    return np.concatenate(parts)
+
+
+@pytest.mark.parametrize('max_frames', [1, 2, 3, 10])
+def test_split_long_always_advances(max_frames):
+    energy = np.zeros(100, dtype=np.float32)
+    parts = _split_long(0, 100, energy, max_frames)
+    assert parts[0][0] == 0 and parts[-1][1] == 100
+    assert all(start < end for start, end in parts)
+    assert all(parts[index][1] == parts[index + 1][0] for index in range(len(parts) - 1))
+
+
+@pytest.mark.parametrize('max_chunk_seconds', [0.01, 0.5, 2.0, 30.0])
+def test_chunks_are_ordered_and_bounded(max_chunk_seconds):
+    audio = speech_with_pauses()
+    bounds = split_on_silence(audio, max_chunk_seconds=max_chunk_seconds, pad_ms=0)
+    assert bounds
+    max_samples = max(2, int(max_chunk_seconds * 1000) // FRAME_MS) * SAMPLE_RATE * FRAME_MS // 1000
+    for start, end in bounds:
+        assert 0 <= start < end <= len(audio)
+        assert end - start <= max_samples
+    assert all(bounds[index][1] <= bounds[index + 1][0] for index in range(len(bounds) - 1))
+
+
+def test_silence_has_no_chunks():
+    assert split_on_silence(np.zeros(SAMPLE_RATE * 2, dtype=np.float32)) == []
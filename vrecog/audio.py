@@ -0,0 +1,83 @@
+import subprocess
+import threading
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+SAMPLE_RATE = 16000
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class AudioDecodeError(RuntimeError):
+    pass
+
+
+class AudioTooLong(AudioDecodeError):
+    pass
+
+
+def decode_audio_bytes(data, sample_rate: int = SAMPLE_RATE, max_seconds: float = None) -> np.ndarray:
+    # OGG/Opus (или любой формат, который понимает ffmpeg) из памяти в float32 моно 16 кГц без временных файлов.
+    # Выход ffmpeg читается кусками, поэтому пик памяти ограничен max_seconds: ~6 байт на сэмпл.
+    cmd = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error", "-threads", "0",
+        "-i", "pipe:0",
+        "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(sample_rate),
+        "pipe:1"
+    ]
+    max_bytes = int(max_seconds * sample_rate) * 2 if max_seconds else None
+    try:
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except FileNotFoundError as e:
+        raise AudioDecodeError("ffmpeg not found") from e
+
+    errors = []
+
+    def feed():
+        try:
+            process.stdin.write(data)
+        except (BrokenPipeError, OSError):
+            pass
+        finally:
+            try:
+                process.stdin.close()
+            except OSError:
+                pass
+
+    def drain_stderr():
+        errors.append(process.stderr.read())
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    stderr_reader = threading.Thread(target=drain_stderr, daemon=True)
+    feeder.start()
+    stderr_reader.start()
+
+    pcm = bytearray()
+    try:
+        while True:
+            chunk = process.stdout.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            pcm.extend(chunk)
+            if max_bytes is not None and len(pcm) > max_bytes:
+                raise AudioTooLong(f"Audio is longer than {max_seconds} seconds")
+    except BaseException:
+        process.kill()
+        raise
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+        feeder.join()
+        stderr_reader.join()
+
+    if returncode != 0:
+        message = errors[0].decode(errors='replace').strip() if errors and errors[0] else ''
+        raise AudioDecodeError(f"ffmpeg failed with code {returncode}: {message}")
+
+    # Последний нечётный байт (если ffmpeg оборвал вывод) отбрасываем
+    samples = np.frombuffer(pcm, dtype=np.int16, count=len(pcm) // 2)
+    audio = samples.astype(np.float32)
+    audio *= 1.0 / 32768.0
+    return audio
@@ -0,0 +1,118 @@
+import os
+from typing import Any, Dict, Optional, Type
+
+import numpy as np
+
+from vrecog.audio import decode_audio_bytes
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# Движок распознавания. load() загружает модель, transcribe() принимает float32 моно 16 кГц
+# (или то, что понимает сам движок, например путь к файлу) и возвращает текст.
+class ASRBackend:
+    name = ''
+    # Можно ли загрузить модель до fork и отдать её воркерам пула
+    fork_safe = True
+
+    def __init__(self, model: str, model_path: Optional[str] = None, cpu_threads: int = 0,
+                 beam_size: int = 0, language: Optional[str] = None, compute_type: Optional[str] = None,
+                 local_files_only: bool = False):
+        self.model_name = model
+        self.model_path = model_path
+        self.cpu_threads = cpu_threads
+        # 0 - значение по умолчанию движка
+        self.beam_size = beam_size
+        self.language = language
+        self.compute_type = compute_type
+        self.local_files_only = local_files_only
+        self.model = None
+
+    def load(self):
+        raise NotImplementedError
+
+    def transcribe(self, audio: Any) -> str:
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.model_name!r})"
+
+
+class WhisperBackend(ASRBackend):
+    # openai-whisper (PyTorch), на CPU в float32
+    name = 'whisper'
+
+    def load(self):
+        import whisper
+        if self.cpu_threads:
+            import torch
+            torch.set_num_threads(self.cpu_threads)
+        self.model = whisper.load_model(self.model_name, download_root=self.model_path)
+        return self
+
+    def transcribe(self, audio: Any) -> str:
+        options = {}
+        if self.beam_size:
+            options['beam_size'] = self.beam_size
+        if self.language:
+            options['language'] = self.language
+        if self.model.device.type == 'cpu':
+            # Иначе whisper на каждом вызове предупреждает, что FP16 на CPU не поддерживается
+            options['fp16'] = False
+        script = self.model.transcribe(audio, **options)
+        return script["text"] if "text" in script else ""
+
+
+class FasterWhisperBackend(ASRBackend):
+    # faster-whisper: та же модель Whisper, сконвертированная в CTranslate2, с квантованием int8 на CPU.
+    # model_path - каталог со сконвертированной моделью (ct2-transformers-converter) или каталог загрузки.
+    name = 'faster_whisper'
+    # Пул потоков CTranslate2 не переживает fork: каждый воркер загружает модель сам
+    fork_safe = False
+
+    def load(self):
+        from faster_whisper import WhisperModel
+        model = self.model_name
+        if self.model_path and os.path.isfile(os.path.join(self.model_path, 'model.bin')):
+            model = self.model_path
+        self.model = WhisperModel(
+            model,
+            device='cpu',
+            compute_type=self.compute_type or 'int8',
+            cpu_threads=self.cpu_threads,
+            download_root=None if model == self.model_path else self.model_path,
+            local_files_only=self.local_files_only
+        )
+        return self
+
+    def transcribe(self, audio: Any) -> str:
+        options = {'language': self.language}
+        if self.beam_size:
+            options['beam_size'] = self.beam_size
+        segments, _ = self.model.transcribe(audio, **options)
+        # segments - генератор: распознавание идёт по мере чтения
+        return ''.join(segment.text for segment in segments)
+
+
+BACKENDS: Dict[str, Type[ASRBackend]] = {
+    WhisperBackend.name: WhisperBackend,
+    FasterWhisperBackend.name: FasterWhisperBackend,
+}
+
+
+def create_backend(name: str, **kwargs) -> ASRBackend:
+    try:
+        backend_class = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown ASR backend: {name}, expected one of {', '.join(BACKENDS)}")
+    return backend_class(**kwargs)
+
+
+def to_audio(audio: Any, max_seconds: float = None) -> Any:
+    if isinstance(audio, (bytes, bytearray, memoryview)):
+        # Сырые байты OGG/Opus декодируются в памяти, без временного файла
+        return decode_audio_bytes(audio, max_seconds=max_seconds)
+    if isinstance(audio, np.ndarray) and audio.dtype != np.float32:
+        return audio.astype(np.float32)
+    return audio
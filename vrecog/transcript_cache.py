@@ -0,0 +1,97 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from utils.cache import TTLCache
+from monitoring.metrics import CACHE_LOOKUPS
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def content_key(data) -> str:
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+def file_key(file_unique_id) -> str:
+    return 'file:' + file_unique_id
+
+
+# Кэш распознанных голосовых. Ключи - file_unique_id Telegram (проверяется до скачивания)
+# и sha256 содержимого (тот же звук, пересланный как другой файл). Свежие записи - в LRU в памяти,
+# все - в SQLite (запись сразу на диск), чтобы попадания переживали перезапуск.
+class TranscriptCache:
+    def __init__(self, path, maxsize=1024, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self._memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS transcripts (
+                key TEXT PRIMARY KEY,
+                text TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        if ttl:
+            self._conn.execute("DELETE FROM transcripts WHERE created_at < ?", (time.time() - ttl,))
+
+    def _get(self, key) -> Optional[str]:
+        text = self._memory.get(key)
+        if text is not None:
+            CACHE_LOOKUPS.labels(cache='transcript', result='memory').inc()
+            return text
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT text, created_at FROM transcripts WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or (self.ttl and row[1] < time.time() - self.ttl):
+            CACHE_LOOKUPS.labels(cache='transcript', result='miss').inc()
+            return None
+        CACHE_LOOKUPS.labels(cache='transcript', result='disk').inc()
+        self._memory.put(key, row[0])
+        return row[0]
+
+    def get(self, file_unique_id=None, data=None) -> Optional[str]:
+        if file_unique_id:
+            text = self._get(file_key(file_unique_id))
+            if text is not None:
+                return text
+        if data is not None:
+            return self._get(content_key(data))
+        return None
+
+    def put(self, text: str, file_unique_id=None, data=None):
+        if not text:
+            # Пустой результат не кэшируем: повторная отправка должна распознаваться заново
+            return
+        keys = []
+        if file_unique_id:
+            keys.append(file_key(file_unique_id))
+        if data is not None:
+            keys.append(content_key(data))
+        self._put(keys, text)
+
+    def _put(self, keys, text):
+        now = time.time()
+        try:
+            with self._lock:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO transcripts (key, text, created_at) VALUES (?, ?, ?)",
+                    [(key, text, now) for key in keys]
+                )
+        except sqlite3.Error as e:
+            logger.error(f"Error saving transcript to cache: {str(e)}")
+        for key in keys:
+            self._memory.put(key, text)
+
+    def stats(self) -> dict:
+        return self._memory.stats()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
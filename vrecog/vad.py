@@ -0,0 +1,98 @@
+from typing import List, Tuple
+
+import numpy as np
+
+from vrecog.audio import SAMPLE_RATE
+
+FRAME_MS = 30
+# Тише этого уровня (дБ относительно полной шкалы) - всегда тишина
+MIN_SPEECH_DB = -50.0
+# Порог речи - доля расстояния от уровня шума до уровня громких фрагментов
+THRESHOLD_RATIO = 0.3
+
+
+def frame_energy_db(audio: np.ndarray, frame_length: int) -> np.ndarray:
+    frames = len(audio) // frame_length
+    if frames == 0:
+        return np.empty(0, dtype=np.float32)
+    framed = audio[:frames * frame_length].reshape(frames, frame_length)
+    rms = np.sqrt(np.mean(np.square(framed, dtype=np.float32), axis=1))
+    return 20.0 * np.log10(rms + 1e-10)
+
+
+def _runs(mask: np.ndarray) -> List[Tuple[int, int]]:
+    # Непрерывные участки True: [(начало, конец), ...], конец не включается
+    padded = np.concatenate(([False], mask, [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return list(zip(edges[::2].tolist(), edges[1::2].tolist()))
+
+
+def detect_speech(audio: np.ndarray, sample_rate: int = SAMPLE_RATE, min_silence_ms=400, min_speech_ms=150):
+    # Энергетический детектор речи: возвращает участки речи в кадрах и энергию кадров
+    frame_length = sample_rate * FRAME_MS // 1000
+    energy = frame_energy_db(audio, frame_length)
+    if not len(energy):
+        return [], energy, frame_length
+    floor = np.percentile(energy, 10)
+    peak = np.percentile(energy, 95)
+    threshold = max(MIN_SPEECH_DB, floor + THRESHOLD_RATIO * (peak - floor))
+    speech = energy >= threshold
+
+    # Короткие паузы внутри фразы не считаем тишиной, короткие щелчки - не считаем речью
+    min_silence = max(1, min_silence_ms // FRAME_MS)
+    min_speech = max(1, min_speech_ms // FRAME_MS)
+    for start, end in _runs(~speech):
+        if end - start < min_silence and start > 0 and end < len(speech):
+            speech[start:end] = True
+    segments = [(start, end) for start, end in _runs(speech) if end - start >= min_speech]
+    return segments, energy, frame_length
+
+
+def _split_long(start, end, energy, max_frames) -> List[Tuple[int, int]]:
+    # Слишком длинный участок без пауз режем в самом тихом кадре последней трети окна
+    parts = []
+    while end - start > max_frames:
+        window_start = start + max_frames * 2 // 3
+        # Кусок не может быть пустым, иначе цикл не сдвинется
+        cut = max(start + 1, window_start + int(np.argmin(energy[window_start:start + max_frames])))
+        parts.append((start, cut))
+        start = cut
+    parts.append((start, end))
+    return parts
+
+
+def split_on_silence(audio: np.ndarray, sample_rate: int = SAMPLE_RATE, max_chunk_seconds=30.0,
+                     min_silence_ms=400, pad_ms=200) -> List[Tuple[int, int]]:
+    # Делит запись на куски не длиннее max_chunk_seconds по паузам, тишина в начале и в конце отрезается.
+    # Возвращает границы кусков в сэмплах; пустой список - в записи нет речи.
+    segments, energy, frame_length = detect_speech(audio, sample_rate, min_silence_ms=min_silence_ms)
+    if not segments:
+        return []
+    max_frames = max(2, int(max_chunk_seconds * 1000) // FRAME_MS)
+    pieces = []
+    for start, end in segments:
+        pieces.extend(_split_long(start, end, energy, max_frames))
+
+    # Соседние участки речи склеиваем, пока кусок укладывается в max_chunk_seconds
+    chunks = []
+    chunk_start, chunk_end = pieces[0]
+    for start, end in pieces[1:]:
+        if end - chunk_start <= max_frames:
+            chunk_end = end
+        else:
+            chunks.append((chunk_start, chunk_end))
+            chunk_start, chunk_end = start, end
+    chunks.append((chunk_start, chunk_end))
+
+    pad = sample_rate * pad_ms // 1000
+    bounds = []
+    for index, (start, end) in enumerate(chunks):
+        sample_start = max(0, start * frame_length - pad)
+        sample_end = min(len(audio), end * frame_length + pad)
+        # Поля не должны заходить на соседний кусок
+        if bounds and sample_start < bounds[-1][1]:
+            middle = (chunks[index - 1][1] * frame_length + start * frame_length) // 2
+            bounds[-1] = (bounds[-1][0], middle)
+            sample_start = middle
+        bounds.append((sample_start, sample_end))
+    return bounds
@@ -1,30 +1,157 @@
-from typing import Any
+from typing import Any, Callable, List, Optional
 #import torch
 #import torchaudio
-import whisper
 import os
+import threading
+from concurrent.futures import as_completed
 
 if __name__ == '__main__':
     import sys
     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import config
+from vrecog.worker_pool import TranscriptionPool
+from vrecog.audio import decode_audio_bytes, SAMPLE_RATE
+from vrecog.backends import ASRBackend, create_backend, to_audio
+from vrecog.vad import split_on_silence
+from monitoring.metrics import QUEUE_DEPTH
 #from pyannote.audio import Pipeline
 #import os
 
 import logging
 logger = logging.getLogger(__name__)
 
-WHISPER_MODEL=config.WHISPER_MODEL
-#WHISPER_MODEL="small"
-WHISPER_MODEL_PATH = config.WHISPER_MODEL_PATH
-logger.info(f"Loading whisper model: {WHISPER_MODEL}")
-model = whisper.load_model(WHISPER_MODEL, download_root = WHISPER_MODEL_PATH)
-logger.info(f"Whisper model {WHISPER_MODEL} loaded")
+# Модель загружается при первом обращении (или в фоне через warm_up), а не при импорте модуля.
+# Пока модель грузится, голосовые сообщения ждут на блокировке, а не отклоняются.
+_model = None
+_model_lock = threading.Lock()
 
 
-def recognise_text(audio_path: Any) -> str:
-    script = model.transcribe(audio_path)
-    return script["text"] if "text" in script else ""
+def _cpu_threads() -> int:
+    if config.ASR_CPU_THREADS:
+        return config.ASR_CPU_THREADS
+    if config.WHISPER_WORKERS > 0:
+        # Ядра делятся поровну между воркерами пула
+        return max(1, (os.cpu_count() or 1) // config.WHISPER_WORKERS)
+    return 0
+
+
+def create_configured_backend() -> ASRBackend:
+    return create_backend(
+        config.ASR_BACKEND,
+        model=config.ASR_MODEL,
+        model_path=config.ASR_MODEL_PATH,
+        cpu_threads=_cpu_threads(),
+        beam_size=config.ASR_BEAM_SIZE,
+        language=config.ASR_LANGUAGE,
+        compute_type=config.ASR_COMPUTE_TYPE,
+        local_files_only=config.ASR_LOCAL_FILES_ONLY
+    )
+
+
+def load_model() -> ASRBackend:
+    global _model
+    with _model_lock:
+        if _model is None:
+            backend = create_configured_backend()
+            logger.info(f"Loading {backend.name} model: {backend.model_name}")
+            _model = backend.load()
+            logger.info(f"{backend.name} model {backend.model_name} loaded")
+        return _model
+
+
+def is_ready() -> bool:
+    return _model is not None or _pool is not None
+
+
+def warm_up():
+    # Загружает модель (и поднимает пул воркеров, если он включён)
+    if get_transcription_pool() is None:
+        load_model()
+
+
+def transcribe_with_model(model: ASRBackend, audio: Any) -> str:
+    return model.transcribe(to_audio(audio, max_seconds=config.VOICE_MAX_SECONDS))
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_transcription_pool():
+    # Пул процессов распознавания, WHISPER_WORKERS=0 - распознавание в текущем потоке
+    global _pool
+    if config.WHISPER_WORKERS <= 0:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = TranscriptionPool(
+                load_model,
+                transcribe_with_model,
+                num_workers=config.WHISPER_WORKERS,
+                default_timeout=config.WHISPER_JOB_TIMEOUT or None,
+                preload=create_configured_backend().fork_safe
+            )
+            QUEUE_DEPTH.labels(queue='whisper').set_function(lambda: _pool.queue_depth)
+        return _pool
+
+
+def stitch(texts: List[Optional[str]]) -> str:
+    return ' '.join(text.strip() for text in texts if text and text.strip())
+
+
+def _report(on_progress, texts, done):
+    # Пользователю показываем только непрерывное начало текста: куски могут завершаться не по порядку
+    if on_progress is None:
+        return
+    ready = next((index for index, text in enumerate(texts) if text is None), len(texts))
+    try:
+        on_progress(stitch(texts[:ready]), done, len(texts))
+    except Exception as e:
+        logger.warning(f"Progress callback failed: {str(e)}")
+
+
+def transcribe_chunks(chunks, on_progress: Callable[[str, int, int], None] = None,
+                      priority: int = 0, timeout: float = None) -> str:
+    texts: List[Optional[str]] = [None] * len(chunks)
+    pool = get_transcription_pool()
+    if pool is None:
+        model = load_model()
+        for index, chunk in enumerate(chunks):
+            texts[index] = transcribe_with_model(model, chunk)
+            _report(on_progress, texts, index + 1)
+        return stitch(texts)
+
+    # Куски распознаются параллельно во всех воркерах пула
+    jobs = [pool.submit(chunk, priority=priority, timeout=timeout) for chunk in chunks]
+    indexes = {job.future: index for index, job in enumerate(jobs)}
+    try:
+        for done, future in enumerate(as_completed(indexes), start=1):
+            texts[indexes[future]] = future.result()
+            _report(on_progress, texts, done)
+    except BaseException:
+        for job in jobs:
+            job.cancel()
+        raise
+    return stitch(texts)
+
+
+def recognise_text(audio_path: Any, priority: int = 0, timeout: float = None,
+                   on_progress: Callable[[str, int, int], None] = None) -> str:
+    # on_progress(текст, готово кусков, всего кусков) вызывается по мере распознавания длинной записи
+    if config.VAD_CHUNKING and isinstance(audio_path, (bytes, bytearray, memoryview)):
+        audio = decode_audio_bytes(audio_path, max_seconds=config.VOICE_MAX_SECONDS)
+        bounds = split_on_silence(audio, max_chunk_seconds=config.VAD_MAX_CHUNK_SECONDS)
+        if not bounds:
+            logger.info("No speech detected in voice message")
+            return ""
+        if len(audio) < config.VAD_MIN_AUDIO_SECONDS * SAMPLE_RATE:
+            # Короткая запись распознаётся целиком, только без тишины по краям
+            bounds = [(bounds[0][0], bounds[-1][1])]
+        return transcribe_chunks([audio[start:end] for start, end in bounds], on_progress, priority, timeout)
+
+    pool = get_transcription_pool()
+    if pool is None:
+        return transcribe_with_model(load_model(), audio_path)
+    return pool.transcribe_sync(audio_path, priority=priority, timeout=timeout)
 
 if __name__ == '__main__':
     print(recognise_text("voices/audio_2024-11-06_18-04-50.ogg"))
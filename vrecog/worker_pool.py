@@ -0,0 +1,333 @@
+import heapq
+import itertools
+import multiprocessing
+import os
+import socket
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError, TimeoutError as FutureTimeout
+from multiprocessing.connection import wait as wait_connections
+from typing import Any, Callable, Optional
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Модель, загруженная в родительском процессе до fork: воркеры получают её copy-on-write
+_inherited_model = None
+
+# Сколько transcribe_sync ждёт сверх срока задачи, пока пул сам завершит её по таймауту
+RESULT_GRACE = 5.0
+
+
+def _settle(future: Future, result=None, error: BaseException = None) -> bool:
+    # Задачу могут отменить из другого потока между проверкой done() и записью результата
+    try:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+        return True
+    except InvalidStateError:
+        return False
+
+
+def _worker_main(conn, load_model: Callable[[], Any], transcribe: Callable[[Any, Any], str], num_threads: int):
+    if num_threads:
+        try:
+            import torch
+            torch.set_num_threads(num_threads)
+        except ImportError:
+            pass
+    model = _inherited_model if _inherited_model is not None else load_model()
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            return
+        if message is None:
+            return
+        job_id, audio = message
+        started = time.monotonic()
+        try:
+            text = transcribe(model, audio)
+            conn.send((job_id, True, text, time.monotonic() - started))
+        except Exception as e:
+            conn.send((job_id, False, f"{type(e).__name__}: {e}", time.monotonic() - started))
+
+
+class TranscriptionJob:
+    def __init__(self, job_id, audio, priority, timeout):
+        self.job_id = job_id
+        self.audio = audio
+        self.priority = priority
+        self.submitted_at = time.monotonic()
+        self.deadline = self.submitted_at + timeout if timeout else None
+        self.started_at = None
+        self.finished_at = None
+        self.future = Future()
+
+    @property
+    def wait_time(self) -> Optional[float]:
+        if self.started_at is None:
+            return None
+        return self.started_at - self.submitted_at
+
+    @property
+    def inference_time(self) -> Optional[float]:
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    def result(self, timeout=None) -> str:
+        return self.future.result(timeout)
+
+    def cancel(self) -> bool:
+        # Задача из очереди просто снимается, выполняющаяся - прерывается вместе с процессом воркера.
+        # Future.cancel() атомарен: завершённую пулом задачу отменить уже нельзя
+        return self.future.cancel()
+
+    def __lt__(self, other):
+        return (self.priority, self.job_id) < (other.priority, other.job_id)
+
+
+class _Worker:
+    def __init__(self, ctx, load_model, transcribe, num_threads):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main,
+            args=(child_conn, load_model, transcribe, num_threads),
+            daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.job: Optional[TranscriptionJob] = None
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+# Пул процессов распознавания. Меньшее значение priority - более срочная задача.
+class TranscriptionPool:
+    def __init__(self, load_model: Callable[[], Any], transcribe: Callable[[Any, Any], str],
+                 num_workers=None, default_timeout=None, start_method=None, preload=True):
+        global _inherited_model
+        self.load_model = load_model
+        self.transcribe = transcribe
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.default_timeout = default_timeout
+        if start_method is None:
+            start_method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+        self._ctx = multiprocessing.get_context(start_method)
+        self._num_threads = max(1, (os.cpu_count() or 1) // self.num_workers)
+        if start_method == 'fork' and preload:
+            _inherited_model = load_model()
+        self._queue = []
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._stats = {'completed': 0, 'failed': 0, 'timeouts': 0, 'cancelled': 0, 'restarts': 0,
+                       'wait_time_total': 0.0, 'inference_time_total': 0.0}
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._workers = [self._spawn() for _ in range(self.num_workers)]
+        self._thread = threading.Thread(target=self._run, name='transcription-pool', daemon=True)
+        self._thread.start()
+
+    def _spawn(self):
+        return _Worker(self._ctx, self.load_model, self.transcribe, self._num_threads)
+
+    def _wake(self):
+        try:
+            self._wake_w.send(b'\0')
+        except OSError:
+            pass
+
+    def submit(self, audio, priority=0, timeout=None) -> TranscriptionJob:
+        job = TranscriptionJob(next(self._ids), audio, priority, timeout or self.default_timeout)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Transcription pool is closed")
+            heapq.heappush(self._queue, job)
+        self._wake()
+        return job
+
+    def transcribe_sync(self, audio, priority=0, timeout=None) -> str:
+        job = self.submit(audio, priority, timeout)
+        # Ждём частями: если поток пула остановился, задача уже никогда не завершится
+        while True:
+            try:
+                return job.result(1.0)
+            except FutureTimeout:
+                if job.future.done():
+                    raise
+                if not self._thread.is_alive():
+                    job.cancel()
+                    raise RuntimeError("Transcription pool is not running")
+                if job.deadline is not None and time.monotonic() > job.deadline + RESULT_GRACE:
+                    job.cancel()
+                    raise TimeoutError("Transcription job timed out")
+
+    @property
+    def queue_depth(self) -> int:
+        with self._lock:
+            return sum(1 for job in self._queue if not job.future.done())
+
+    @property
+    def busy_workers(self) -> int:
+        with self._lock:
+            return sum(1 for worker in self._workers if worker.job is not None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            done = stats['completed'] + stats['failed']
+            stats['queue_depth'] = sum(1 for job in self._queue if not job.future.done())
+            stats['busy_workers'] = sum(1 for worker in self._workers if worker.job is not None)
+        stats['avg_wait_time'] = stats['wait_time_total'] / done if done else 0.0
+        stats['avg_inference_time'] = stats['inference_time_total'] / done if done else 0.0
+        return stats
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            pending, self._queue = self._queue, []
+        for job in pending:
+            job.cancel()
+        self._wake()
+        self._thread.join()
+
+    def _expire_queued(self, job: TranscriptionJob, now) -> bool:
+        if job.future.done():
+            if job.future.cancelled():
+                self._stats['cancelled'] += 1
+            return True
+        if job.deadline is not None and now >= job.deadline:
+            if _settle(job.future, error=TimeoutError("Transcription job timed out in queue")):
+                self._stats['timeouts'] += 1
+            return True
+        return False
+
+    def _next_job(self) -> Optional[TranscriptionJob]:
+        now = time.monotonic()
+        while self._queue:
+            job = heapq.heappop(self._queue)
+            if self._expire_queued(job, now):
+                continue
+            return job
+        return None
+
+    def _assign(self):
+        with self._lock:
+            for worker in self._workers:
+                if worker.job is not None:
+                    continue
+                job = self._next_job()
+                if job is None:
+                    return
+                job.started_at = time.monotonic()
+                worker.job = job
+                try:
+                    worker.conn.send((job.job_id, job.audio))
+                except (OSError, ValueError) as e:
+                    self._fail_worker(worker, e)
+
+    def _restart(self, worker: _Worker) -> _Worker:
+        worker.kill()
+        self._stats['restarts'] += 1
+        replacement = self._spawn()
+        self._workers[self._workers.index(worker)] = replacement
+        return replacement
+
+    def _fail_worker(self, worker: _Worker, error):
+        job = worker.job
+        worker.job = None
+        if job is not None and _settle(job.future, error=RuntimeError(f"Transcription worker failed: {error}")):
+            self._stats['failed'] += 1
+        self._restart(worker)
+
+    def _finish(self, worker: _Worker, message):
+        job_id, ok, payload, inference_time = message
+        job = worker.job
+        worker.job = None
+        if job is None or job.job_id != job_id:
+            return
+        job.finished_at = time.monotonic()
+        if not _settle(job.future, payload if ok else None, None if ok else RuntimeError(payload)):
+            return
+        self._stats['wait_time_total'] += job.wait_time
+        self._stats['inference_time_total'] += inference_time
+        self._stats['completed' if ok else 'failed'] += 1
+        logger.info(f"Transcription job {job_id}: wait {job.wait_time:.2f}s, inference {inference_time:.2f}s")
+
+    def _check_running(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [job for job in self._queue if self._expire_queued(job, now)]
+            if expired:
+                self._queue = [job for job in self._queue if not job.future.done()]
+                heapq.heapify(self._queue)
+            for worker in list(self._workers):
+                job = worker.job
+                if job is None:
+                    continue
+                if job.future.done():
+                    # Задачу отменили во время распознавания
+                    worker.job = None
+                    self._stats['cancelled'] += 1
+                    self._restart(worker)
+                elif job.deadline is not None and now >= job.deadline:
+                    worker.job = None
+                    if _settle(job.future, error=TimeoutError("Transcription job timed out")):
+                        self._stats['timeouts'] += 1
+                    self._restart(worker)
+
+    def _next_timeout(self) -> float:
+        with self._lock:
+            deadlines = [worker.job.deadline for worker in self._workers
+                         if worker.job is not None and worker.job.deadline is not None]
+            deadlines.extend(job.deadline for job in self._queue if job.deadline is not None)
+        # Отмену выполняющихся задач проверяем не реже раза в секунду
+        if not deadlines:
+            return 1.0
+        return min(1.0, max(0.0, min(deadlines) - time.monotonic()))
+
+    def _step(self):
+        self._assign()
+        with self._lock:
+            conns = {worker.conn: worker for worker in self._workers if worker.job is not None}
+        ready = wait_connections(list(conns) + [self._wake_r], timeout=self._next_timeout())
+        for conn in ready:
+            if conn is self._wake_r:
+                self._wake_r.recv(4096)
+                continue
+            worker = conns[conn]
+            with self._lock:
+                try:
+                    self._finish(worker, conn.recv())
+                except (EOFError, OSError) as e:
+                    self._fail_worker(worker, e)
+        self._check_running()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                closed = self._closed
+            if closed:
+                break
+            try:
+                self._step()
+            except Exception as e:
+                # Поток пула не должен умирать молча: без него ни одна задача не завершится
+                logger.error(f"Error in transcription pool loop: {str(e)}")
+                time.sleep(0.1)
+        for worker in self._workers:
+            if worker.job is not None:
+                worker.job.cancel()
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+            worker.process.join(5)
+            if worker.process.is_alive():
+                worker.process.kill()